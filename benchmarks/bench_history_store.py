@@ -0,0 +1,126 @@
+"""聊天記錄存儲的微基準測試
+
+比較舊版 RoleManager 的列表實現與 HistoryStore 的環形緩衝實現。
+
+用法：
+    python benchmarks/bench_history_store.py --users 100000 --messages 50
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from bot.history_store import HistoryStore  # noqa: E402
+
+ROLE_ID = "butler"
+CONTENT = "您好，請問今天有什麼需要我幫忙安排的嗎？"
+
+
+class LegacyHistory:
+    """舊版 RoleManager 的聊天記錄實現（僅保留存取邏輯）"""
+
+    def __init__(self, max_length: int, expiry_hours: int):
+        self.chat_history = {}
+        self.history_expiry = timedelta(hours=expiry_hours)
+        self.max_history_length = max_length
+
+    def add_chat_history(self, user_id, role_id, message):
+        if user_id not in self.chat_history:
+            self.chat_history[user_id] = {}
+        if role_id not in self.chat_history[user_id]:
+            self.chat_history[user_id][role_id] = []
+        message['timestamp'] = datetime.now()
+        history = self.chat_history[user_id][role_id]
+        history.append(message)
+        if len(history) > self.max_history_length:
+            history.pop(0)
+        self._clean_old_history(user_id, role_id)
+
+    def get_chat_history(self, user_id, role_id):
+        if user_id in self.chat_history and role_id in self.chat_history[user_id]:
+            self._clean_old_history(user_id, role_id)
+            return [
+                {"role": msg["role"], "content": msg["content"]}
+                for msg in self.chat_history[user_id][role_id]
+            ]
+        return []
+
+    def _clean_old_history(self, user_id, role_id):
+        current_time = datetime.now()
+        history = self.chat_history[user_id][role_id]
+        valid_messages = [
+            msg for msg in history
+            if current_time - msg['timestamp'] < self.history_expiry
+        ]
+        self.chat_history[user_id][role_id] = valid_messages
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_legacy(users: int, messages: int, max_length: int):
+    store = LegacyHistory(max_length, 24)
+    start = time.perf_counter()
+    for _ in range(messages):
+        for user_id in range(users):
+            store.add_chat_history(user_id, ROLE_ID, {"role": "user", "content": CONTENT})
+    write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user_id in range(users):
+        store.get_chat_history(user_id, ROLE_ID)
+    read = time.perf_counter() - start
+    return write, read
+
+
+def run_store(users: int, messages: int, max_length: int):
+    store = HistoryStore(max_length, 24 * 3600)
+    start = time.perf_counter()
+    for _ in range(messages):
+        for user_id in range(users):
+            store.append(user_id, ROLE_ID, "user", CONTENT)
+    write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user_id in range(users):
+        store.get(user_id, ROLE_ID)
+    read = time.perf_counter() - start
+    return write, read
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--max-length", type=int, default=50)
+    parser.add_argument("--impl", choices=["legacy", "store", "both"], default="both",
+                        help="峰值內存按進程統計，比較內存時請分別運行")
+    args = parser.parse_args()
+
+    total = args.users * args.messages
+    print(f"用戶數 {args.users}，每人 {args.messages} 條消息，共 {total} 次寫入")
+
+    impls = [("legacy", run_legacy), ("store", run_store)]
+    for name, func in impls:
+        if args.impl not in (name, "both"):
+            continue
+        gc.collect()
+        write, read = func(args.users, args.messages, args.max_length)
+        print(
+            f"{name:>7}: 寫入 {write:7.2f}s ({write / total * 1e6:6.2f} µs/條)  "
+            f"讀取 {read:6.2f}s ({read / args.users * 1e6:6.2f} µs/次)  "
+            f"峰值 RSS {peak_rss_mb():8.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
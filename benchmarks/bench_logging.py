@@ -0,0 +1,124 @@
+"""日誌管道的基準測試
+
+模擬處理器：每次處理寫兩條 INFO 日誌和一條 DEBUG 日誌（級別為 INFO 時不輸出），
+並讓出一次事件循環。分別使用同步 FileHandler（f-string 預先格式化，舊寫法）和
+隊列日誌管道（延遲格式化、後台線程寫 JSON 文件），報告單次日誌調用的延遲
+p50/p99/最大值和處理吞吐量。--disk-latency-ms 模擬慢磁盤，每次寫文件額外阻塞。
+
+用法：
+    python benchmarks/bench_logging.py --requests 20000 --concurrency 200 --disk-latency-ms 1
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from bot.log_pipeline import TEXT_FORMAT, setup_logging  # noqa: E402
+
+logger = logging.getLogger("bench")
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+class SlowDiskMixin:
+    """每次 emit 額外阻塞 disk_latency 秒"""
+    disk_latency = 0.0
+
+    def emit(self, record):
+        if self.disk_latency:
+            time.sleep(self.disk_latency)
+        super().emit(record)
+
+
+class SlowFileHandler(SlowDiskMixin, logging.FileHandler):
+    pass
+
+
+def install_sync(path: str):
+    root = logging.getLogger()
+    handler = SlowFileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    return handler
+
+
+def install_queue(path: str):
+    pipeline = setup_logging(path, "INFO", rate_limit=0, queue_size=1_000_000, console=False)
+    for handler in pipeline.listener.handlers:
+        # 只替換 emit 的行為，保留 RotatingFileHandler 的格式化和輪轉
+        handler.__class__ = type("Slow" + type(handler).__name__, (SlowDiskMixin, type(handler)), {})
+    return pipeline
+
+
+async def run(mode: str, path: str, requests: int, concurrency: int, users: int):
+    if mode == "sync":
+        handler = install_sync(path)
+    else:
+        pipeline = install_queue(path)
+    latencies = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for n in counter:
+            user_id = n % users
+            if mode == "sync":
+                start = time.perf_counter()
+                logger.info(f"收到用戶 {user_id} 的消息，長度 {n % 200}")
+                logger.debug(f"用戶 {user_id} 的上下文: {[n] * 20}")
+                logger.info(f"已回覆用戶 {user_id}")
+            else:
+                start = time.perf_counter()
+                logger.info("收到用戶 %s 的消息，長度 %s", user_id, n % 200)
+                logger.debug("用戶 %s 的上下文: %s", user_id, [n] * 20)
+                logger.info("已回覆用戶 %s", user_id)
+            latencies.append((time.perf_counter() - start) / 3)
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    handled = time.perf_counter() - start
+    if mode == "sync":
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+    else:
+        pipeline.stop()
+    written = time.perf_counter() - start
+
+    print(
+        f"{mode:>5}: 處理 {requests / handled:9.0f} 次/s  "
+        f"p50 {percentile(latencies, 50) * 1e6:8.1f} µs  "
+        f"p99 {percentile(latencies, 99) * 1e6:8.1f} µs  "
+        f"最大 {max(latencies) * 1e6:8.1f} µs  "
+        f"平均 {statistics.mean(latencies) * 1e6:8.1f} µs  "
+        f"寫完 {written:6.2f} s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--disk-latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+    SlowDiskMixin.disk_latency = args.disk_latency_ms / 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("sync", "queue"):
+            asyncio.run(run(mode, os.path.join(tmp, f"{mode}.log"), args.requests,
+                            args.concurrency, args.users))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""OpenAI 調用層的尾延遲基準測試
+
+在本地啟動模擬 OpenAI 服務器（注入長尾延遲、500 和 429 錯誤），
+分別以三種方式發出相同的聊天請求：
+
+- raw：SDK 不重試，直接調用
+- sdk：SDK 自帶的重試（max_retries=2）
+- caller：OpenAICaller（full jitter 重試、Retry-After、對沖和熔斷）
+
+報告每種方式的成功率和成功請求的 p50/p95/p99 延遲。--stream 改為串流請求
+（OpenAICaller 使用 chat_stream 端點），延遲為讀完整個串流的時間。
+
+用法：
+    python benchmarks/bench_openai_caller.py --requests 2000 --concurrency 50
+    python benchmarks/bench_openai_caller.py --requests 2000 --concurrency 50 --stream
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from bot.openai_caller import OpenAICaller  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+
+MESSAGES = [
+    {"role": "system", "content": "你現在是一位專業的管家。"},
+    {"role": "user", "content": "今天的行程幫我安排一下"},
+]
+
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+async def run(mode: str, base_url: str, requests: int, concurrency: int, timeout: float, stream: bool):
+    client = AsyncOpenAI(api_key="test", base_url=base_url, max_retries=2 if mode == "sdk" else 0)
+    endpoint = "chat_stream" if stream else "chat"
+    caller = OpenAICaller(client, {endpoint: {"timeout": timeout, "hedge": True}}, base_delay=0.1)
+    latencies = []
+    failures = 0
+    counter = iter(range(requests))
+
+    async def request():
+        kwargs = {"model": "gpt-3.5-turbo", "messages": MESSAGES, "max_tokens": 100, "stream": stream}
+        if mode == "caller":
+            response = await caller.call(endpoint, client.chat.completions.create, **kwargs)
+        else:
+            response = await client.chat.completions.create(timeout=timeout, **kwargs)
+        if stream:
+            async for _ in response:
+                pass
+
+    async def worker():
+        nonlocal failures
+        for _ in counter:
+            start = time.perf_counter()
+            try:
+                await request()
+            except Exception:
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await client.close()
+
+    print(
+        f"{mode:<7} 成功率 {len(latencies) / requests:7.2%}  "
+        f"p50 {percentile(latencies, 50) * 1000:7.0f} ms  "
+        f"p95 {percentile(latencies, 95) * 1000:7.0f} ms  "
+        f"p99 {percentile(latencies, 99) * 1000:7.0f} ms  "
+        f"耗時 {elapsed:6.1f} s"
+    )
+    if mode == "caller":
+        chat = caller.stats()[endpoint]
+        print(f"        重試 {chat['retries']}，對沖 {chat['hedges']}（勝出 {chat['hedge_wins']}），"
+              f"熔斷 {chat['breaker_trips']} 次，拒絕 {chat['rejected']}")
+
+
+async def main(args):
+    server = FakeOpenAI(
+        latency_ms=args.latency_ms,
+        tail_rate=args.tail_rate,
+        tail_ms=args.tail_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=1,
+    )
+    base_url = await server.start()
+    print(f"請求 {args.requests}，並發 {args.concurrency}，延遲中位數 {args.latency_ms} ms，"
+          f"長尾 {args.tail_rate:.0%} × {args.tail_ms} ms，500 {args.error_rate:.0%}，429 {args.rate_limit_rate:.0%}")
+    try:
+        for mode in args.modes.split(","):
+            await run(mode, base_url, args.requests, args.concurrency, args.timeout, args.stream)
+        if args.stream:
+            print(f"服務端觀察到提前關閉的串流 {server.stats()['abandoned_streams']} 個")
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--tail-rate', type=float, default=0.03)
+    parser.add_argument('--tail-ms', type=float, default=3000)
+    parser.add_argument('--error-rate', type=float, default=0.02)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.01)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--modes', default='raw,sdk,caller')
+    parser.add_argument('--stream', action='store_true')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,126 @@
+"""啟動時間的基準測試
+
+每輪在新的子進程中依次計時：導入 bot.role_chat_bot（含讀取和校驗配置）、
+創建 RoleChatBot、創建 Application（開始輪詢前的全部同步工作），並檢查導入後
+是否已經加載了應該延遲導入的重型模塊（openai、tiktoken、Pillow）。
+最後用 python -X importtime 列出導入耗時最多的模塊。
+
+--max-import-ms 給出導入時間中位數的上限，超出時以非零狀態退出，可在 CI 中防止回退。
+
+用法：
+    python benchmarks/bench_startup.py --runs 10 --max-import-ms 800
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+
+# 導入 bot.role_chat_bot 時不應加載的模塊
+LAZY_MODULES = ("openai", "tiktoken", "PIL")
+
+CHILD = '''
+import json
+import sys
+import time
+
+started = time.perf_counter()
+from bot import role_chat_bot
+imported = time.perf_counter()
+lazy = [name for name in {lazy!r} if name in sys.modules]
+bot = role_chat_bot.RoleChatBot()
+created = time.perf_counter()
+bot.build_application()
+built = time.perf_counter()
+print(json.dumps({{
+    "import": imported - started,
+    "bot": created - imported,
+    "application": built - created,
+    "eager": lazy,
+}}))
+'''
+
+
+def child_env(workdir: str) -> dict:
+    base = os.path.join(REPO_DIR, 'config', 'config.py')
+    if not os.path.exists(base):
+        base = os.path.join(REPO_DIR, 'config', 'config.example.py')
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": SRC_DIR,
+        "BOT_CONFIG_FILE": base,
+        "BOT_TOKEN": "123456:startup-bench",
+        "OPENAI_API_KEY": "sk-startup-bench",
+        "STORAGE_BACKEND": "memory",
+        "METRICS_PORT": "0",
+        "TTS_CACHE_DIR": os.path.join(workdir, 'tts_cache'),
+    })
+    return env
+
+
+def run_once(env: dict, workdir: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(lazy=LAZY_MODULES)],
+        env=env, cwd=workdir, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_profile(env: dict, workdir: str, top: int) -> list:
+    """返回 -X importtime 中累計耗時最多的模塊 [(毫秒, 模塊名)]"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import bot.role_chat_bot"],
+        env=env, cwd=workdir, capture_output=True, text=True, check=True
+    ).stderr
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        entries.append((int(cumulative) / 1000, name.strip()))
+    return sorted(entries, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-import-ms", type=float, default=0,
+                        help="導入時間中位數的上限（毫秒），0 表示不檢查")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = child_env(workdir)
+        results = [run_once(env, workdir) for _ in range(args.runs)]
+        for stage in ("import", "bot", "application"):
+            samples = [result[stage] * 1000 for result in results]
+            print(f"{stage:>11}: 中位數 {statistics.median(samples):8.1f} ms  "
+                  f"最小 {min(samples):8.1f} ms  最大 {max(samples):8.1f} ms")
+        total = statistics.median(sum(result[stage] for stage in ("import", "bot", "application")) * 1000
+                                  for result in results)
+        print(f"{'total':>11}: 中位數 {total:8.1f} ms")
+
+        print(f"\n導入耗時最多的 {args.top} 個模塊（累計）：")
+        for elapsed, name in import_profile(env, workdir, args.top):
+            print(f"{elapsed:9.1f} ms  {name}")
+
+    failed = False
+    eager = sorted({name for result in results for name in result["eager"]})
+    if eager:
+        print(f"\n導入時已加載應延遲導入的模塊: {', '.join(eager)}")
+        failed = True
+    import_ms = statistics.median(result["import"] * 1000 for result in results)
+    if args.max_import_ms and import_ms > args.max_import_ms:
+        print(f"\n導入時間中位數 {import_ms:.1f} ms 超過上限 {args.max_import_ms:.1f} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
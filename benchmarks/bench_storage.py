@@ -0,0 +1,82 @@
+"""會話持久化的基準測試
+
+模擬處理器：每次處理追加一條用戶消息和一條回覆，並讓出一次事件循環。
+分別在不持久化（memory）和 SQLite WAL 後台批量寫入下運行，
+報告處理器延遲 p50/p99、處理吞吐量，以及寫入全部落盤的持續吞吐量。
+
+用法：
+    python benchmarks/bench_storage.py --requests 50000 --concurrency 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from bot.history_store import HistoryStore  # noqa: E402
+from bot.storage import create_storage  # noqa: E402
+
+ROLE_ID = "butler"
+USER_TEXT = "今天的行程幫我安排一下"
+REPLY_TEXT = "好的，我已為您安排好今天的行程，上午十點會議，下午三點健身。"
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+async def run(backend: str, path: str, requests: int, concurrency: int, users: int):
+    storage = create_storage(backend, path, 24 * 3600, 50)
+    await storage.start()
+    history = HistoryStore(50, 24 * 3600)
+    latencies = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for n in counter:
+            user_id = n % users
+            start = time.perf_counter()
+            for role, content in (("user", USER_TEXT), ("assistant", REPLY_TEXT)):
+                history.append(user_id, ROLE_ID, role, content)
+                storage.append_message(user_id, ROLE_ID, role, content, time.time())
+            await asyncio.sleep(0)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    handled = time.perf_counter() - start
+    await storage.flush()
+    durable = time.perf_counter() - start
+    await storage.close()
+
+    writes = requests * 2
+    print(
+        f"{backend:>7}: 處理 {requests / handled:9.0f} 次/s  "
+        f"p50 {percentile(latencies, 50) * 1e6:7.1f} µs  "
+        f"p99 {percentile(latencies, 99) * 1e6:7.1f} µs  "
+        f"平均 {statistics.mean(latencies) * 1e6:7.1f} µs  "
+        f"落盤 {writes / durable:9.0f} 條/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50_000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--users", type=int, default=5_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ("memory", "sqlite"):
+            asyncio.run(run(backend, os.path.join(tmp, "sessions.db"), args.requests,
+                            args.concurrency, args.users))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""本地模擬的 OpenAI API 服務器，可注入延遲和錯誤
+
+支持 chat.completions（含串流和圖片輸入）、audio.speech、audio.transcriptions
+和 models。延遲服從對數正態分佈，並以一定概率出現長尾，chat、vision、whisper
+和 tts 可分別設置延遲中位數；錯誤按比例返回 429（帶 Retry-After）或 500。
+可在基準測試中導入，也可單獨運行：
+
+    python benchmarks/fake_openai.py --port 8081 --latency-ms 300 --endpoint-latency vision=1200,tts=500
+
+然後把 OPENAI_BASE_URL 設為 http://127.0.0.1:8081/v1。
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+from aiohttp import web
+
+REPLY_TEXT = "好的，我明白了。今天過得怎麼樣呢？有什麼想和我分享的嗎？"
+# 最小的合法 MP3 幀頭加填充，足夠讓客戶端當作音頻處理
+FAKE_MP3 = b"\xff\xfb\x90\x64" + b"\x00" * 2048
+
+
+def parse_latencies(text: str) -> dict:
+    """解析 "chat=300,vision=1200" 形式的各端點延遲中位數（毫秒）"""
+    latencies = {}
+    for item in filter(None, (part.strip() for part in (text or "").split(","))):
+        endpoint, _, value = item.partition("=")
+        latencies[endpoint.strip()] = float(value)
+    return latencies
+
+
+def has_image(body: dict) -> bool:
+    """請求的消息中是否帶有圖片，帶圖片的聊天請求按 vision 端點計"""
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return True
+    return False
+
+
+class FakeOpenAI:
+    """模擬 OpenAI 的 aiohttp 服務器"""
+
+    def __init__(self, latency_ms: float = 300, sigma: float = 0.3, tail_rate: float = 0.02,
+                 tail_ms: float = 3000, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: float = 0.5, stream_chunks: int = 10, seed: int = None,
+                 endpoint_latency_ms: dict = None):
+        self.latency_ms = latency_ms
+        # 端點 -> 延遲中位數，未列出的端點使用 latency_ms
+        self.endpoint_latency_ms = endpoint_latency_ms or {}
+        self.sigma = sigma
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        # 客戶端在串流結束前斷開的次數（如落選的對沖請求被關閉）
+        self.abandoned_streams = 0
+        self.calls = {}
+        self._runner = None
+
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self.app.router.add_post("/v1/audio/speech", self.speech)
+        self.app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        self.app.router.add_get("/v1/models", self.models)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """啟動服務器，返回 base_url"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "abandoned_streams": self.abandoned_streams,
+            "calls": dict(self.calls),
+        }
+
+    def _latency(self, endpoint: str) -> float:
+        if self.random.random() < self.tail_rate:
+            return self.tail_ms * (1 + self.random.random()) / 1000
+        median = self.endpoint_latency_ms.get(endpoint, self.latency_ms)
+        return median * math.exp(self.random.gauss(0, self.sigma)) / 1000
+
+    async def _inject(self, endpoint: str):
+        """等待模擬延遲，需要注入錯誤時返回錯誤響應"""
+        self.requests += 1
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"retry-after": str(self.retry_after)}
+            )
+        await asyncio.sleep(self._latency(endpoint))
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "The server had an error", "type": "server_error"}}, status=500
+            )
+        return None
+
+    async def chat_completions(self, request: web.Request):
+        body = await request.json()
+        error = await self._inject("vision" if has_image(body) else "chat")
+        if error is not None:
+            return error
+
+        created = int(time.time())
+        if not body.get("stream"):
+            return web.json_response({
+                "id": f"chatcmpl-{self.requests}",
+                "object": "chat.completion",
+                "created": created,
+                "model": body.get("model", "gpt-3.5-turbo"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": REPLY_TEXT},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 40, "total_tokens": 140},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        step = max(1, len(REPLY_TEXT) // self.stream_chunks)
+        try:
+            await response.prepare(request)
+            for start in range(0, len(REPLY_TEXT), step):
+                chunk = {
+                    "id": f"chatcmpl-{self.requests}",
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": body.get("model", "gpt-3.5-turbo"),
+                    "choices": [{"index": 0, "delta": {"content": REPLY_TEXT[start:start + step]}, "finish_reason": None}],
+                }
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                await asyncio.sleep(0.02)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            self.abandoned_streams += 1
+        return response
+
+    async def speech(self, request: web.Request):
+        await request.read()
+        error = await self._inject("tts")
+        if error is not None:
+            return error
+        return web.Response(body=FAKE_MP3, content_type="audio/mpeg")
+
+    async def transcriptions(self, request: web.Request):
+        await request.read()
+        error = await self._inject("whisper")
+        if error is not None:
+            return error
+        return web.json_response({"text": "你好，今天天氣不錯。"})
+
+    async def models(self, request: web.Request):
+        # 啟動時的連接預熱會調用，不注入延遲和錯誤
+        return web.json_response({
+            "object": "list",
+            "data": [{"id": "gpt-3.5-turbo", "object": "model", "created": 0, "owned_by": "system"}],
+        })
+
+
+async def main(args):
+    server = FakeOpenAI(
+        latency_ms=args.latency_ms,
+        tail_rate=args.tail_rate,
+        tail_ms=args.tail_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        endpoint_latency_ms=parse_latencies(args.endpoint_latency),
+    )
+    base_url = await server.start(args.host, args.port)
+    print(f"模擬 OpenAI 服務已啟動: {base_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--endpoint-latency', default='',
+                        help='各端點的延遲中位數（毫秒），如 chat=300,vision=1200,whisper=600,tts=500')
+    parser.add_argument('--tail-rate', type=float, default=0.02)
+    parser.add_argument('--tail-ms', type=float, default=3000)
+    parser.add_argument('--error-rate', type=float, default=0.02)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.01)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
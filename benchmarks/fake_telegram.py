@@ -0,0 +1,302 @@
+"""本地模擬的 Telegram Bot API 服務器
+
+提供機器人運行所需的方法：getMe、getUpdates（長輪詢）、getFile 和文件下載，
+記錄 sendMessage、editMessageText、sendVoice 等發出的消息，其餘方法一律返回成功。
+更新由測試程序通過控制端點推入，update_id 由服務器按入隊順序分配：
+
+    POST /_control/updates   [{"update": {...}, "kind": "message"}, ...]
+    GET  /_control/stats
+
+推入時帶上 ?wait=<秒>，會等到這些更新的首次回覆後再返回各自的延遲。
+
+每條推入的更新從入隊到機器人對該聊天發出第一條消息的時間按 kind 記錄，
+即用戶看到的首次回覆延遲；機器人把連續幾條消息合併回覆時，這條回覆算作它們
+各自的首次回覆。可在基準測試中導入，也可單獨運行：
+
+    python benchmarks/fake_telegram.py --port 8082
+
+然後把 TELEGRAM_BASE_URL 設為 http://127.0.0.1:8082/bot，
+TELEGRAM_BASE_FILE_URL 設為 http://127.0.0.1:8082/file/bot。
+"""
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+import zlib
+from collections import deque
+
+from aiohttp import web
+
+BOT_USER = {
+    "id": 100000001,
+    "is_bot": True,
+    "first_name": "RoleChatBot",
+    "username": "role_chat_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+# 視為對用戶的回覆的方法，用於計算首次回覆延遲
+REPLY_METHODS = {"sendMessage", "editMessageText", "sendVoice", "sendPhoto", "sendAudio"}
+# getUpdates 單次長輪詢最多等待的秒數
+MAX_POLL_WAIT = 1.0
+
+
+def make_png(size: int, seed: str) -> bytes:
+    """生成 size×size 的隨機噪點 PNG，不同種子的內容不同，不會命中媒體緩存"""
+    rng = random.Random(seed)
+    row_bytes = size * 3
+    raw = b"".join(b"\x00" + rng.randbytes(row_bytes) for _ in range(size))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+def make_voice(size: int, seed: str) -> bytes:
+    """生成 OGG 頭加隨機內容的語音文件，內容不同，轉寫緩存不會命中"""
+    return b"OggS" + random.Random(seed).randbytes(max(0, size - 4))
+
+
+class FakeTelegram:
+    """模擬 Telegram Bot API 的 aiohttp 服務器
+
+    文件內容由 file_id 決定：以 "photo" 開頭的生成 PNG 圖片，其他生成語音，
+    同一 file_id 每次下載得到相同的內容。
+    """
+
+    def __init__(self, token: str, photo_size: int = 256, voice_bytes: int = 24 * 1024, latency_ms: float = 0):
+        self.token = token
+        self.photo_size = photo_size
+        self.voice_bytes = voice_bytes
+        self.latency_ms = latency_ms
+        self.calls = {}
+        self.uploaded_bytes = 0
+        self.first_reply = {}
+        self._updates = deque()
+        self._new_updates = asyncio.Event()
+        # chat_id -> 等待首次回覆的 (kind, 入隊時間, update_id)
+        self._awaiting = {}
+        # update_id -> 首次回覆延遲的 Future，只為需要等待回覆的更新創建
+        self._replies = {}
+        self._files = {}
+        self._message_id = 0
+        self._update_id = 0
+        self._runner = None
+
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_route("*", "/bot{token}/{method}", self.api_method)
+        self.app.router.add_get("/file/bot{token}/{path:.+}", self.download)
+        self.app.router.add_post("/_control/updates", self.push_updates)
+        self.app.router.add_get("/_control/stats", self.control_stats)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """啟動服務器，返回根地址"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def push(self, update: dict, kind: str = "update", watch: bool = False) -> int:
+        """把更新放入 getUpdates 隊列，按入隊順序分配並返回 update_id"""
+        self._update_id += 1
+        update["update_id"] = self._update_id
+        chat_id = chat_of(update)
+        if chat_id is not None:
+            self._awaiting.setdefault(chat_id, deque()).append((kind, time.perf_counter(), self._update_id))
+            if watch:
+                self._replies[self._update_id] = asyncio.get_running_loop().create_future()
+        self._updates.append(update)
+        self._new_updates.set()
+        return self._update_id
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "uploaded_bytes": self.uploaded_bytes,
+            "pending_updates": len(self._updates),
+            "first_reply": {kind: list(samples) for kind, samples in self.first_reply.items()},
+        }
+
+    def file_content(self, file_id: str) -> bytes:
+        content = self._files.get(file_id)
+        if content is None:
+            if file_id.startswith("photo"):
+                content = make_png(self.photo_size, file_id)
+            else:
+                content = make_voice(self.voice_bytes, file_id)
+            self._files[file_id] = content
+        return content
+
+    def _next_message(self, chat_id, **fields) -> dict:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        message.update(fields)
+        return message
+
+    def _record_reply(self, method: str, chat_id):
+        if method not in REPLY_METHODS or chat_id is None:
+            return
+        # 回覆之前該聊天的所有更新都視為已得到回覆
+        waiting = self._awaiting.pop(chat_id, None)
+        if not waiting:
+            return
+        now = time.perf_counter()
+        for kind, pushed_at, update_id in waiting:
+            latency = now - pushed_at
+            self.first_reply.setdefault(kind, []).append(latency)
+            future = self._replies.get(update_id)
+            if future is not None and not future.done():
+                future.set_result(latency)
+
+    async def wait_reply(self, update_id: int, timeout: float):
+        """等待更新的首次回覆，返回延遲秒數，超時返回 None"""
+        future = self._replies.get(update_id)
+        if future is None:
+            return None
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._replies.pop(update_id, None)
+
+    async def api_method(self, request: web.Request):
+        if request.match_info["token"] != self.token:
+            return web.json_response({"ok": False, "error_code": 401, "description": "Unauthorized"}, status=401)
+        method = request.match_info["method"]
+        params = await read_params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates":
+            return ok(await self.get_updates(params))
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            chat_id = int(chat_id)
+        self._record_reply(method, chat_id)
+
+        if method == "getMe":
+            return ok(BOT_USER)
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            return ok({
+                "file_id": file_id,
+                "file_unique_id": f"u-{file_id}",
+                "file_size": len(self.file_content(file_id)),
+                "file_path": f"files/{file_id}",
+            })
+        if method in ("sendMessage", "editMessageText"):
+            return ok(self._next_message(chat_id, text=params.get("text", "")))
+        if method == "sendVoice":
+            voice = params.get("voice")
+            size = len(voice.file.read()) if isinstance(voice, web.FileField) else 0
+            self.uploaded_bytes += size
+            return ok(self._next_message(chat_id, voice={
+                "file_id": f"sent-voice-{self._message_id}",
+                "file_unique_id": f"sent-{self._message_id}",
+                "duration": 1,
+                "file_size": size,
+            }))
+        return ok(True)
+
+    async def get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        # offset 之前的更新已被確認，從隊列中移除
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(timeout, MAX_POLL_WAIT))
+            except asyncio.TimeoutError:
+                pass
+        return [update for update in list(self._updates)[:limit] if update["update_id"] >= offset]
+
+    async def download(self, request: web.Request):
+        path = request.match_info["path"]
+        file_id = path.rsplit("/", 1)[-1]
+        return web.Response(body=self.file_content(file_id), content_type="application/octet-stream")
+
+    async def push_updates(self, request: web.Request):
+        wait = float(request.query.get("wait") or 0)
+        update_ids = [
+            self.push(item["update"], item.get("kind", "update"), watch=wait > 0) for item in await request.json()
+        ]
+        result = {"ok": True, "update_ids": update_ids}
+        if wait > 0:
+            result["replies"] = await asyncio.gather(*(self.wait_reply(update_id, wait) for update_id in update_ids))
+        return web.json_response(result)
+
+    async def control_stats(self, request: web.Request):
+        return web.json_response(self.stats())
+
+
+def chat_of(update: dict):
+    """更新所屬的聊天 ID"""
+    for key in ("message", "edited_message", "channel_post"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    query = update.get("callback_query")
+    if query is not None:
+        message = query.get("message")
+        return message["chat"]["id"] if message else query["from"]["id"]
+    return None
+
+
+async def read_params(request: web.Request) -> dict:
+    """讀取 Bot API 的參數，支持查詢字符串、JSON、表單和 multipart"""
+    params = dict(request.query)
+    if request.method != "POST" or not request.can_read_body:
+        return params
+    if request.content_type == "application/json":
+        params.update(await request.json())
+    else:
+        params.update(await request.post())
+    return params
+
+
+def ok(result) -> web.Response:
+    return web.json_response({"ok": True, "result": result})
+
+
+async def main(args):
+    server = FakeTelegram(args.token, latency_ms=args.latency_ms)
+    root = await server.start(args.host, args.port)
+    print(f"模擬 Telegram 服務已啟動: {root}/bot（文件 {root}/file/bot）")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps({"calls": server.calls}, ensure_ascii=False))
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--token', default='123456:TEST')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,652 @@
+"""端到端負載測試：在本地模擬的 Telegram 和 OpenAI 服務上運行 RoleChatBot
+
+模擬服務器（benchmarks/fake_telegram.py 和 benchmarks/fake_openai.py）在子進程中運行，
+機器人以輪詢模式在本進程中運行，使用項目的配置文件（config/config.py，不存在時用
+config.example.py），只把 API 地址、令牌和存儲位置指向本地。
+
+每個模擬用戶先選擇角色，再逐條發送消息：發出一條後等機器人處理完才發下一條，
+同時在處理的更新數不超過 --concurrency。消息可以是按 --mix 比例隨機生成的文字、
+語音和圖片，也可以來自 --traffic 指定的 JSONL 文件：帶 update_id 的行按錄製的
+Telegram 更新回放（同一聊天保持順序），其他行取 text、body 或 title 字段作為文字消息。
+--burst N 時連續的文字消息每 N 條一起發出，模擬用戶連發幾條短消息，用於觀察
+消息合併（COALESCE_WINDOW）的效果。
+
+報告吞吐量、各處理器從更新入隊到處理完成（回覆排入發送隊列）的 p50/p95/p99、
+用戶看到首次回覆的延遲，以及機器人進程的峰值 RSS；--output 把結果寫成 JSON，
+便於與基線比較。
+
+--workers N 時改為以子進程運行 src/main.py（WORKERS=N），用於比較分片模式隨
+工作進程數的擴展情況。此時無法觀察處理器何時結束，以用戶收到首次回覆作為完成，
+峰值 RSS 為單個進程的最大值。開啟消息合併時文字消息在後台回覆，處理器返回不代表
+處理完成，同樣以首次回覆作為完成。
+
+用法：
+    python benchmarks/load_test.py --users 50 --messages 10 --mix message=0.7,voice=0.2,photo=0.1
+    python benchmarks/load_test.py --traffic updates.jsonl --concurrency 20 --output baseline.json
+    python benchmarks/load_test.py --users 400 --workers 4 --latency-ms 50 --endpoint-latency ''
+    python benchmarks/load_test.py --mix message=1 --burst 3 --coalesce-window 0
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import sys
+import tempfile
+import time
+from itertools import count
+
+import aiohttp
+from aiohttp import web
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'src'))
+
+from fake_openai import FakeOpenAI, parse_latencies  # noqa: E402
+from fake_telegram import FakeTelegram, chat_of  # noqa: E402
+
+TOKEN = "123456:LOADTEST"
+ROLE_ID = "butler"
+FIRST_CHAT_ID = 1_000_000
+TEXTS = [
+    "今天的行程幫我安排一下",
+    "晚餐有什麼推薦嗎？",
+    "幫我想一個週末的活動",
+    "最近工作壓力有點大，怎麼放鬆比較好？",
+    "明天早上提醒我帶雨傘",
+    "你覺得這本書值得讀嗎？",
+]
+# 生成的配置：先執行項目配置，再按比例放大限流額度
+CONFIG_TEMPLATE = '''# 負載測試生成的配置
+with open({base!r}, encoding="utf-8") as _f:
+    exec(_f.read())
+for _limits in RATE_LIMITS.values():
+    for _key in ("rpm", "tpm"):
+        if _limits.get(_key):
+            _limits[_key] *= {scale!r}
+'''
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def summarize(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 1),
+        "p95_ms": round(percentile(samples, 95) * 1000, 1),
+        "p99_ms": round(percentile(samples, 99) * 1000, 1),
+        "max_ms": round(max(samples) * 1000, 1),
+    }
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    # Linux 上 ru_maxrss 的單位是 KB，macOS 上是字節
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# ---------- 模擬服務器子進程 ----------
+
+def serve_fakes(conn, options: dict):
+    asyncio.run(_serve_fakes(conn, options))
+
+
+async def _serve_fakes(conn, options: dict):
+    openai = FakeOpenAI(
+        latency_ms=options["latency_ms"],
+        endpoint_latency_ms=options["endpoint_latency_ms"],
+        tail_rate=options["tail_rate"],
+        tail_ms=options["tail_ms"],
+        error_rate=options["error_rate"],
+        rate_limit_rate=options["rate_limit_rate"],
+        seed=options["seed"],
+    )
+    telegram = FakeTelegram(
+        TOKEN,
+        photo_size=options["photo_size"],
+        voice_bytes=options["voice_bytes"],
+        latency_ms=options["telegram_latency_ms"],
+    )
+
+    async def openai_stats(request):
+        return web.json_response(openai.stats())
+
+    telegram.app.router.add_get("/_control/openai", openai_stats)
+    openai_url = await openai.start()
+    telegram_url = await telegram.start()
+
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    conn.send((openai_url, telegram_url))
+    try:
+        await stop.wait()
+    finally:
+        await telegram.stop()
+        await openai.stop()
+
+
+# ---------- 流量 ----------
+
+def user_of(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "language_code": "zh-hant"}
+
+
+class ChatScript:
+    """一個模擬用戶依次發送的更新"""
+
+    def __init__(self, chat_id: int, user_id: int = None):
+        self.chat_id = chat_id
+        self.user = user_of(user_id or chat_id)
+        self.updates = []
+        self._message_ids = count(1)
+
+    def _message(self, **fields) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.chat_id, "type": "private"},
+            "from": self.user,
+        }
+        message.update(fields)
+        return message
+
+    def add(self, kind: str, update: dict):
+        self.updates.append((kind, update))
+
+    def batches(self, burst: int = 1):
+        """按發送批次分組，連續的文字消息每 burst 條一組，其他更新單獨一組"""
+        batch = []
+        for kind, update in self.updates:
+            if batch and (kind != "message" or batch[0][0] != "message" or len(batch) >= burst):
+                yield batch
+                batch = []
+            batch.append((kind, update))
+        if batch:
+            yield batch
+
+    def select_role(self, role_id: str):
+        self.add("role_selection", {"callback_query": {
+            "id": f"cb-{self.chat_id}-{len(self.updates)}",
+            "from": self.user,
+            "chat_instance": str(self.chat_id),
+            "data": f"select_role_{role_id}",
+            "message": self._message(text="請選擇角色"),
+        }})
+
+    def text(self, text: str):
+        self.add("message", {"message": self._message(text=text)})
+
+    def voice(self, file_id: str, size: int):
+        self.add("voice", {"message": self._message(voice={
+            "file_id": file_id,
+            "file_unique_id": f"u-{file_id}",
+            "duration": 3,
+            "mime_type": "audio/ogg",
+            "file_size": size,
+        })})
+
+    def photo(self, file_id: str, dimension: int):
+        self.add("photo", {"message": self._message(photo=[{
+            "file_id": file_id,
+            "file_unique_id": f"u-{file_id}",
+            "width": dimension,
+            "height": dimension,
+            "file_size": dimension * dimension * 3,
+        }])})
+
+
+def classify(update: dict) -> str:
+    """錄製的更新對應的處理器"""
+    if "callback_query" in update:
+        return "role_selection"
+    message = update.get("message") or {}
+    if "voice" in message:
+        return "voice"
+    if "photo" in message:
+        return "photo"
+    if (message.get("text") or "").startswith("/"):
+        return "command"
+    return "message"
+
+
+def load_traffic(path: str) -> tuple:
+    """讀取 JSONL，返回 (錄製的更新, 文字消息)"""
+    updates, texts = [], []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            update = record.get("update", record)
+            if "update_id" in update:
+                updates.append(update)
+                continue
+            for field in ("text", "body", "title"):
+                if isinstance(record.get(field), str) and record[field]:
+                    texts.append(record[field])
+                    break
+    return updates, texts
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        kind, _, weight = item.partition("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {"message", "voice", "photo"}
+    if unknown:
+        raise SystemExit(f"--mix 不支持的消息類型: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def synthetic_scripts(args, texts: list) -> list:
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    scripts = []
+    for index in range(args.users):
+        script = ChatScript(FIRST_CHAT_ID + index)
+        script.select_role(ROLE_ID)
+        for n in range(args.messages):
+            kind = rng.choices(kinds, weights)[0]
+            if kind == "voice":
+                script.voice(f"voice-{script.chat_id}-{n}", args.voice_kb * 1024)
+            elif kind == "photo":
+                script.photo(f"photo-{script.chat_id}-{n}", args.photo_size)
+            else:
+                script.text(rng.choice(texts))
+        scripts.append(script)
+    return scripts
+
+
+def recorded_scripts(args, updates: list) -> list:
+    """按聊天分組錄製的更新；語音和圖片換成模擬服務器可下載的文件"""
+    scripts = {}
+    for index, update in enumerate(updates):
+        update = dict(update)
+        update.pop("update_id", None)
+        chat_id = chat_of(update)
+        if chat_id is None:
+            continue
+        script = scripts.get(chat_id)
+        if script is None:
+            sender = (update.get("message") or update.get("callback_query") or {}).get("from") or {}
+            script = scripts[chat_id] = ChatScript(chat_id, sender.get("id"))
+            if "callback_query" not in update:
+                script.select_role(ROLE_ID)
+        message = update.get("message")
+        if message and "voice" in message:
+            file_id = f"voice-rec-{index}"
+            message["voice"] = dict(message["voice"], file_id=file_id, file_unique_id=f"u-{file_id}",
+                                    file_size=args.voice_kb * 1024)
+        elif message and "photo" in message:
+            file_id = f"photo-rec-{index}"
+            message["photo"] = [dict(size, file_id=f"{file_id}-{n}", file_unique_id=f"u-{file_id}-{n}")
+                                for n, size in enumerate(message["photo"])]
+        script.add(classify(update), update)
+    return list(scripts.values())
+
+
+# ---------- 驅動 ----------
+
+class UpdateTracker:
+    """記錄每條更新處理完成的時間"""
+
+    def __init__(self):
+        self._done = {}
+        self._waiters = {}
+
+    def complete(self, update_id):
+        self._done[update_id] = time.perf_counter()
+        waiter = self._waiters.get(update_id)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def wait(self, update_id: int, timeout: float):
+        """等待更新處理完成，返回完成時間，超時返回 None"""
+        if update_id not in self._done:
+            waiter = self._waiters[update_id] = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self._waiters.pop(update_id, None)
+        return self._done.pop(update_id)
+
+
+class TrafficDriver:
+    """模擬用戶逐條發送更新；沒有 tracker 時以首次回覆作為處理完成"""
+
+    def __init__(self, session: aiohttp.ClientSession, telegram_url: str, tracker: UpdateTracker,
+                 concurrency: int, timeout: float, think_ms: float, seed: int, burst: int = 1):
+        self.session = session
+        self.push_url = f"{telegram_url}/_control/updates"
+        self.tracker = tracker
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.think_ms = think_ms
+        self.random = random.Random(seed)
+        self.burst = burst
+        self.latencies = {}
+        self.timeouts = {}
+
+    async def send(self, batch: list) -> list:
+        """一次發送一組更新並等待全部處理完成，返回各自的耗時秒數，超時為 None"""
+        items = [{"update": update, "kind": kind} for kind, update in batch]
+        if self.tracker is None:
+            async with self.session.post(self.push_url, params={"wait": str(self.timeout)}, json=items) as response:
+                return (await response.json())["replies"]
+
+        sent_at = time.perf_counter()
+        async with self.session.post(self.push_url, json=items) as response:
+            update_ids = (await response.json())["update_ids"]
+        done = await asyncio.gather(*(self.tracker.wait(update_id, self.timeout) for update_id in update_ids))
+        return [None if done_at is None else done_at - sent_at for done_at in done]
+
+    async def run_chat(self, script: ChatScript):
+        for batch in script.batches(self.burst):
+            async with self.semaphore:
+                latencies = await self.send(batch)
+            for (kind, _), latency in zip(batch, latencies):
+                if latency is None:
+                    self.timeouts[kind] = self.timeouts.get(kind, 0) + 1
+                else:
+                    self.latencies.setdefault(kind, []).append(latency)
+            if self.think_ms:
+                await asyncio.sleep(self.random.expovariate(1000 / self.think_ms))
+
+    async def run(self, scripts: list) -> float:
+        """運行全部用戶，返回耗時秒數"""
+        started = time.perf_counter()
+        await asyncio.gather(*(self.run_chat(script) for script in scripts))
+        return time.perf_counter() - started
+
+
+async def fetch_fake_stats(session: aiohttp.ClientSession, telegram_url: str) -> tuple:
+    async with session.get(f"{telegram_url}/_control/stats") as response:
+        telegram_stats = await response.json()
+    async with session.get(f"{telegram_url}/_control/openai") as response:
+        openai_stats = await response.json()
+    return telegram_stats, openai_stats
+
+
+def build_results(args, scripts: list, driver: TrafficDriver, elapsed: float,
+                  telegram_stats: dict, openai_stats: dict) -> dict:
+    completed = sum(len(samples) for samples in driver.latencies.values())
+    return {
+        "mode": f"{args.workers}_workers" if args.workers else "in_process",
+        "users": len(scripts),
+        "concurrency": args.concurrency,
+        "updates": completed + sum(driver.timeouts.values()),
+        "completed": completed,
+        "timeouts": driver.timeouts,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(completed / elapsed, 2) if elapsed else 0.0,
+        "handlers": {kind: summarize(samples) for kind, samples in sorted(driver.latencies.items())},
+        "first_reply": {
+            kind: summarize(samples) for kind, samples in sorted(telegram_stats["first_reply"].items())
+        },
+        "telegram_calls": telegram_stats["calls"],
+        "openai_calls": openai_stats["calls"],
+        "openai_errors": {"errors": openai_stats["errors"], "rate_limited": openai_stats["rate_limited"]},
+    }
+
+
+def prepare_environment(args, workdir: str, openai_url: str, telegram_url: str):
+    """在臨時目錄中生成配置，並通過環境變量把機器人指向模擬服務器"""
+    base = os.path.join(REPO_DIR, 'config', 'config.py')
+    if not os.path.exists(base):
+        base = os.path.join(REPO_DIR, 'config', 'config.example.py')
+    # 機器人通過 BOT_CONFIG_FILE 讀取生成的配置
+    config_file = os.path.join(workdir, 'config.py')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(base=base, scale=args.rate_limit_scale))
+
+    os.makedirs(os.path.join(workdir, 'logs'))
+    os.chdir(workdir)
+    os.environ.update({
+        "BOT_CONFIG_FILE": config_file,
+        "BOT_TOKEN": TOKEN,
+        "OPENAI_API_KEY": "sk-load-test",
+        "OPENAI_BASE_URL": openai_url,
+        "OPENAI_HTTP2": "false",
+        "TELEGRAM_BASE_URL": f"{telegram_url}/bot",
+        "TELEGRAM_BASE_FILE_URL": f"{telegram_url}/file/bot",
+        "UPDATE_MODE": "polling",
+        "METRICS_PORT": "0",
+        "STORAGE_BACKEND": args.storage,
+        "STORAGE_PATH": os.path.join(workdir, 'sessions.db'),
+        "TTS_CACHE_DIR": os.path.join(workdir, 'tts_cache'),
+    })
+    if args.max_concurrent_updates:
+        os.environ["MAX_CONCURRENT_UPDATES"] = str(args.max_concurrent_updates)
+    if args.coalesce_window is not None:
+        os.environ["COALESCE_WINDOW"] = str(args.coalesce_window)
+
+
+async def run(args, scripts: list, telegram_url: str) -> dict:
+    baseline_rss = peak_rss_mb()
+    # 導入時讀取配置，必須在設置好環境變量之後
+    from bot import role_chat_bot
+    from bot.update_processor import ChatOrderedUpdateProcessor
+    role_chat_bot.configure_logging()
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    # 開啟消息合併時處理器只是把消息交給後台任務，改以首次回覆作為完成
+    tracker = None if role_chat_bot.COALESCE_WINDOW > 0 else UpdateTracker()
+
+    class TimedUpdateProcessor(ChatOrderedUpdateProcessor):
+        async def process_update(self, update, coroutine):
+            try:
+                await super().process_update(update, coroutine)
+            finally:
+                if tracker is not None:
+                    tracker.complete(getattr(update, "update_id", None))
+
+    bot = role_chat_bot.RoleChatBot()
+    application = bot.build_application(TimedUpdateProcessor(role_chat_bot.MAX_CONCURRENT_UPDATES))
+    await application.initialize()
+    await bot.post_init(application)
+    await application.updater.start_polling(poll_interval=0, timeout=10, drop_pending_updates=False)
+    await application.start()
+    ready_rss = peak_rss_mb()
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            driver = TrafficDriver(session, telegram_url, tracker, args.concurrency,
+                                   args.timeout, args.think_ms, args.seed, args.burst)
+            elapsed = await driver.run(scripts)
+            telegram_stats, openai_stats = await fetch_fake_stats(session, telegram_url)
+        bot_stats = {
+            "openai_caller": bot.api.stats(),
+            "coalescer": bot.coalescer.stats(),
+            "send_queue": bot.outbox.stats(),
+            "rate_limiter": bot.rate_limits.stats(),
+            "http_pools": bot.pool_stats(),
+        }
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await bot.post_stop(application)
+        await bot.post_shutdown(application)
+        await application.shutdown()
+
+    results = build_results(args, scripts, driver, elapsed, telegram_stats, openai_stats)
+    results.update({
+        "baseline_rss_mb": baseline_rss,
+        "ready_rss_mb": ready_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "bot": bot_stats,
+    })
+    return results
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, telegram_url: str, process, timeout: float = 60):
+    """等機器人開始輪詢且各進程的初始化和連接預熱結束（getMe 調用數不再增加）"""
+    deadline = time.monotonic() + timeout
+    last_get_me = -1
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise SystemExit(f"機器人進程已退出，退出碼 {process.returncode}")
+        async with session.get(f"{telegram_url}/_control/stats") as response:
+            calls = (await response.json())["calls"]
+        get_me = calls.get("getMe", 0)
+        if calls.get("getUpdates") and get_me == last_get_me:
+            return
+        last_get_me = get_me
+        await asyncio.sleep(1)
+    raise SystemExit("等待機器人啟動超時")
+
+
+async def run_processes(args, scripts: list, telegram_url: str) -> dict:
+    """以子進程運行 src/main.py，以首次回覆作為處理完成"""
+    env = dict(os.environ)
+    env["WORKERS"] = str(args.workers)
+    env["PYTHONPATH"] = os.path.join(REPO_DIR, 'src')
+    # 機器人的日誌寫在工作目錄的 logs/bot.log 和各工作進程的 logs/bot.worker<N>.log 中
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(REPO_DIR, 'src', 'main.py'), env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_until_ready(session, telegram_url, process)
+            driver = TrafficDriver(session, telegram_url, None, args.concurrency,
+                                   args.timeout, args.think_ms, args.seed, args.burst)
+            elapsed = await driver.run(scripts)
+            telegram_stats, openai_stats = await fetch_fake_stats(session, telegram_url)
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(process.wait(), 60)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+    results = build_results(args, scripts, driver, elapsed, telegram_stats, openai_stats)
+    # 已回收的子進程（機器人主進程及其工作進程）中最大的峰值 RSS
+    results["peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return results
+
+
+def report(results: dict):
+    print(f"模式 {results['mode']}，用戶 {results['users']}，並發 {results['concurrency']}，更新 {results['updates']}，"
+          f"完成 {results['completed']}，超時 {sum(results['timeouts'].values())}")
+    print(f"耗時 {results['elapsed_seconds']:.1f} s，吞吐 {results['throughput_per_second']:.1f} 更新/秒")
+    print(f"{'處理器':<16}{'次數':>8}{'p50':>10}{'p95':>10}{'p99':>10}   首次回覆 p50/p95/p99 (ms)")
+    for kind, stats in results["handlers"].items():
+        reply = results["first_reply"].get(kind, {"count": 0})
+        reply_text = (f"{reply['p50_ms']:.0f}/{reply['p95_ms']:.0f}/{reply['p99_ms']:.0f}"
+                      if reply["count"] else "-")
+        print(f"{kind:<16}{stats['count']:>8}{stats['p50_ms']:>10.0f}{stats['p95_ms']:>10.0f}"
+              f"{stats['p99_ms']:>10.0f}   {reply_text}")
+    if results["mode"] == "in_process":
+        print(f"峰值 RSS {results['peak_rss_mb']:.1f} MB（導入前 {results['baseline_rss_mb']:.1f} MB，"
+              f"啟動後 {results['ready_rss_mb']:.1f} MB）")
+    else:
+        print(f"以首次回覆作為處理完成；單進程峰值 RSS {results['peak_rss_mb']:.1f} MB")
+    print(f"Telegram 調用: {results['telegram_calls']}")
+    print(f"OpenAI 調用: {results['openai_calls']}，注入錯誤: {results['openai_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=10, help='每個用戶發送的消息數')
+    parser.add_argument('--concurrency', type=int, default=0, help='同時處理的更新數上限，默認等於用戶數')
+    parser.add_argument('--mix', default='message=0.7,voice=0.2,photo=0.1')
+    parser.add_argument('--traffic', help='回放的 JSONL 文件')
+    parser.add_argument('--think-ms', type=float, default=0, help='用戶兩條消息之間的平均間隔')
+    parser.add_argument('--burst', type=int, default=1, help='連續的文字消息每這麼多條一起發送')
+    parser.add_argument('--coalesce-window', type=float, help='覆蓋配置中的 COALESCE_WINDOW，0 表示不合併')
+    parser.add_argument('--timeout', type=float, default=120, help='單條更新最長等待秒數')
+    parser.add_argument('--latency-ms', type=float, default=300, help='OpenAI 默認延遲中位數')
+    parser.add_argument('--endpoint-latency', default='chat=400,vision=1200,whisper=600,tts=500')
+    parser.add_argument('--tail-rate', type=float, default=0.01)
+    parser.add_argument('--tail-ms', type=float, default=3000)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency-ms', type=float, default=20)
+    parser.add_argument('--voice-kb', type=int, default=24)
+    parser.add_argument('--photo-size', type=int, default=256)
+    parser.add_argument('--rate-limit-scale', type=float, default=1.0, help='按比例放大配置中的限流額度')
+    parser.add_argument('--max-concurrent-updates', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=0, help='大於 0 時以子進程運行機器人（WORKERS=N）')
+    parser.add_argument('--storage', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='warning')
+    parser.add_argument('--output', help='把結果寫入 JSON 文件')
+    args = parser.parse_args()
+    args.concurrency = args.concurrency or args.users
+    # 運行時會切換到臨時目錄
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    texts = TEXTS
+    scripts = None
+    if args.traffic:
+        updates, loaded_texts = load_traffic(args.traffic)
+        if updates:
+            scripts = recorded_scripts(args, updates)
+        elif loaded_texts:
+            texts = loaded_texts
+        else:
+            raise SystemExit(f"{args.traffic} 中沒有可回放的更新或文字")
+    if scripts is None:
+        scripts = synthetic_scripts(args, texts)
+
+    options = {
+        "latency_ms": args.latency_ms,
+        "endpoint_latency_ms": parse_latencies(args.endpoint_latency),
+        "tail_rate": args.tail_rate,
+        "tail_ms": args.tail_ms,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "telegram_latency_ms": args.telegram_latency_ms,
+        "voice_bytes": args.voice_kb * 1024,
+        "photo_size": args.photo_size,
+        "seed": args.seed,
+    }
+    # 模擬服務器放在子進程中，不佔用機器人的事件循環，也不計入機器人的 RSS
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=serve_fakes, args=(child_conn, options), daemon=True)
+    process.start()
+    try:
+        if not parent_conn.poll(30):
+            raise SystemExit("模擬服務器啟動超時")
+        openai_url, telegram_url = parent_conn.recv()
+        workdir = tempfile.mkdtemp(prefix="rolechatbot-load-")
+        prepare_environment(args, workdir, openai_url, telegram_url)
+        print(f"工作目錄 {workdir}")
+        if args.workers:
+            results = asyncio.run(run_processes(args, scripts, telegram_url))
+        else:
+            results = asyncio.run(run(args, scripts, telegram_url))
+    finally:
+        process.terminate()
+        process.join(5)
+
+    report(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,177 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', 'your_openai_api_key_here')
 # 聊天歷史設置
 HISTORY_EXPIRY_HOURS = int(os.getenv('HISTORY_EXPIRY_HOURS', 24))
 MAX_HISTORY_LENGTH = int(os.getenv('MAX_HISTORY_LENGTH', 50))
+# 聊天記錄的全局內存預算（MB），超出時按最久未使用淘汰整段對話，0 表示不限制
+HISTORY_MAX_MB = int(os.getenv('HISTORY_MAX_MB', 256))
+# 後台清理過期對話的間隔（秒）
+HISTORY_SWEEP_INTERVAL = int(os.getenv('HISTORY_SWEEP_INTERVAL', 60))
+
+# 會話存儲設置：memory（不持久化）或 sqlite
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+STORAGE_PATH = os.getenv('STORAGE_PATH', 'data/sessions.db')
+# 批量寫入的攢批窗口（秒）
+STORAGE_FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', 0.05))
+
+# OpenAI 速率限制（每分鐘請求數 rpm / token 數 tpm，TTS 的 tpm 按字符計）
+RATE_LIMITS = {
+    "chat": {"rpm": 3500, "tpm": 90000},
+    "vision": {"rpm": 50, "tpm": 30000},
+    "whisper": {"rpm": 50, "tpm": None},
+    "tts": {"rpm": 50, "tpm": None},
+    "summary": {"rpm": 500, "tpm": 30000},
+}
+# 額度不足時最多排隊等待的秒數
+RATE_LIMIT_WAIT = float(os.getenv('RATE_LIMIT_WAIT', 10))
+
+# 同時處理的更新數上限（不同聊天並行，同一聊天按順序處理）
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 64))
+
+# 接收更新的方式：polling 或 webhook
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+# Webhook 的公開地址（不含路徑），例如 https://bot.example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Telegram 在每個請求的 X-Telegram-Bot-Api-Secret-Token 頭中帶上此密鑰（只能包含 A-Z、a-z、0-9、_ 和 -）；
+# Webhook 模式下必須設置，可用 python -c "import secrets; print(secrets.token_urlsafe(32))" 生成
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# 工作進程數：大於 1 時主進程只接收更新，按用戶 ID 分派給多個工作進程，
+# MAX_CONCURRENT_UPDATES 按每個工作進程計算；需要持久化時請使用 sqlite 存儲
+WORKERS = int(os.getenv('WORKERS', 1))
+# 工作進程意外退出後的重啟等待秒數，連續崩潰時按指數退避
+WORKER_RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', 1))
+
+# 串流回覆設置
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
+# 兩次編輯訊息的最短間隔（秒），Telegram 對同一聊天的編輯頻率約為每秒一次
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+
+# 消息合併：用戶連續發送的文字和語音消息在這段時間（秒）內沒有新消息時才合併回覆，0 表示逐條回覆
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', 0.8))
+# 從第一條消息起最多等待的秒數，用戶持續發送時也不會無限推遲回覆
+COALESCE_MAX_WAIT = float(os.getenv('COALESCE_MAX_WAIT', 3.0))
+
+# 上下文 token 預算（按模型），角色可用 "context_tokens" 單獨覆蓋
+CONTEXT_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": int(os.getenv('CONTEXT_TOKENS', 3000)),
+}
+
+# 語音合成緩存：內存層和磁盤層的容量上限（MB）
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', 'temp/tts_cache')
+TTS_CACHE_MEMORY_MB = int(os.getenv('TTS_CACHE_MEMORY_MB', 32))
+TTS_CACHE_DISK_MB = int(os.getenv('TTS_CACHE_DISK_MB', 512))
+
+# 超過此字數的語音回覆按句子分段並行合成，先合成好的第一段先發送
+TTS_PIPELINE_THRESHOLD = int(os.getenv('TTS_PIPELINE_THRESHOLD', 200))
+# 分段合成的最大並行數
+TTS_PIPELINE_CONCURRENCY = int(os.getenv('TTS_PIPELINE_CONCURRENCY', 3))
+
+# 圖片分析：優先下載長邊不小於此尺寸的最小版本
+VISION_TARGET_DIMENSION = int(os.getenv('VISION_TARGET_DIMENSION', 1024))
+# 圖片縮放和編碼的線程數
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+
+# 語音轉寫和圖片分析結果緩存的條目上限和有效期
+MEDIA_CACHE_SIZE = int(os.getenv('MEDIA_CACHE_SIZE', 5000))
+MEDIA_CACHE_TTL_HOURS = int(os.getenv('MEDIA_CACHE_TTL_HOURS', 24))
+
+# 同時處理中的語音和圖片可佔用的內存上限（MB），超出時新請求排隊等待
+MEDIA_MEMORY_BUDGET_MB = int(os.getenv('MEDIA_MEMORY_BUDGET_MB', 128))
+# 下載緩衝區池保留的空閒內存上限（MB）
+MEDIA_POOL_MB = int(os.getenv('MEDIA_POOL_MB', 32))
+
+# 對話歷史超過此 token 數時，在後台把較早的消息壓縮成摘要，0 表示不壓縮
+SUMMARY_THRESHOLD_TOKENS = int(os.getenv('SUMMARY_THRESHOLD_TOKENS', 1500))
+# 壓縮時保留原文的最近消息條數
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', 6))
+# 摘要的最大 token 數
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', 400))
+
+# OpenAI 各端點的請求超時（秒）和是否對沖（超過近期 p95 延遲時再發一個相同請求）；
+# chat_stream 為串流回覆，其延遲按收到響應頭計算，與完整生成的 chat 分開統計
+OPENAI_ENDPOINTS = {
+    "chat": {"timeout": 30.0, "hedge": True},
+    "chat_stream": {"timeout": 30.0, "hedge": True},
+    "vision": {"timeout": 60.0, "hedge": False},
+    "whisper": {"timeout": 60.0, "hedge": False},
+    "tts": {"timeout": 30.0, "hedge": False},
+    "summary": {"timeout": 60.0, "hedge": False},
+}
+# 限流、超時和服務端錯誤的最多重試次數
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 3))
+# 連續失敗多少次後熔斷，以及熔斷持續的秒數
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', 30))
+
+# OpenAI 連接池：最大連接數、保持的空閒連接數和空閒超時（秒）；http2 需要安裝 h2；
+# proxy 留空時使用環境變量 HTTPS_PROXY、ALL_PROXY 和 NO_PROXY
+OPENAI_POOL = {
+    "max_connections": int(os.getenv('OPENAI_MAX_CONNECTIONS', 100)),
+    "max_keepalive": int(os.getenv('OPENAI_MAX_KEEPALIVE', 50)),
+    "keepalive_expiry": 60.0,
+    "http2": os.getenv('OPENAI_HTTP2', 'true').lower() == 'true',
+    "proxy": os.getenv('OPENAI_PROXY') or None,
+}
+# Telegram Bot API 連接池，連接數應不小於 MAX_CONCURRENT_UPDATES；http_version 可為 "1.1"、"2" 或 "2.0"；
+# proxy 的規則同上
+TELEGRAM_POOL = {
+    "max_connections": int(os.getenv('TELEGRAM_MAX_CONNECTIONS', 64)),
+    "keepalive_expiry": 60.0,
+    "http_version": os.getenv('TELEGRAM_HTTP_VERSION', '1.1'),
+    "proxy": os.getenv('TELEGRAM_PROXY') or None,
+    "pool_timeout": 5.0,
+    "connect_timeout": 5.0,
+    "read_timeout": 10.0,
+    "write_timeout": 20.0,
+}
+# 回覆發送隊列：全局每秒和單個聊天每分鐘的發送上限（Telegram 約為 30 條/秒、每個聊天 1 條/秒），
+# 同時進行的發送和語音上傳數，以及收到 RetryAfter 後的重試次數和可接受的最長等待秒數
+TELEGRAM_SEND = {
+    "global_per_second": float(os.getenv('TELEGRAM_SEND_PER_SECOND', 30)),
+    "chat_per_minute": float(os.getenv('TELEGRAM_CHAT_PER_MINUTE', 60)),
+    "chat_burst": 3,
+    "max_in_flight": 32,
+    "max_uploads": 4,
+    "max_retries": 5,
+    "max_retry_after": 60.0,
+}
+# 啟動時預先建立的連接數（0 表示不預熱），以及預熱的最長等待秒數
+WARMUP_CONNECTIONS = int(os.getenv('WARMUP_CONNECTIONS', 4))
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 5))
+
+# Prometheus 指標：所有模式下都只在 METRICS_LISTEN:METRICS_PORT 提供 /metrics，
+# 不掛在公網的 Webhook 端口上；METRICS_PORT 為 0 時不導出
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9090))
+
+# 事件循環阻塞超過此秒數時在日誌中記錄阻塞時的調用棧，0 表示不監控
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.25))
+# 可以使用 /profile 命令的 Telegram 用戶 ID，以逗號分隔，留空則不註冊該命令
+ADMIN_USER_IDS = [int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()]
+# 採樣分析：默認和最長採樣秒數、每秒採樣次數，結果以 collapsed 格式寫入 PROFILE_DIR；
+# PROFILE_ENDPOINT 為 true 時指標服務另提供 /debug/profile?seconds=N
+PROFILE_SECONDS = float(os.getenv('PROFILE_SECONDS', 10))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 60))
+PROFILE_HZ = float(os.getenv('PROFILE_HZ', 100))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'logs/profiles')
+PROFILE_ENDPOINT = os.getenv('PROFILE_ENDPOINT', 'true').lower() == 'true'
+
+# 日誌設置：文件按 LOG_MAX_MB 輪轉並保留 LOG_BACKUPS 個舊文件，LOG_FORMAT 為 json 或 text；
+# 同一條日誌模板每 LOG_RATE_INTERVAL 秒最多輸出 LOG_RATE_LIMIT 條（ERROR 除外），0 表示不限流
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FILE = os.getenv('LOG_FILE', 'logs/bot.log')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_MAX_MB = int(os.getenv('LOG_MAX_MB', 50))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', 5))
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', 20))
+LOG_RATE_INTERVAL = float(os.getenv('LOG_RATE_INTERVAL', 60))
+
+# API 地址，留空使用官方服務；基準測試時指向本地的模擬服務器
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', '')
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot')
+TELEGRAM_BASE_FILE_URL = os.getenv('TELEGRAM_BASE_FILE_URL', 'https://api.telegram.org/file/bot')
 
 # 角色配置
 ROLES = {
@@ -55,6 +226,3 @@ ROLES = {
 
 # 設置默認角色
 DEFAULT_ROLE = ROLES["butler"]
-
-# 日誌設置
-LOG_FILE = "logs/bot.log"
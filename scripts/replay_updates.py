@@ -0,0 +1,65 @@
+"""把錄製的 Telegram 更新逐條 POST 到本地 Webhook 端點
+
+文件為 JSONL，每行是一個 Update 對象，或帶有 "update" 字段的對象。
+
+用法：
+    python scripts/replay_updates.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret xxx
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def load_updates(path: str) -> list:
+    updates = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            update = record.get("update", record)
+            if "update_id" not in update:
+                print(f"跳過不是 Telegram 更新的記錄: {line[:60]}")
+                continue
+            updates.append(update)
+    return updates
+
+
+async def replay(updates: list, url: str, secret: str, concurrency: int):
+    headers = {SECRET_HEADER: secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(update):
+            async with semaphore:
+                async with session.post(url, json=update) as response:
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        elapsed = time.perf_counter() - start
+
+    print(f"已發送 {len(updates)} 條更新，耗時 {elapsed:.2f}s，狀態碼: {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="默認逐條發送，保持同一聊天內的順序")
+    args = parser.parse_args()
+
+    asyncio.run(replay(load_updates(args.file), args.url, args.secret, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import logging
+from collections.abc import Mapping
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT_TOKENS = 3000
+
+# 未安裝 tiktoken 時估算 token 數，緩存鍵中以此代替分詞器名稱
+ESTIMATE_ENCODING = "estimate"
+
+# 對話摘要作為第二條系統消息發送時的前綴
+SUMMARY_PREFIX = "以下是你們之前對話的摘要：\n"
+
+
+class ContextBuilder:
+    """按 token 預算組裝發送給模型的上下文"""
+
+    # 每條消息的格式開銷（role、分隔符等），參考 OpenAI 的計算方式
+    MESSAGE_OVERHEAD = 4
+    # 模型回覆的起始標記
+    REPLY_PRIMING = 3
+    # 超出預算時一次裁剪到預算的這個比例，之後幾輪的歷史起點保持不變
+    PACK_RATIO = 0.75
+    # 提示詞 token 數緩存的條目上限
+    MAX_CACHED_PROMPTS = 10000
+
+    def __init__(self, budgets: dict = None, default_budget: int = DEFAULT_CONTEXT_TOKENS):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self._encodings = {}
+        self._prompt_tokens = {}
+
+    def budget_for(self, role: dict, model: str) -> int:
+        """獲取角色在指定模型下的上下文 token 預算"""
+        role_budget = role.get('context_tokens')
+        if isinstance(role_budget, Mapping):
+            role_budget = role_budget.get(model)
+        if role_budget:
+            return int(role_budget)
+        return int(self.budgets.get(model, self.default_budget))
+
+    def _get_encoding(self, model: str):
+        """獲取並緩存模型對應的分詞器"""
+        if model in self._encodings:
+            return self._encodings[model]
+
+        encoding = None
+        # 導入 tiktoken 和加載詞表較慢，第一次計算 token 數時才進行
+        try:
+            import tiktoken
+        except ImportError:  # 未安裝 tiktoken 時退回估算
+            tiktoken = None
+        if tiktoken is not None:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # 詞表需要下載，離線或無法訪問外網時同樣退回估算，結果緩存後不再重試
+                logger.warning("加載 %s 的分詞器失敗，將使用估算的 token 數: %s", model, e)
+        else:
+            logger.warning("未安裝 tiktoken，將使用估算的 token 數")
+        self._encodings[model] = encoding
+        return encoding
+
+    def preload(self, model: str):
+        """提前加載模型的分詞器，可在線程池中調用，避免第一條消息承擔加載時間"""
+        self._get_encoding(model)
+
+    def encoding_name(self, model: str) -> str:
+        """模型使用的分詞器名稱，不同模型共用分詞器時 token 數可以共用"""
+        encoding = self._get_encoding(model)
+        return encoding.name if encoding is not None else ESTIMATE_ENCODING
+
+    def count_tokens(self, text: str, model: str) -> int:
+        """計算文本的 token 數"""
+        encoding = self._get_encoding(model)
+        if encoding is None:
+            # 粗略估算：中文約每字 1.5 token，英文偏保守
+            return (len(text.encode('utf-8')) + 1) // 2
+        return len(encoding.encode(text))
+
+    def message_tokens(self, message, model: str) -> int:
+        """獲取消息的 token 數，結果連同分詞器名稱緩存在消息上，避免重複分詞
+
+        對話和摘要可能使用不同的模型，分詞器不同時重新計算。
+        """
+        encoding = self.encoding_name(model)
+        if message.tokens is None or message.token_encoding != encoding:
+            message.tokens = self.count_tokens(message.content, model) + self.MESSAGE_OVERHEAD
+            message.token_encoding = encoding
+        return message.tokens
+
+    def prompt_tokens(self, prompt: str, model: str) -> int:
+        """獲取系統提示詞的 token 數（按內容緩存）"""
+        key = (self.encoding_name(model), prompt)
+        tokens = self._prompt_tokens.get(key)
+        if tokens is None:
+            tokens = self.count_tokens(prompt, model) + self.MESSAGE_OVERHEAD
+            if len(self._prompt_tokens) >= self.MAX_CACHED_PROMPTS:
+                self._prompt_tokens.clear()
+            self._prompt_tokens[key] = tokens
+        return tokens
+
+    def build(self, system_prompt: str, history, model: str, budget: int, start=None, summary: str = None) -> tuple:
+        """從最新的消息開始往回裝入歷史記錄，直到用完預算
+
+        系統提示詞在前、歷史記錄在後，並且歷史的起點有滯後：start 為上一輪
+        選定的最早一條消息，只要從它開始仍在預算內就沿用，不會每輪都丟掉
+        最舊的一條，使消息列表的前綴在各輪之間保持不變。超出預算時一次裁剪
+        到預算的 PACK_RATIO，為之後幾輪留出空間。有摘要時放在系統提示詞之後、
+        歷史記錄之前。
+
+        返回 (消息列表, 提示詞 token 數, 本輪的歷史起點)
+        """
+        base = self.REPLY_PRIMING + self.prompt_tokens(system_prompt, model)
+        if summary:
+            summary = SUMMARY_PREFIX + summary
+            base += self.prompt_tokens(summary, model)
+        used = base
+        selected = []
+        overflow = False
+        reached_start = False
+        for message in reversed(history):
+            tokens = self.message_tokens(message, model)
+            # 最新一條消息總是保留
+            if selected and used + tokens > budget:
+                overflow = True
+                break
+            used += tokens
+            selected.append(message)
+            if message is start:
+                reached_start = True
+                break
+
+        if overflow:
+            target = base + int((budget - base) * self.PACK_RATIO)
+            while len(selected) > 1 and used > target:
+                used -= self.message_tokens(selected.pop(), model)
+            start = selected[-1]
+            logger.debug("上下文超出預算 %s，保留 %s/%s 條消息", budget, len(selected), len(history))
+        elif not reached_start:
+            # 起點已被淘汰或從未裁剪過，從最早的消息開始
+            start = None
+
+        messages = [{"role": "system", "content": system_prompt}]
+        if summary:
+            messages.append({"role": "system", "content": summary})
+        messages.extend({"role": message.role, "content": message.content} for message in reversed(selected))
+        return messages, used, start
@@ -0,0 +1,190 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter, deque
+from .metrics import LOOP_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerBusyError(Exception):
+    """已有採樣在進行中"""
+
+
+class LoopLagMonitor:
+    """監控事件循環被同步代碼阻塞的情況
+
+    事件循環中的心跳任務每 interval 秒醒來一次，實際間隔超出 interval 的部分記入
+    bot_event_loop_lag_seconds。後台線程發現心跳停止超過 threshold 秒時，抓取事件循環
+    線程此刻的調用棧寫入日誌（阻塞的代碼就在棧頂），心跳恢復後再記錄阻塞的總時長。
+    """
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.05, stack_limit: int = 30,
+                 max_events: int = 20):
+        self.threshold = threshold
+        self.interval = interval
+        self.stack_limit = stack_limit
+        self.stalls = 0
+        self.max_lag = 0.0
+        # 最近的阻塞：(開始的 Unix 時間, 時長, 調用棧)
+        self.events = deque(maxlen=max_events)
+        self._beat = 0.0
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """開始監控當前線程的事件循環，必須在事件循環中調用"""
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+        self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            self._beat = now
+
+    def _watch(self):
+        stalled_beat = None
+        stack = ""
+        # 每個閾值檢查兩次，阻塞被發現時最多已持續 1.5 倍閾值
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            if beat == stalled_beat:
+                continue
+            if stalled_beat is not None:
+                # 心跳恢復，上一次阻塞結束
+                duration = beat - stalled_beat - self.interval
+                self.events.append((time.time() - (time.monotonic() - stalled_beat), duration, stack))
+                logger.warning("事件循環阻塞結束，共 %.3f 秒", duration)
+                stalled_beat = None
+            if time.monotonic() - beat - self.interval >= self.threshold:
+                stalled_beat = beat
+                self.stalls += 1
+                stack = self._loop_stack()
+                logger.warning(
+                    "事件循環已阻塞 %.3f 秒，當前調用棧:\n%s", time.monotonic() - beat - self.interval, stack
+                )
+
+    def _loop_stack(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return ""
+        return "".join(traceback.format_stack(frame, limit=self.stack_limit))
+
+    def stats(self) -> dict:
+        return {
+            "stalls": self.stalls,
+            "max_lag": round(self.max_lag, 4),
+            "last_stall": round(self.events[-1][1], 4) if self.events else 0.0,
+        }
+
+
+def _frame_label(code, labels: dict) -> str:
+    label = labels.get(code)
+    if label is None:
+        # 保留上一級目錄，區分不同包中的同名文件（如 __init__.py）
+        path = code.co_filename
+        short = os.path.join(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+        label = labels[code] = f"{code.co_name} ({short}:{code.co_firstlineno})".replace(";", ":")
+    return label
+
+
+class SamplingProfiler:
+    """對運行中的進程定時採樣所有線程的調用棧
+
+    採樣在後台線程中進行，不需要重啟或預先插樁。結果寫成 collapsed 格式，
+    每行為 "線程名;最外層函數;...;最內層函數 次數"，可直接交給 flamegraph.pl 或 speedscope。
+    同一時間只運行一次採樣。
+    """
+
+    def __init__(self, output_dir: str, hz: float = 100, max_seconds: float = 60.0):
+        self.output_dir = output_dir
+        self.hz = hz
+        self.max_seconds = max_seconds
+        self.profiles = 0
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    async def profile(self, seconds: float) -> tuple:
+        """採樣 seconds 秒（不超過 max_seconds），返回 (輸出文件路徑, 採樣次數)"""
+        if self._running:
+            raise ProfilerBusyError("已有採樣在進行中")
+        self._running = True
+        try:
+            seconds = min(max(seconds, 0.1), self.max_seconds)
+            path, samples = await asyncio.to_thread(self._run, seconds)
+        finally:
+            self._running = False
+        self.profiles += 1
+        logger.info("採樣 %.1f 秒完成，共 %s 次，結果寫入 %s", seconds, samples, path)
+        return path, samples
+
+    def _run(self, seconds: float) -> tuple:
+        stacks, samples = self._sample(seconds)
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path, samples
+
+    def _sample(self, seconds: float) -> tuple:
+        me = threading.get_ident()
+        period = 1 / self.hz
+        stacks = Counter()
+        labels = {}
+        samples = 0
+        next_at = time.monotonic()
+        deadline = next_at + seconds
+        while next_at < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(_frame_label(frame.f_code, labels))
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)).replace(";", ":"))
+                stacks[";".join(reversed(frames))] += 1
+            samples += 1
+            next_at += period
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return stacks, samples
+
+    def stats(self) -> dict:
+        return {"running": self._running, "profiles": self.profiles}
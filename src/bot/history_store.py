@@ -0,0 +1,316 @@
+import sys
+import time
+import heapq
+import asyncio
+import logging
+from collections import deque, OrderedDict
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+# ChatMessage 實例本身（含 __slots__）的大致開銷
+MESSAGE_OVERHEAD = 80
+
+
+class ChatMessage:
+    """單條聊天記錄，使用 __slots__ 減少內存佔用"""
+    __slots__ = ('role', 'content', 'timestamp', 'tokens', 'token_encoding')
+
+    def __init__(self, role: str, content: str, timestamp: float = None, tokens: int = None,
+                 token_encoding: str = None):
+        self.role = role
+        self.content = content
+        # 使用單調時鐘，不受系統時間調整影響
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        # token 數由 ContextBuilder 首次計算後緩存，token_encoding 為計算時使用的分詞器名稱
+        self.tokens = tokens
+        self.token_encoding = token_encoding
+
+    def __repr__(self):
+        return f"ChatMessage(role={self.role!r}, content={self.content[:20]!r})"
+
+
+class HistoryView:
+    """聊天記錄的只讀視圖，不複製底層數據"""
+    __slots__ = ('_messages',)
+
+    def __init__(self, messages=()):
+        self._messages = messages
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __bool__(self):
+        return len(self._messages) > 0
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    def __reversed__(self):
+        return reversed(self._messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self._messages))
+            return list(islice(self._messages, start, stop, step))
+        return self._messages[index]
+
+
+EMPTY_VIEW = HistoryView()
+
+
+class Conversation:
+    """一段 (用戶, 角色) 對話的消息緩衝"""
+    __slots__ = ('messages', 'nbytes', 'deadline', 'context_start', 'summary')
+
+    def __init__(self, max_length: int):
+        self.messages = deque(maxlen=max_length)
+        # 估算的常駐內存字節數
+        self.nbytes = 0
+        # 在過期堆中登記的截止時間
+        self.deadline = 0.0
+        # 上一輪組裝上下文時選用的最早一條消息
+        self.context_start = None
+        # 已壓縮的較早消息的滾動摘要
+        self.summary = None
+
+
+def message_size(message: ChatMessage) -> int:
+    """估算單條消息佔用的內存字節數"""
+    return MESSAGE_OVERHEAD + sys.getsizeof(message.content)
+
+
+class HistoryStore:
+    """按 (用戶, 角色) 存放的環形緩衝聊天記錄
+
+    每段對話是一個固定長度的 deque，追加和淘汰最舊消息都是 O(1)；
+    消息按時間順序追加，因此過期清理只需從隊首彈出已過期的消息。
+    整段對話按最後一條消息的過期時間登記在最小堆中，由後台清理任務
+    按截止時間順序淘汰；超出全局內存預算時按 LRU 淘汰整段對話。
+    """
+
+    def __init__(self, max_length: int, expiry_seconds: float, max_bytes: int = 0):
+        self.max_length = max_length
+        self.expiry_seconds = expiry_seconds
+        self.max_bytes = max_bytes
+        # (user_id, role_id) -> Conversation，按最近使用排序
+        self._conversations = OrderedDict()
+        # user_id -> 該用戶有記錄的角色集合
+        self._user_roles = {}
+        self._deadlines = []
+        self.total_messages = 0
+        self.total_bytes = 0
+        self.expired_evictions = 0
+        self.budget_evictions = 0
+        # 因內存預算淘汰對話時以 user_id 調用，持久化的記錄需要在下次使用前重新加載；
+        # 自然過期的對話在存儲中也已過期，不會通知
+        self.on_evict = None
+
+    def append(self, user_id: int, role_id: str, role: str, content: str) -> ChatMessage:
+        """追加一條消息"""
+        key = (user_id, role_id)
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            conversation = self._conversations[key] = Conversation(self.max_length)
+            self._user_roles.setdefault(user_id, set()).add(role_id)
+        else:
+            self._conversations.move_to_end(key)
+
+        message = ChatMessage(role, content)
+        messages = conversation.messages
+        if len(messages) == self.max_length:
+            # 手動彈出最舊消息，以便同步更新計數
+            self._account(conversation, messages.popleft(), -1)
+        messages.append(message)
+        self._account(conversation, message, 1)
+        self._trim(conversation, message.timestamp)
+
+        if not conversation.deadline:
+            self._schedule(key, conversation)
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            self._enforce_budget()
+        return message
+
+    def restore(self, user_id: int, role_id: str, messages: list, summary: str = None):
+        """恢復持久化的聊天記錄，messages 為 [(role, content, created_at), ...]
+
+        created_at 為 Unix 時間戳；已有常駐記錄的對話不會被覆蓋。
+        """
+        key = (user_id, role_id)
+        if key in self._conversations or not messages:
+            return
+
+        # 將牆上時間換算為單調時鐘
+        offset = time.monotonic() - time.time()
+        conversation = self._conversations[key] = Conversation(self.max_length)
+        self._user_roles.setdefault(user_id, set()).add(role_id)
+        for role, content, created_at in messages[-self.max_length:]:
+            message = ChatMessage(role, content, created_at + offset)
+            conversation.messages.append(message)
+            self._account(conversation, message, 1)
+        if summary:
+            self._set_summary(conversation, summary)
+
+        self._trim(conversation, time.monotonic())
+        if not conversation.messages:
+            self._drop(key)
+            return
+        self._schedule(key, conversation)
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            self._enforce_budget()
+
+    def get(self, user_id: int, role_id: str) -> HistoryView:
+        """獲取未過期的聊天記錄視圖"""
+        key = (user_id, role_id)
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            return EMPTY_VIEW
+
+        if self._trim(conversation, time.monotonic()):
+            logger.debug("用戶 %s 的 %s 角色有過期消息被清理", user_id, role_id)
+        if not conversation.messages:
+            self._drop(key)
+            return EMPTY_VIEW
+        self._conversations.move_to_end(key)
+        return HistoryView(conversation.messages)
+
+    def get_summary(self, user_id: int, role_id: str):
+        """獲取對話的滾動摘要，沒有時返回 None"""
+        conversation = self._conversations.get((user_id, role_id))
+        return conversation.summary if conversation is not None else None
+
+    def compact(self, user_id: int, role_id: str, summary: str, last_message: ChatMessage) -> int:
+        """以摘要取代從隊首到 last_message（含）的消息，返回移除的數量
+
+        摘要生成期間 last_message 已被淘汰或對話已清除時不做任何修改，返回 0。
+        """
+        conversation = self._conversations.get((user_id, role_id))
+        if conversation is None or not any(message is last_message for message in conversation.messages):
+            return 0
+
+        messages = conversation.messages
+        removed = 0
+        while True:
+            message = messages.popleft()
+            self._account(conversation, message, -1)
+            removed += 1
+            if message is conversation.context_start:
+                conversation.context_start = None
+            if message is last_message:
+                break
+        self._set_summary(conversation, summary)
+        return removed
+
+    def get_context_start(self, user_id: int, role_id: str):
+        """獲取上一輪上下文的歷史起點消息"""
+        conversation = self._conversations.get((user_id, role_id))
+        return conversation.context_start if conversation is not None else None
+
+    def set_context_start(self, user_id: int, role_id: str, message):
+        conversation = self._conversations.get((user_id, role_id))
+        if conversation is not None:
+            conversation.context_start = message
+
+    def clear(self, user_id: int, role_id: str = None):
+        """清除用戶某個角色或全部角色的記錄"""
+        if role_id is not None:
+            self._drop((user_id, role_id))
+            return
+        for role in list(self._user_roles.get(user_id, ())):
+            self._drop((user_id, role))
+
+    def sweep(self, now: float = None) -> int:
+        """按截止時間淘汰已整段過期的對話，返回淘汰數量"""
+        if now is None:
+            now = time.monotonic()
+        evicted = 0
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(deadlines)
+            conversation = self._conversations.get(key)
+            # 對話已被移除或重新登記過，跳過舊條目
+            if conversation is None or conversation.deadline != deadline:
+                continue
+            self._trim(conversation, now)
+            if conversation.messages:
+                # 對話期間有新消息，按最新消息重新登記
+                self._schedule(key, conversation)
+            else:
+                self._drop(key)
+                self.expired_evictions += 1
+                evicted += 1
+        return evicted
+
+    async def run_sweeper(self, interval: float):
+        """後台定期清理過期對話"""
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.sweep()
+            if evicted and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("後台清理了 %s 段過期對話，當前狀態: %s", evicted, self.stats())
+
+    def stats(self) -> dict:
+        """返回常駐用戶、消息和內存的計數"""
+        return {
+            "users": len(self._user_roles),
+            "conversations": len(self._conversations),
+            "messages": self.total_messages,
+            "bytes": self.total_bytes,
+            "expired_evictions": self.expired_evictions,
+            "budget_evictions": self.budget_evictions,
+        }
+
+    def _account(self, conversation: Conversation, message: ChatMessage, sign: int):
+        size = message_size(message) * sign
+        conversation.nbytes += size
+        self.total_bytes += size
+        self.total_messages += sign
+
+    def _set_summary(self, conversation: Conversation, summary: str):
+        size = sys.getsizeof(summary) - (sys.getsizeof(conversation.summary) if conversation.summary else 0)
+        conversation.summary = summary
+        conversation.nbytes += size
+        self.total_bytes += size
+
+    def _schedule(self, key: tuple, conversation: Conversation):
+        """以最新消息的過期時間登記到最小堆"""
+        conversation.deadline = conversation.messages[-1].timestamp + self.expiry_seconds
+        heapq.heappush(self._deadlines, (conversation.deadline, key))
+
+    def _enforce_budget(self):
+        """超出內存預算時，從最久未使用的對話開始整段淘汰"""
+        # 保留最近使用的一段對話，即正在寫入的那段
+        while self.total_bytes > self.max_bytes and len(self._conversations) > 1:
+            key = next(iter(self._conversations))
+            self._drop(key)
+            self.budget_evictions += 1
+            logger.debug("超出內存預算，淘汰對話 %s", key)
+            if self.on_evict is not None:
+                self.on_evict(key[0])
+
+    def _trim(self, conversation: Conversation, now: float) -> int:
+        """從隊首彈出過期消息，返回清理數量"""
+        deadline = now - self.expiry_seconds
+        messages = conversation.messages
+        removed = 0
+        while messages and messages[0].timestamp <= deadline:
+            self._account(conversation, messages.popleft(), -1)
+            removed += 1
+        return removed
+
+    def _drop(self, key: tuple):
+        """移除一段對話，用戶沒有其他對話時一併移除"""
+        conversation = self._conversations.pop(key, None)
+        if conversation is None:
+            return
+        self.total_messages -= len(conversation.messages)
+        self.total_bytes -= conversation.nbytes
+        user_id, role_id = key
+        roles = self._user_roles.get(user_id)
+        if roles is not None:
+            roles.discard(role_id)
+            if not roles:
+                del self._user_roles[user_id]
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._user_roles
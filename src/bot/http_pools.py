@@ -0,0 +1,223 @@
+import time
+import logging
+import importlib.util
+
+import httpx
+# 私有函數，按 httpx 自己的規則解析代理環境變量；requirements.txt 固定了 httpx 版本
+from httpx._utils import get_environment_proxies
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# 未安裝 h2 時 httpx 無法使用 HTTP/2
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+# HTTP/2 下每個連接可同時承載的請求數（服務器通常允許 100 個並發流）
+HTTP2_STREAMS_PER_CONNECTION = 100
+# HTTPXRequest 接受的 HTTP/2 寫法
+HTTP2_VERSIONS = ("2", "2.0")
+
+
+def resolve_http2(requested: bool, name: str) -> bool:
+    """請求 HTTP/2 但缺少 h2 時退回 HTTP/1.1"""
+    if requested and not HTTP2_AVAILABLE:
+        logger.warning("%s 連接池配置了 HTTP/2，但未安裝 h2，改用 HTTP/1.1", name)
+        return False
+    return requested
+
+
+class PoolMonitor:
+    """統計連接池的使用情況，判斷請求是否在池上排隊
+
+    in_use 為正在進行（含未讀完響應體）的請求數，超出池容量的部分
+    即為在 httpx 連接池中等待連接的請求。
+
+    容量按實際協商到的協議計算：允許 HTTP/2 時，在收到 HTTP/2 響應之前（以及服務器
+    退回 HTTP/1.1 時）仍按每個連接一個請求計算，只有確認使用 HTTP/2 後才按每個連接
+    HTTP2_STREAMS_PER_CONNECTION 個並發流計算。
+    """
+
+    def __init__(self, name: str, max_connections: int, http2: bool = False):
+        self.name = name
+        self.max_connections = max_connections
+        self.http2_allowed = http2
+        self.http_version = None
+        self.capacity = max_connections
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.peak_waiters = 0
+        self.requests = 0
+        self.saturated = 0
+        self.busy_seconds = 0.0
+        self._since = time.monotonic()
+
+    @property
+    def waiters(self) -> int:
+        return max(0, self.in_use - self.capacity)
+
+    def acquire(self):
+        self._advance()
+        self.requests += 1
+        if self.in_use >= self.capacity:
+            self.saturated += 1
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        self.peak_waiters = max(self.peak_waiters, self.waiters)
+
+    def release(self):
+        self._advance()
+        self.in_use -= 1
+
+    def negotiated(self, http_version):
+        """記錄響應實際使用的協議（響應的 extensions["http_version"]），更新容量"""
+        if not http_version or http_version == self.http_version:
+            return
+        self._advance()
+        self.http_version = http_version
+        http2 = self.http2_allowed and http_version == b"HTTP/2"
+        self.capacity = self.max_connections * (HTTP2_STREAMS_PER_CONNECTION if http2 else 1)
+
+    def _advance(self):
+        # 累計池被佔滿的時間
+        now = time.monotonic()
+        if self.in_use >= self.capacity:
+            self.busy_seconds += now - self._since
+        self._since = now
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "http2": self.capacity > self.max_connections,
+            "in_use": self.in_use,
+            "waiters": self.waiters,
+            "peak_in_use": self.peak_in_use,
+            "peak_waiters": self.peak_waiters,
+            "requests": self.requests,
+            "saturated_requests": self.saturated,
+            "saturated_seconds": round(self.busy_seconds, 3),
+        }
+
+
+class _MonitoredStream(httpx.AsyncByteStream):
+    """響應體讀完或關閉時才歸還連接計數"""
+
+    def __init__(self, stream, monitor: PoolMonitor):
+        self._stream = stream
+        self._monitor = monitor
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._monitor.release()
+        await self._stream.aclose()
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """包裝 httpx 傳輸層，記錄連接池的佔用情況"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, monitor: PoolMonitor):
+        self._transport = transport
+        self.monitor = monitor
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.monitor.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self.monitor.release()
+            raise
+        self.monitor.negotiated(response.extensions.get("http_version"))
+        response.stream = _MonitoredStream(response.stream, self.monitor)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def build_mounts(monitor: PoolMonitor, proxy=None, trust_env: bool = True, **transport_kwargs) -> dict:
+    """按代理配置創建 AsyncClient 的 mounts：{URL 模式: 帶監控的代理傳輸層}
+
+    傳入自定義 transport 時 httpx 不再讀取 HTTPS_PROXY、ALL_PROXY 和 NO_PROXY，這裡按 httpx
+    自己的規則補上：明確配置的 proxy 優先，否則使用環境變量；NO_PROXY 匹配的地址對應 None，
+    即直連默認的傳輸層。
+    """
+    if proxy is not None:
+        proxies = {"all://": proxy}
+    elif trust_env:
+        proxies = get_environment_proxies()
+    else:
+        proxies = {}
+    return {
+        pattern: None if url is None else InstrumentedTransport(
+            httpx.AsyncHTTPTransport(proxy=url if isinstance(url, httpx.Proxy) else httpx.Proxy(url),
+                                     **transport_kwargs),
+            monitor
+        )
+        for pattern, url in proxies.items()
+    }
+
+
+def build_limits(config: dict) -> httpx.Limits:
+    max_connections = config.get("max_connections", 100)
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=config.get("max_keepalive", max_connections),
+        keepalive_expiry=config.get("keepalive_expiry", 60.0),
+    )
+
+
+def create_openai_http_client(config: dict, monitor_name: str = "openai") -> tuple:
+    """按配置創建 OpenAI 客戶端使用的 httpx 客戶端，返回 (客戶端, 連接池監控)"""
+    limits = build_limits(config)
+    http2 = resolve_http2(config.get("http2", True), monitor_name)
+    monitor = PoolMonitor(monitor_name, limits.max_connections, http2)
+    transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+    client = httpx.AsyncClient(
+        transport=InstrumentedTransport(transport, monitor),
+        mounts=build_mounts(monitor, config.get("proxy"), limits=limits, http2=http2),
+        timeout=httpx.Timeout(config.get("timeout", 60.0), connect=config.get("connect_timeout", 5.0)),
+    )
+    return client, monitor
+
+
+class MonitoredHTTPXRequest(HTTPXRequest):
+    """帶連接池監控和可配置 keepalive 的 Telegram 請求對象
+
+    HTTPXRequest 默認的 keepalive 只有 5 秒，空閒稍久就要重新握手。
+    """
+
+    def __init__(self, monitor_name: str = "telegram", keepalive_expiry: float = 60.0,
+                 http_version: str = "1.1", **kwargs):
+        if http_version in HTTP2_VERSIONS and not resolve_http2(True, monitor_name):
+            http_version = "1.1"
+        # 父類構造函數會調用 _build_client，需要先設置好這些屬性
+        self._monitor_name = monitor_name
+        self._keepalive_expiry = keepalive_expiry
+        self._pool_size = kwargs.get("connection_pool_size", 1)
+        self._http2 = http_version in HTTP2_VERSIONS
+        self.monitor = PoolMonitor(monitor_name, self._pool_size, self._http2)
+        super().__init__(http_version=http_version, **kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        client_kwargs = dict(self._client_kwargs)
+        client_kwargs.pop("limits", None)
+        http1 = client_kwargs.pop("http1", True)
+        http2 = client_kwargs.pop("http2", self._http2)
+        client_kwargs.pop("transport", None)
+        # 代理（proxy 參數或環境變量）改由帶監控的 mounts 處理
+        proxy = client_kwargs.pop("proxies", None)
+        limits = httpx.Limits(
+            max_connections=self._pool_size,
+            max_keepalive_connections=self._pool_size,
+            keepalive_expiry=self._keepalive_expiry,
+        )
+        transport = httpx.AsyncHTTPTransport(limits=limits, http1=http1, http2=http2)
+        client_kwargs["transport"] = InstrumentedTransport(transport, self.monitor)
+        client_kwargs["mounts"] = build_mounts(
+            self.monitor, proxy, client_kwargs.get("trust_env", True), limits=limits, http1=http1, http2=http2
+        )
+        return httpx.AsyncClient(**client_kwargs)
@@ -0,0 +1,100 @@
+import io
+import asyncio
+import hashlib
+import logging
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from .media_io import MemoryReader, encode_data_url
+
+logger = logging.getLogger(__name__)
+
+# 未安裝 Pillow 時只做格式識別，不縮放；Pillow 在線程池中處理第一張圖片時才導入
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+# 文件頭標記 -> (擴展名, MIME 類型)
+MAGIC_NUMBERS = [
+    (b"\xff\xd8\xff", ".jpg", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", ".png", "image/png"),
+    (b"GIF8", ".gif", "image/gif"),
+]
+
+PIL_FORMATS = {
+    "JPEG": (".jpg", "image/jpeg"),
+    "PNG": (".png", "image/png"),
+    "WEBP": (".webp", "image/webp"),
+    "GIF": (".gif", "image/gif"),
+}
+
+
+def detect_format(data) -> tuple:
+    """根據文件頭識別圖片格式，返回 (擴展名, MIME 類型)"""
+    header = bytes(data[:12])
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return ".webp", "image/webp"
+    for magic, ext, mime in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return ext, mime
+    return ".jpg", "image/jpeg"
+
+
+def pick_photo_size(photos, target_dimension: int):
+    """選出長邊不小於目標尺寸的最小 PhotoSize，都不夠大時選最大的"""
+    ordered = sorted(photos, key=lambda photo: photo.width * photo.height)
+    for photo in ordered:
+        if max(photo.width, photo.height) >= target_dimension:
+            return photo
+    return ordered[-1]
+
+
+def prepare_image(data, max_dimension: int, supported_formats: list, quality: int = 85) -> tuple:
+    """按需縮放並重新編碼圖片，返回 (圖片數據, MIME 類型, 圖片哈希)
+
+    格式受支持且尺寸不超限時原樣返回，否則縮放到 max_dimension 內並轉為 JPEG。
+    圖片哈希為下載的原始數據的 SHA-256，用作分析結果緩存的精確鍵：感知哈希會讓
+    相似但不同的圖片（如文字不同的截圖）共用另一張圖的分析結果。
+    """
+    ext, mime = detect_format(data)
+    image_hash = f"sha256:{hashlib.sha256(data).hexdigest()}"
+    if not PIL_AVAILABLE:
+        return data, mime, image_hash
+    from PIL import Image
+
+    # 直接從 memoryview 讀取，不複製原始數據
+    with Image.open(MemoryReader(memoryview(data))) as image:
+        ext, mime = PIL_FORMATS.get(image.format, (ext, mime))
+        if ext in supported_formats and max(image.size) <= max_dimension:
+            return data, mime, image_hash
+
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue(), "image/jpeg", image_hash
+
+
+def prepare_data_url(data, max_dimension: int, supported_formats: list) -> tuple:
+    """預處理圖片並編碼為 data URL，返回 (data URL, 圖片哈希)"""
+    data, mime, image_hash = prepare_image(data, max_dimension, supported_formats)
+    return encode_data_url(data, mime), image_hash
+
+
+class ImageProcessor:
+    """在線程池中預處理圖片和 base64 編碼，避免阻塞事件循環"""
+
+    def __init__(self, max_dimension: int, supported_formats: list, workers: int = 2):
+        self.max_dimension = max_dimension
+        self.supported_formats = supported_formats
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        if not PIL_AVAILABLE:
+            logger.warning("未安裝 Pillow，圖片將不做縮放直接發送")
+
+    async def prepare(self, data) -> tuple:
+        """返回 (data URL, 圖片哈希)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, prepare_data_url, data, self.max_dimension, self.supported_formats
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=False)
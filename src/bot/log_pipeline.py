@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# LogRecord 的標準屬性，其餘屬性（logger.info(..., extra={...}) 傳入的）作為結構化字段輸出
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "suppressed"}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """每條記錄輸出一行 JSON，在寫入線程中才格式化消息"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """按消息模板限流：同一模板每 interval 秒最多輸出 burst 條
+
+    消息模板是 logger 調用時的格式字符串（未代入參數），熱路徑上同一類日誌
+    只保留前幾條，被丟棄的條數記在該模板下一條輸出的記錄的 suppressed 字段中。
+    ERROR 及以上的記錄不限流。
+    """
+
+    def __init__(self, burst: int, interval: float = 60.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.suppressed = 0
+        # (logger, 模板) -> [窗口開始時間, 窗口內已輸出條數, 被丟棄條數]
+        self._windows = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        template = record.msg if isinstance(record.msg, str) else type(record.msg).__name__
+        key = (record.name, template)
+        now = record.created
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is None and len(self._windows) >= 10000:
+                self._windows.clear()
+            dropped = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if dropped:
+                record.suppressed = dropped
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        self.suppressed += 1
+        return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """只把記錄放入隊列，不在調用線程中格式化；隊列滿時丟棄並計數
+
+    標準 QueueHandler.prepare() 會先格式化消息，這裡留給寫入線程處理。
+    記錄的參數在寫入線程中才代入，不要傳入之後會被修改的對象。
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """隊列日誌管道：事件循環只把記錄放入隊列，由後台線程寫文件和控制台"""
+
+    def __init__(self, handler: NonBlockingQueueHandler, listener: QueueListener, rate_limit: RateLimitFilter = None):
+        self.handler = handler
+        self.listener = listener
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def stop(self):
+        """寫完隊列中剩餘的記錄後停止後台線程"""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.handler.queue.qsize(),
+            "dropped": self.handler.dropped,
+            "suppressed": self.rate_limit.suppressed if self.rate_limit is not None else 0,
+        }
+
+
+def setup_logging(path: str = None, level: str = "INFO", json_format: bool = True, max_bytes: int = 50 * 1024 * 1024,
+                  backup_count: int = 5, rate_limit: int = 20, rate_interval: float = 60.0,
+                  queue_size: int = 10000, console: bool = True) -> LogPipeline:
+    """為根 logger 安裝隊列日誌管道，取代原有的處理器
+
+    path 為日誌文件路徑（按 max_bytes 輪轉，保留 backup_count 個舊文件），為空時只輸出到控制台。
+    文件為每行一條的 JSON（json_format=False 時為文本），控制台總是文本。
+    rate_limit 為每個消息模板每 rate_interval 秒最多輸出的條數，0 表示不限流。
+    """
+    handlers = []
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+        handlers.append(file_handler)
+    if console:
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handlers.append(stream_handler)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    rate_filter = None
+    if rate_limit > 0:
+        rate_filter = RateLimitFilter(rate_limit, rate_interval)
+        queue_handler.addFilter(rate_filter)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    listener.start()
+
+    pipeline = LogPipeline(queue_handler, listener, rate_filter)
+    atexit.register(pipeline.stop)
+    return pipeline
@@ -0,0 +1,56 @@
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class MediaResultCache:
+    """語音轉寫和圖片分析結果的緩存，帶過期時間和 LRU 淘汰
+
+    第一級鍵是 Telegram 的 file_unique_id，命中時連文件都不用下載；
+    第二級鍵是內容的 SHA-256，命中時省去 API 調用。
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self.hits = {"file_id": 0, "content": 0}
+        self.misses = {"file_id": 0, "content": 0}
+
+    @staticmethod
+    def transcription_key(tier: str, value: str) -> tuple:
+        return ("whisper", tier, value)
+
+    @staticmethod
+    def vision_key(tier: str, value: str, role_id: str, caption: str = None) -> tuple:
+        # 圖片分析的提示詞因角色和說明文字而異
+        return ("vision", tier, value, role_id, caption or "")
+
+    def get(self, key: tuple):
+        """查找結果，key 的第二項為層級（file_id 或 content）"""
+        tier = key[1]
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits[tier] += 1
+                return value
+            del self._entries[key]
+        self.misses[tier] += 1
+        return None
+
+    def put(self, key: tuple, value):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            **{f"hits_{tier}": count for tier, count in self.hits.items()},
+            **{f"misses_{tier}": count for tier, count in self.misses.items()},
+        }
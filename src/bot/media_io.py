@@ -0,0 +1,244 @@
+import io
+import asyncio
+import logging
+import binascii
+from contextlib import asynccontextmanager
+
+import httpx
+
+from .http_pools import PoolMonitor, InstrumentedTransport, build_mounts
+
+logger = logging.getLogger(__name__)
+
+# 下載時每次讀取的塊大小
+CHUNK_SIZE = 64 * 1024
+# base64 每次編碼的輸入塊大小，須為 3 的倍數
+BASE64_CHUNK = 3 * 64 * 1024
+
+
+class BufferPool:
+    """可重用的下載緩衝區池，容量按 2 的冪次分級"""
+
+    MIN_SIZE = 64 * 1024
+
+    def __init__(self, max_pooled_bytes: int):
+        self.max_pooled_bytes = max_pooled_bytes
+        self._free = {}
+        self.pooled_bytes = 0
+
+    @classmethod
+    def capacity_for(cls, size: int) -> int:
+        """容納 size 字節時實際分配的緩衝區大小"""
+        return max(cls.MIN_SIZE, 1 << max(size - 1, 0).bit_length())
+
+    def acquire(self, size: int) -> bytearray:
+        capacity = self.capacity_for(size)
+        free = self._free.get(capacity)
+        if free:
+            self.pooled_bytes -= capacity
+            return free.pop()
+        return bytearray(capacity)
+
+    def release(self, buffer: bytearray):
+        capacity = len(buffer)
+        if self.pooled_bytes + capacity > self.max_pooled_bytes:
+            return
+        self._free.setdefault(capacity, []).append(buffer)
+        self.pooled_bytes += capacity
+
+
+class MediaBuffer:
+    """從池中借出的緩衝區：下載數據直接寫入，讀取時只提供 memoryview"""
+
+    def __init__(self, pool: BufferPool, size_hint: int):
+        self._pool = pool
+        self._buffer = pool.acquire(size_hint or BufferPool.MIN_SIZE)
+        self._views = []
+        self.length = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self._buffer)
+
+    def write(self, data) -> int:
+        size = len(data)
+        end = self.length + size
+        if end > len(self._buffer):
+            # 實際大小超出預估時換用更大的緩衝區
+            larger = self._pool.acquire(end)
+            larger[:self.length] = memoryview(self._buffer)[:self.length]
+            self._pool.release(self._buffer)
+            self._buffer = larger
+        self._buffer[self.length:end] = data
+        self.length = end
+        return size
+
+    def view(self) -> memoryview:
+        """返回已寫入數據的只讀視圖，歸還緩衝區時失效"""
+        view = memoryview(self._buffer)[:self.length].toreadonly()
+        self._views.append(view)
+        return view
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views.clear()
+        if self._buffer is not None:
+            self._pool.release(self._buffer)
+            self._buffer = None
+
+
+class MemoryReader(io.RawIOBase):
+    """把 memoryview 包裝成只讀文件對象，上傳時分塊讀取而不複製整個文件"""
+
+    def __init__(self, view: memoryview, name: str = None):
+        self._view = view
+        self._pos = 0
+        if name:
+            self.name = name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), len(self._view) - self._pos)
+        buffer[:size] = self._view[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._pos + size)
+        data = bytes(self._view[self._pos:end])
+        self._pos = end
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+def encode_data_url(data, mime_type: str) -> str:
+    """分塊 base64 編碼成 data URL，輸出寫入預先分配的緩衝區，只在最後轉成一次字符串"""
+    view = memoryview(data)
+    prefix = f"data:{mime_type};base64,".encode('ascii')
+    output = bytearray(len(prefix) + (len(view) + 2) // 3 * 4)
+    output[:len(prefix)] = prefix
+    pos = len(prefix)
+    for start in range(0, len(view), BASE64_CHUNK):
+        encoded = binascii.b2a_base64(view[start:start + BASE64_CHUNK], newline=False)
+        output[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+    return output.decode('ascii')
+
+
+class MemoryBudget:
+    """限制同時進行中的媒體請求佔用的內存總量"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak = 0
+        self.peak_request = 0
+        self.waits = 0
+        self._condition = None
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        # 單個請求超過上限時獨佔全部預算
+        size = min(size, self.max_bytes)
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            if self.in_use + size > self.max_bytes:
+                self.waits += 1
+                await self._condition.wait_for(lambda: self.in_use + size <= self.max_bytes)
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_use -= size
+                self._condition.notify_all()
+
+
+class MediaIO:
+    """媒體下載層：流式下載到池化緩衝區，並限制進行中請求的內存總量
+
+    下載使用與 Telegram 連接池相同的代理配置（proxy 或環境變量），連接池的佔用記入 monitor。
+    """
+
+    def __init__(self, max_inflight_bytes: int, max_pooled_bytes: int, proxy=None,
+                 max_connections: int = 64, monitor_name: str = "telegram_files"):
+        self.pool = BufferPool(max_pooled_bytes)
+        self.budget = MemoryBudget(max_inflight_bytes)
+        self.proxy = proxy
+        self.max_connections = max_connections
+        self.monitor = PoolMonitor(monitor_name, max_connections)
+        self._client = None
+
+    @asynccontextmanager
+    async def download(self, file, size_hint: int, reserve_factor: float = 1.0):
+        """下載 Telegram 文件，產出 MediaBuffer，退出時歸還緩衝區
+
+        reserve_factor 為該請求處理期間預計佔用內存與文件大小的倍數。緩衝區按 2 的冪次分配，
+        最多比文件大將近一倍，預算按實際分配的容量加上其餘的處理開銷計算。
+        """
+        size_hint = size_hint or file.file_size or 0
+        reserved = BufferPool.capacity_for(size_hint) + int(size_hint * max(reserve_factor - 1, 0))
+        async with self.budget.reserve(reserved):
+            buffer = MediaBuffer(self.pool, size_hint)
+            try:
+                await self._fetch(file, buffer)
+                self.budget.peak_request = max(self.budget.peak_request, buffer.capacity, reserved)
+                yield buffer
+            finally:
+                buffer.close()
+
+    async def _fetch(self, file, buffer: MediaBuffer):
+        file_path = file.file_path or ""
+        if not file_path.startswith(("http://", "https://")):
+            # 本地 Bot API 服務器返回的是本地路徑
+            await file.download_to_memory(out=buffer)
+            return
+
+        if self._client is None:
+            self._client = self._build_client()
+        async with self._client.stream("GET", file_path) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                buffer.write(chunk)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=self.max_connections)
+        transport = httpx.AsyncHTTPTransport(limits=limits)
+        return httpx.AsyncClient(
+            transport=InstrumentedTransport(transport, self.monitor),
+            mounts=build_mounts(self.monitor, self.proxy, limits=limits),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "inflight_bytes": self.budget.in_use,
+            "peak_inflight_bytes": self.budget.peak,
+            "peak_request_bytes": self.budget.peak_request,
+            "budget_waits": self.budget.waits,
+            "pooled_bytes": self.pool.pooled_bytes,
+        }
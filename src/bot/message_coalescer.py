@@ -0,0 +1,170 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBatch:
+    """合併後一次處理的消息
+
+    items 按到達順序排列，first_at 為第一條消息到達的單調時鐘時間。
+    處理函數在開始向用戶發送回覆前調用 start_delivery()，此後新消息不再取消本批次。
+    """
+    __slots__ = ('key', 'items', 'first_at', 'delivering')
+
+    def __init__(self, key, items: list, first_at: float):
+        self.key = key
+        self.items = items
+        self.first_at = first_at
+        self.delivering = False
+
+    def start_delivery(self):
+        self.delivering = True
+
+
+class _ChatState:
+    __slots__ = ('items', 'first_at', 'last_at', 'runner', 'batch', 'generation', 'flushing', 'wake')
+
+    def __init__(self):
+        self.items = []
+        self.first_at = 0.0
+        self.last_at = 0.0
+        self.runner = None
+        self.batch = None
+        self.generation = None
+        # 設置後不再等待合併窗口，排隊的消息立即處理
+        self.flushing = False
+        # 在事件循環中創建（submit 只在事件循環中調用）
+        self.wake = asyncio.Event()
+
+
+class MessageCoalescer:
+    """把同一聊天短時間內連續到達的消息合併為一次處理
+
+    收到消息後等待 window 秒，期間每來一條新消息重新計時，但從第一條起最多等待
+    max_wait 秒。每個聊天在自己的後台任務中處理，不佔用更新處理器的聊天鎖；
+    處理中又收到新消息、而回覆尚未開始發送時，取消正在進行的處理，把它的消息
+    放回最前面和新消息一起重新合併。process(batch) 是協程函數。
+    """
+
+    def __init__(self, process, window: float, max_wait: float):
+        self.process = process
+        self.window = window
+        self.max_wait = max(max_wait, window)
+        self.submitted = 0
+        self.batches = 0
+        self.superseded = 0
+        self.failures = 0
+        self._chats = {}
+        # 關閉後等待中的聊天立即開始處理
+        self._closing = False
+
+    def submit(self, key, item):
+        """加入一條消息，必須在事件循環中調用"""
+        state = self._chats.get(key)
+        if state is None:
+            state = self._chats[key] = _ChatState()
+        now = time.monotonic()
+        if not state.items:
+            state.first_at = now
+        state.items.append(item)
+        state.last_at = now
+        self.submitted += 1
+
+        generation = state.generation
+        if generation is not None and not generation.done() and not state.batch.delivering:
+            # 回覆還沒開始發送，舊的處理已經過時
+            generation.cancel()
+        if state.runner is None:
+            state.runner = asyncio.create_task(self._run(key, state))
+
+    def discard(self, key):
+        """丟棄聊天中尚未處理的消息，並取消還沒開始發送回覆的處理"""
+        state = self._chats.get(key)
+        if state is None:
+            return
+        state.items = []
+        if state.generation is not None and not state.batch.delivering:
+            state.generation.cancel()
+
+    async def flush(self, key):
+        """不再等待合併窗口，立即處理聊天中排隊的消息，並等待處理完成
+
+        用於同一聊天中不經過合併器的消息（如圖片）寫入歷史記錄之前，保證先到的文字消息
+        先寫入。等待期間提交的新消息也會一併處理，調用方應保證此時不再提交該聊天的消息。
+        """
+        state = self._chats.get(key)
+        if state is None or state.runner is None:
+            return
+        state.flushing = True
+        state.wake.set()
+        # 調用方被取消時不影響聊天的處理
+        await asyncio.wait({state.runner})
+
+    async def _debounce(self, state: _ChatState):
+        while not (self._closing or state.flushing):
+            delay = min(state.last_at + self.window, state.first_at + self.max_wait) - time.monotonic()
+            if delay <= 0:
+                return
+            try:
+                await asyncio.wait_for(state.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, key, state: _ChatState):
+        try:
+            while state.items:
+                await self._debounce(state)
+                if not state.items:
+                    break
+                batch = state.batch = MessageBatch(key, state.items, state.first_at)
+                state.items = []
+                self.batches += 1
+                generation = state.generation = asyncio.create_task(self.process(batch))
+                try:
+                    await asyncio.wait({generation})
+                except asyncio.CancelledError:
+                    generation.cancel()
+                    raise
+                finally:
+                    state.generation = state.batch = None
+
+                if generation.cancelled():
+                    if state.items:
+                        # 被新消息取代，舊消息放回最前面，與新消息一起重新計時
+                        self.superseded += 1
+                        state.items[:0] = batch.items
+                elif generation.exception() is not None:
+                    self.failures += 1
+                    logger.error("處理聊天 %s 的合併消息失敗: %s", key, generation.exception())
+        finally:
+            state.runner = None
+            if self._chats.get(key) is state:
+                del self._chats[key]
+
+    async def close(self, timeout: float = 30.0):
+        """不再等待合併窗口，處理完所有排隊的消息，超時則取消"""
+        self._closing = True
+        for state in self._chats.values():
+            state.wake.set()
+        runners = [state.runner for state in self._chats.values() if state.runner is not None]
+        if not runners:
+            return
+        _, pending = await asyncio.wait(runners, timeout=timeout)
+        for runner in pending:
+            runner.cancel()
+        if pending:
+            logger.warning("%s 個聊天的合併消息未在 %s 秒內處理完，已取消", len(pending), timeout)
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "active_chats": len(self._chats),
+            "pending_messages": sum(len(state.items) for state in self._chats.values()),
+            "generating": sum(1 for state in self._chats.values() if state.generation is not None),
+            "messages": self.submitted,
+            "batches": self.batches,
+            "superseded": self.superseded,
+            "failures": self.failures,
+        }
@@ -0,0 +1,207 @@
+import time
+import logging
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# 延遲直方圖的默認分桶（秒），覆蓋從毫秒級的緩存命中到數十秒的模型調用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+INF_LABEL = 'le="+Inf"'
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """單調遞增計數器，按標籤值分組"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Span:
+    """計時上下文，退出時把耗時記入直方圖"""
+    __slots__ = ('_histogram', '_labels', '_start')
+
+    def __init__(self, histogram, labels: tuple):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+        return False
+
+
+class Histogram:
+    """延遲直方圖，每個標籤組合只保存分桶計數、總和與次數"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [各分桶計數（非累積，最後一個為 +Inf）, 總和, 次數]
+        self._series = {}
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *labels) -> Span:
+        """返回計時上下文：with histogram.time(...):"""
+        return Span(self, labels)
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, INF_LABEL)} {count}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class StatsCollector:
+    """把組件的 stats() 字典導出為 gauge
+
+    stats() 返回 {指標: 數值}，或 {分組: {指標: 數值}}；
+    後者的分組名作為標籤 label 的值。非數值的項目會被忽略。
+    """
+
+    def __init__(self, prefix: str, func, label: str = "name"):
+        self.prefix = prefix
+        self.func = func
+        self.label = label
+
+    def collect(self) -> list:
+        try:
+            stats = self.func()
+        except Exception as e:
+            logger.warning("收集 %s 指標失敗: %s", self.prefix, e)
+            return []
+
+        series = {}
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                for metric, number in value.items():
+                    if _is_number(number):
+                        series.setdefault(metric, []).append((f'{self.label}="{_escape(key)}"', number))
+            elif _is_number(value):
+                series.setdefault(key, []).append(("", value))
+
+        lines = []
+        for metric, samples in series.items():
+            name = f"{self.prefix}_{metric}"
+            lines.append(f"# TYPE {name} gauge")
+            for labels, number in samples:
+                lines.append(f"{name}{{{labels}}} {float(number)}" if labels else f"{name} {float(number)}")
+        return lines
+
+
+def _is_number(value) -> bool:
+    # bool 是 int 的子類，導出為 0 或 1
+    return isinstance(value, (int, float))
+
+
+class Registry:
+    """指標註冊表，負責輸出 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_stats(self, prefix: str, func, label: str = "name"):
+        """註冊一個 stats() 函數，導出時調用；同一前綴重複註冊時替換舊的函數"""
+        collector = StatsCollector(prefix, func, label)
+        for index, metric in enumerate(self._metrics):
+            if isinstance(metric, StatsCollector) and metric.prefix == prefix:
+                self._metrics[index] = collector
+                return
+        self.register(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# 處理器各階段的耗時，按處理器、階段和角色分組
+STAGE_SECONDS = REGISTRY.histogram(
+    "bot_stage_seconds", "Duration of each handler stage", ("handler", "stage", "role")
+)
+# 處理器整體耗時和結果
+HANDLER_SECONDS = REGISTRY.histogram(
+    "bot_handler_seconds", "End-to-end handler duration", ("handler", "role")
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    "bot_handler_errors_total", "Handler invocations that ended with an error", ("handler", "role")
+)
+# OpenAI 每次請求（含重試和對沖）的耗時和結果
+OPENAI_SECONDS = REGISTRY.histogram(
+    "bot_openai_request_seconds", "Duration of individual OpenAI requests", ("endpoint", "outcome")
+)
+# 限流排隊等待的時間
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.histogram(
+    "bot_rate_limit_wait_seconds", "Time spent queued for rate limit tokens", ("service",)
+)
+RATE_LIMIT_REJECTIONS = REGISTRY.counter(
+    "bot_rate_limit_rejections_total", "Requests rejected after waiting for rate limit tokens", ("service",)
+)
+# 回覆在發送隊列中的等待時間，以及每次調用 Telegram 發送的耗時和結果
+SEND_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "bot_send_queue_wait_seconds", "Time outbound messages spent queued before sending", ("kind",)
+)
+TELEGRAM_SEND_SECONDS = REGISTRY.histogram(
+    "bot_telegram_send_seconds", "Duration of individual Telegram send calls", ("kind", "outcome")
+)
+# 事件循環心跳的實際間隔超出預期的時間，反映循環被同步代碼阻塞的程度
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "bot_event_loop_lag_seconds", "Delay of event loop heartbeats beyond their scheduled time", (),
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
@@ -0,0 +1,334 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from .metrics import OPENAI_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 各端點的默認設置：timeout 為單次請求的總超時（秒），hedge 表示是否啟用對沖請求。
+# 串流請求的延遲是收到響應頭的時間，與完整生成的延遲分開統計，各自決定對沖時機
+DEFAULT_ENDPOINT_POLICIES = {
+    "chat": {"timeout": 30.0, "hedge": True},
+    "chat_stream": {"timeout": 30.0, "hedge": True},
+    "vision": {"timeout": 60.0, "hedge": False},
+    "whisper": {"timeout": 60.0, "hedge": False},
+    "tts": {"timeout": 30.0, "hedge": False},
+    "summary": {"timeout": 60.0, "hedge": False},
+}
+
+# 可以重試的 openai 錯誤：限流、超時、連接失敗和服務端錯誤（另加 asyncio.TimeoutError）
+RETRYABLE_ERROR_NAMES = ("RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError")
+
+
+class CircuitOpenError(Exception):
+    """端點處於熔斷狀態，請求直接失敗"""
+
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"{endpoint} 服務暫時不可用，{retry_in:.0f} 秒後重試")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """連續失敗達到閾值後熔斷，冷卻期過後放行一個探測請求"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+
+    def retry_in(self) -> float:
+        """返回距離可以再次嘗試的秒數，0 表示可以發出請求"""
+        if self.state == self.CLOSED:
+            return 0.0
+        now = time.monotonic()
+        remaining = self.opened_at + self.reset_timeout - now
+        if remaining > 0:
+            return remaining
+        # 冷卻結束（或上一個探測請求遲遲沒有結果），放行一個探測請求
+        self.state = self.HALF_OPEN
+        self.opened_at = now
+        return 0.0
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+                logger.warning("連續失敗 %s 次，熔斷 %s 秒", self.failures, self.reset_timeout)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class LatencyWindow:
+    """最近若干次成功請求的延遲，用於計算分位數"""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> float:
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class EndpointState:
+    """單個端點的設置、熔斷器、延遲窗口和計數"""
+
+    def __init__(self, name: str, timeout: float, hedge: bool, breaker: CircuitBreaker):
+        self.name = name
+        self.timeout = timeout
+        self.hedge = hedge
+        self.breaker = breaker
+        self.latency = LatencyWindow()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+
+def retry_after_seconds(error: Exception):
+    """從錯誤響應的 Retry-After 頭讀取等待秒數，沒有時返回 None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rewind_file(kwargs: dict):
+    """上傳的文件對象在重試前回到開頭"""
+    file = kwargs.get("file")
+    if isinstance(file, tuple):
+        file = file[1]
+    if hasattr(file, "seek"):
+        file.seek(0)
+
+
+class OpenAICaller:
+    """所有 OpenAI 請求的統一調用層
+
+    - 可重試的錯誤按 full jitter 指數退避重試，服務端給出 Retry-After 時按其等待
+    - 每個端點有獨立的請求超時
+    - 啟用對沖的端點在請求超過最近 p95 延遲後再發一個相同請求，取先完成的結果
+    - 每個端點有獨立的熔斷器，連續失敗後在冷卻期內直接拋出 CircuitOpenError
+    """
+
+    # 至少有這麼多延遲樣本後才開始對沖
+    HEDGE_MIN_SAMPLES = 20
+    # 對沖請求最多佔總請求數的比例，避免服務變慢時請求量翻倍
+    HEDGE_MAX_RATIO = 0.1
+
+    def __init__(self, client, policies: dict = None, max_retries: int = 3, base_delay: float = 0.5,
+                 max_delay: float = 8.0, max_retry_after: float = 20.0,
+                 breaker_failures: int = 5, breaker_reset: float = 30.0):
+        # openai 導入較慢，和客戶端一樣等到創建調用層時才導入，分片模式的分派進程不需要它
+        import openai
+        self._openai = openai
+        self.retryable_errors = tuple(getattr(openai, name) for name in RETRYABLE_ERROR_NAMES) + (asyncio.TimeoutError,)
+        self.client = client
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        policies = {**DEFAULT_ENDPOINT_POLICIES, **(policies or {})}
+        self.endpoints = {
+            name: EndpointState(
+                name,
+                policy.get("timeout", 30.0),
+                policy.get("hedge", False),
+                CircuitBreaker(breaker_failures, breaker_reset)
+            )
+            for name, policy in policies.items()
+        }
+
+    async def call(self, endpoint: str, func, **kwargs):
+        """通過指定端點調用 func(**kwargs)，失敗時按策略重試"""
+        state = self.endpoints[endpoint]
+        state.calls += 1
+        kwargs.setdefault("timeout", state.timeout)
+        attempt = 0
+        while True:
+            retry_in = state.breaker.retry_in()
+            if retry_in > 0:
+                state.rejected += 1
+                raise CircuitOpenError(endpoint, retry_in)
+
+            rewind_file(kwargs)
+            try:
+                if state.hedge and len(state.latency) >= self.HEDGE_MIN_SAMPLES:
+                    return await self._hedged(state, func, kwargs)
+                return await self._attempt(state, func, kwargs)
+            except self.retryable_errors as e:
+                if attempt >= self.max_retries:
+                    state.failures += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                if delay is None:
+                    state.failures += 1
+                    raise
+                attempt += 1
+                state.retries += 1
+                logger.warning("%s 請求失敗（%s），%.2f 秒後第 %s 次重試", endpoint, type(e).__name__, delay, attempt)
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "calls": state.calls,
+                "retries": state.retries,
+                "failures": state.failures,
+                "rejected": state.rejected,
+                "hedges": state.hedges,
+                "hedge_wins": state.hedge_wins,
+                "breaker": state.breaker.state,
+                "breaker_trips": state.breaker.trips,
+                "p50": round(state.latency.percentile(50), 3),
+                "p95": round(state.latency.percentile(95), 3),
+                "p99": round(state.latency.percentile(99), 3),
+            }
+            for name, state in self.endpoints.items()
+        }
+
+    def _backoff(self, attempt: int, error: Exception):
+        """計算重試前的等待秒數，Retry-After 超過上限時返回 None 表示放棄"""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+            # 加少量抖動，避免同時被限流的請求一起重試
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _attempt(self, state: EndpointState, func, kwargs: dict):
+        """發出一次請求，整個請求不超過端點的超時
+
+        SDK 的 timeout 只限制每次讀寫，響應緩慢地逐塊到達時可以遠超這個時間，
+        這裡再用 wait_for 限制總時長，超時按 asyncio.TimeoutError 重試和計入熔斷。
+        串流請求在收到響應頭時就返回，總時長限制的是等待響應頭的時間。
+        """
+        timeout = kwargs.get("timeout")
+        if not isinstance(timeout, (int, float)):
+            timeout = state.timeout
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(func(**kwargs), timeout)
+        except self.retryable_errors as e:
+            OPENAI_SECONDS.observe(time.monotonic() - started, state.name, type(e).__name__)
+            # 限流說明服務正常，只是額度不足，不計入熔斷
+            if not isinstance(e, self._openai.RateLimitError):
+                state.breaker.record_failure()
+            raise
+        except self._openai.APIStatusError as e:
+            OPENAI_SECONDS.observe(time.monotonic() - started, state.name, type(e).__name__)
+            # 其他錯誤響應（如參數錯誤）說明服務可用
+            state.breaker.record_success()
+            raise
+        elapsed = time.monotonic() - started
+        state.breaker.record_success()
+        state.latency.add(elapsed)
+        OPENAI_SECONDS.observe(elapsed, state.name, "ok")
+        return result
+
+    async def _hedged(self, state: EndpointState, func, kwargs: dict):
+        """主請求超過 p95 延遲仍未完成時發出對沖請求，返回先成功的結果"""
+        primary = asyncio.ensure_future(self._attempt(state, func, kwargs))
+        hedge_delay = state.latency.percentile(95)
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        except asyncio.CancelledError:
+            # 調用方被取消（如消息被新消息取代）時不留下孤立的請求
+            primary.cancel()
+            primary.add_done_callback(_discard_result)
+            raise
+        if done or state.hedges >= state.calls * self.HEDGE_MAX_RATIO:
+            return await primary
+
+        state.hedges += 1
+        hedge = asyncio.ensure_future(self._attempt(state, func, dict(kwargs)))
+        pending = {primary, hedge}
+        winner = None
+        error = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+            if winner is None:
+                raise error
+            if winner is hedge:
+                state.hedge_wins += 1
+            return winner.result()
+        finally:
+            for task in (primary, hedge):
+                if task is winner:
+                    continue
+                if task.done():
+                    _discard_result(task)
+                else:
+                    task.cancel()
+                    task.add_done_callback(_discard_result)
+
+
+# 正在關閉的落選串流，保留引用直到關閉完成
+_closing = set()
+
+
+def _discard_result(task: asyncio.Task):
+    """關閉落選或被取消的請求已經返回的串流，釋放其連接"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    # SDK 的串流包裝著 httpx 響應，直接關閉響應，不再讀取剩餘的事件
+    response = getattr(result, "response", None)
+    close = getattr(response, "aclose", None) or getattr(result, "close", None)
+    if close is None:
+        return
+    closing = close()
+    if asyncio.iscoroutine(closing):
+        closing = asyncio.ensure_future(closing)
+        _closing.add(closing)
+        closing.add_done_callback(_closing.discard)
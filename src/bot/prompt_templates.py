@@ -0,0 +1,86 @@
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# 角色提示詞中代表自訂稱呼的佔位符
+NAME_PLACEHOLDER = "{name}"
+# 提示詞沒有佔位符時，在末尾追加的稱呼說明
+NAME_SUFFIX = "\n\n你的名字是「{name}」，請以這個名字自稱。"
+
+
+def normalize_prompt(text: str) -> str:
+    """統一換行符並去除行尾空白，保證同一角色每次得到完全相同的字節"""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+class RoleTemplate:
+    """啟動時編譯好的角色提示詞，創建後不可修改"""
+    __slots__ = ('role_id', 'prompt', '_head', '_tail')
+
+    def __init__(self, role_id: str, prompt: str, default_name: str = ""):
+        prompt = normalize_prompt(prompt)
+        head, found, tail = prompt.partition(NAME_PLACEHOLDER)
+        object.__setattr__(self, 'role_id', role_id)
+        if found:
+            # 沒有自訂稱呼時，佔位符處填入角色名稱
+            object.__setattr__(self, 'prompt', head + default_name + tail)
+            object.__setattr__(self, '_head', head)
+            object.__setattr__(self, '_tail', tail)
+        else:
+            object.__setattr__(self, 'prompt', prompt)
+            object.__setattr__(self, '_head', None)
+            object.__setattr__(self, '_tail', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RoleTemplate 不可修改")
+
+    def render(self, custom_name: str = None) -> str:
+        """填入自訂稱呼；沒有自訂稱呼時返回共用的基礎提示詞"""
+        if not custom_name:
+            return self.prompt
+        custom_name = " ".join(custom_name.split())
+        if self._head is not None:
+            return f"{self._head}{custom_name}{self._tail}"
+        # 稱呼追加在末尾，使角色提示詞本身成為所有用戶共用的前綴
+        return self.prompt + NAME_SUFFIX.format(name=custom_name)
+
+
+class PromptLibrary:
+    """所有角色的提示詞模板，以及按稱呼渲染後的結果緩存
+
+    同一角色和稱呼總是返回同一個字符串對象，系統消息在各輪對話之間
+    逐字節相同，可以命中服務端的提示詞前綴緩存。
+    """
+
+    # 最多緩存的 (角色, 稱呼) 渲染結果數量
+    MAX_RENDERED = 10000
+
+    def __init__(self, roles: dict):
+        self._templates = {
+            role_id: RoleTemplate(role_id, role['prompt'], role.get('name', ''))
+            for role_id, role in roles.items()
+        }
+        self._rendered = OrderedDict()
+
+    def __contains__(self, role_id: str) -> bool:
+        return role_id in self._templates
+
+    def render(self, role_id: str, custom_name: str = None) -> str:
+        """返回角色的系統提示詞，未知角色返回空字符串"""
+        template = self._templates.get(role_id)
+        if template is None:
+            return ""
+        if not custom_name:
+            return template.prompt
+
+        key = (role_id, custom_name)
+        prompt = self._rendered.get(key)
+        if prompt is None:
+            prompt = self._rendered[key] = template.render(custom_name)
+            if len(self._rendered) > self.MAX_RENDERED:
+                self._rendered.popitem(last=False)
+        else:
+            self._rendered.move_to_end(key)
+        return prompt
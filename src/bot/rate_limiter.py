@@ -0,0 +1,182 @@
+import time
+import asyncio
+import logging
+from collections import deque, OrderedDict
+from .metrics import RATE_LIMIT_WAIT_SECONDS, RATE_LIMIT_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+# 各服務的默認限額，tpm 為 None 表示不限制 token 數
+DEFAULT_RATE_LIMITS = {
+    "chat": {"rpm": 3500, "tpm": 90000},
+    "vision": {"rpm": 50, "tpm": 30000},
+    "whisper": {"rpm": 50, "tpm": None},
+    # TTS 的 tpm 按輸入字符數計算
+    "tts": {"rpm": 50, "tpm": None},
+    # 後台對話摘要，與聊天分開排隊，不佔用用戶請求的隊列
+    "summary": {"rpm": 500, "tpm": 30000},
+}
+
+
+class TokenBucket:
+    """令牌桶：按時間連續補充，每次檢查都是 O(1)"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """返回可取出 amount 個令牌前需要等待的秒數"""
+        self._refill(now)
+        # 單次請求超過桶容量時按容量計算，避免永遠等待
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta: float):
+        """按實際用量修正餘額，允許暫時為負"""
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class ServiceLimiter:
+    """單個服務的 RPM/TPM 限流器
+
+    令牌不足時請求進入所屬用戶的隊列等待，調度器在各用戶隊列間輪轉
+    發放令牌，避免單個用戶耗盡共享的令牌桶。
+    """
+
+    def __init__(self, name: str, rpm: float, tpm: float = None):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm) if tpm else None
+        # user_id -> deque[(future, amount)]，按輪轉順序排列
+        self._queues = OrderedDict()
+        self._scheduler = None
+        self.granted = 0
+        self.rejected = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+
+    def _wait_time(self, amount: float, now: float) -> float:
+        wait = self.requests.wait_time(1, now)
+        if self.tokens is not None and amount:
+            wait = max(wait, self.tokens.wait_time(amount, now))
+        return wait
+
+    def _consume(self, amount: float):
+        self.requests.consume(1)
+        if self.tokens is not None and amount:
+            self.tokens.consume(amount)
+        self.granted += 1
+
+    async def acquire(self, user_id: int, amount: float = 0, timeout: float = 0) -> bool:
+        """獲取一次調用額度，最多等待 timeout 秒，超時返回 False"""
+        start = time.monotonic()
+        # 沒有人排隊且令牌充足時直接通過
+        if not self._queues and self._wait_time(amount, start) == 0:
+            self._consume(amount)
+            return True
+
+        if timeout <= 0:
+            self.rejected += 1
+            RATE_LIMIT_REJECTIONS.inc(self.name)
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append((future, amount))
+        if self._scheduler is None:
+            self._scheduler = asyncio.create_task(self._schedule())
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            RATE_LIMIT_REJECTIONS.inc(self.name)
+            logger.warning("%s 服務限流等待超時，用戶 %s", self.name, user_id)
+            return False
+
+        waited = time.monotonic() - start
+        self.waited += 1
+        self.wait_seconds += waited
+        RATE_LIMIT_WAIT_SECONDS.observe(waited, self.name)
+        return True
+
+    async def _schedule(self):
+        """在各用戶隊列之間輪轉發放令牌"""
+        try:
+            while self._queues:
+                user_id, queue = next(iter(self._queues.items()))
+                future, amount = queue[0]
+                if future.done():
+                    # 等待者已超時或被取消
+                    self._pop(user_id, queue)
+                    continue
+
+                wait = self._wait_time(amount, time.monotonic())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                self._consume(amount)
+                future.set_result(True)
+                self._pop(user_id, queue)
+        finally:
+            self._scheduler = None
+
+    def _pop(self, user_id: int, queue: deque):
+        """移除隊首請求，並把該用戶輪轉到隊尾"""
+        queue.popleft()
+        if queue:
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+
+    def settle(self, estimated: float, actual: float):
+        """請求完成後按實際 token 用量修正"""
+        if self.tokens is not None:
+            self.tokens.adjust(actual - estimated)
+
+    def stats(self) -> dict:
+        return {
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "waited": self.waited,
+            "wait_seconds": self.wait_seconds,
+            "queued": sum(len(queue) for queue in self._queues.values()),
+        }
+
+
+class RateLimiter:
+    """聊天、圖片、語音識別和語音合成服務的限流器"""
+
+    def __init__(self, limits: dict = None, wait_timeout: float = 10.0):
+        limits = {**DEFAULT_RATE_LIMITS, **(limits or {})}
+        self.wait_timeout = wait_timeout
+        self.services = {
+            name: ServiceLimiter(name, limit["rpm"], limit.get("tpm"))
+            for name, limit in limits.items()
+        }
+
+    async def acquire(self, service: str, user_id: int, amount: float = 0, timeout: float = None) -> bool:
+        """等待服務額度，超過等待期限返回 False"""
+        if timeout is None:
+            timeout = self.wait_timeout
+        return await self.services[service].acquire(user_id, amount, timeout)
+
+    def settle(self, service: str, estimated: float, actual: float):
+        self.services[service].settle(estimated, actual)
+
+    def stats(self) -> dict:
+        return {name: limiter.stats() for name, limiter in self.services.items()}
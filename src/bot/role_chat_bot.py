@@ -1,61 +1,142 @@
 import os
 import sys
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Voice
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-import openai
-from openai import AsyncOpenAI
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from .settings import load_config, ConfigError
 from .role_manager import RoleManager
-import aiohttp
-import io
+from .storage import create_storage
+from .rate_limiter import RateLimiter
+from .update_processor import ChatOrderedUpdateProcessor
+from .message_coalescer import MessageCoalescer, MessageBatch
+from .send_queue import SendQueue, PRIORITY_TEXT, PRIORITY_VOICE
+from .webhook import WebhookServer, MetricsServer, profile_handler
+from .metrics import REGISTRY, STAGE_SECONDS, HANDLER_SECONDS, HANDLER_ERRORS
+from .tts_cache import TTSCache
+from .text_splitter import split_sentences
+from .image_processor import ImageProcessor, pick_photo_size
+from .media_cache import MediaResultCache
+from .media_io import MediaIO, MemoryReader
+from .summarizer import ConversationSummarizer
+from .openai_caller import OpenAICaller, CircuitOpenError
+from .http_pools import create_openai_http_client, MonitoredHTTPXRequest
+from .sharding import ShardDispatcher, DispatchWebhookServer, UpdatePoller, STOP_MESSAGE
+from .log_pipeline import setup_logging
+from .diagnostics import LoopLagMonitor, SamplingProfiler, ProfilerBusyError
 import json
-import base64
-from collections import deque
-from datetime import datetime, timedelta
-import asyncio
+import hashlib
+from functools import partial
 from pathlib import Path
+import asyncio
+import time
+import signal
 
-# 設置日誌
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('logs/bot.log'),
-        logging.StreamHandler()
-    ]
-)
-
+# 日誌處理器由 configure_logging() 在進程入口安裝，導入本模塊時不打開日誌文件
 logger = logging.getLogger(__name__)
 
-# 直接讀取配置文件
+# 直接讀取配置文件，可用 BOT_CONFIG_FILE 指定其他路徑（如基準測試生成的配置）
 current_dir = os.path.dirname(os.path.abspath(__file__))
-config_file = os.path.join(os.path.dirname(os.path.dirname(current_dir)), 'config', 'config.py')
+config_file = os.getenv('BOT_CONFIG_FILE') or os.path.join(
+    os.path.dirname(os.path.dirname(current_dir)), 'config', 'config.py'
+)
 
-# 使用 exec 執行配置文件
-config_namespace = {}
+# 讀取並校驗配置文件，得到只讀的設置表
 try:
-    with open(config_file, 'r') as f:
-        exec(f.read(), config_namespace)
-    logger.info("成功導入配置")
-    
-    # 從命名空間中需的變量
+    config_namespace = load_config(config_file)
     BOT_TOKEN = config_namespace['BOT_TOKEN']
     OPENAI_API_KEY = config_namespace['OPENAI_API_KEY']
     ROLES = config_namespace['ROLES']
+    STREAM_RESPONSES = config_namespace.get('STREAM_RESPONSES', True)
+    STREAM_EDIT_INTERVAL = config_namespace.get('STREAM_EDIT_INTERVAL', 1.0)
+    COALESCE_WINDOW = config_namespace.get('COALESCE_WINDOW', 0.8)
+    COALESCE_MAX_WAIT = config_namespace.get('COALESCE_MAX_WAIT', 3.0)
+    CONTEXT_TOKEN_BUDGETS = config_namespace.get('CONTEXT_TOKEN_BUDGETS', {})
+    HISTORY_MAX_MB = config_namespace.get('HISTORY_MAX_MB', 256)
+    HISTORY_SWEEP_INTERVAL = config_namespace.get('HISTORY_SWEEP_INTERVAL', 60)
+    HISTORY_EXPIRY_HOURS = config_namespace.get('HISTORY_EXPIRY_HOURS', 24)
+    MAX_HISTORY_LENGTH = config_namespace.get('MAX_HISTORY_LENGTH', 50)
+    STORAGE_BACKEND = config_namespace.get('STORAGE_BACKEND', 'memory')
+    STORAGE_PATH = config_namespace.get('STORAGE_PATH', 'data/sessions.db')
+    STORAGE_FLUSH_INTERVAL = config_namespace.get('STORAGE_FLUSH_INTERVAL', 0.05)
+    RATE_LIMITS = config_namespace.get('RATE_LIMITS', {})
+    RATE_LIMIT_WAIT = config_namespace.get('RATE_LIMIT_WAIT', 10.0)
+    MAX_CONCURRENT_UPDATES = config_namespace.get('MAX_CONCURRENT_UPDATES', 64)
+    UPDATE_MODE = config_namespace.get('UPDATE_MODE', 'polling')
+    WEBHOOK_URL = config_namespace.get('WEBHOOK_URL', '')
+    WEBHOOK_LISTEN = config_namespace.get('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_PORT = config_namespace.get('WEBHOOK_PORT', 8443)
+    WEBHOOK_PATH = config_namespace.get('WEBHOOK_PATH', '/telegram')
+    WEBHOOK_SECRET = config_namespace.get('WEBHOOK_SECRET') or None
+    # Webhook 端口對公網開放，必須用固定的密鑰驗證請求；重放工具等也需要同一個密鑰
+    if UPDATE_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise ConfigError(
+            "Webhook 模式必須設置 WEBHOOK_SECRET，例如 python -c \"import secrets; print(secrets.token_urlsafe(32))\" 生成"
+        )
+    TTS_CACHE_DIR = config_namespace.get('TTS_CACHE_DIR', 'temp/tts_cache')
+    TTS_CACHE_MEMORY_MB = config_namespace.get('TTS_CACHE_MEMORY_MB', 32)
+    TTS_CACHE_DISK_MB = config_namespace.get('TTS_CACHE_DISK_MB', 512)
+    TTS_PIPELINE_THRESHOLD = config_namespace.get('TTS_PIPELINE_THRESHOLD', 200)
+    TTS_PIPELINE_CONCURRENCY = config_namespace.get('TTS_PIPELINE_CONCURRENCY', 3)
+    VISION_TARGET_DIMENSION = config_namespace.get('VISION_TARGET_DIMENSION', 1024)
+    IMAGE_WORKERS = config_namespace.get('IMAGE_WORKERS', 2)
+    MEDIA_CACHE_SIZE = config_namespace.get('MEDIA_CACHE_SIZE', 5000)
+    MEDIA_CACHE_TTL_HOURS = config_namespace.get('MEDIA_CACHE_TTL_HOURS', 24)
+    MEDIA_MEMORY_BUDGET_MB = config_namespace.get('MEDIA_MEMORY_BUDGET_MB', 128)
+    MEDIA_POOL_MB = config_namespace.get('MEDIA_POOL_MB', 32)
+    SUMMARY_THRESHOLD_TOKENS = config_namespace.get('SUMMARY_THRESHOLD_TOKENS', 1500)
+    SUMMARY_KEEP_RECENT = config_namespace.get('SUMMARY_KEEP_RECENT', 6)
+    SUMMARY_MAX_TOKENS = config_namespace.get('SUMMARY_MAX_TOKENS', 400)
+    OPENAI_ENDPOINTS = config_namespace.get('OPENAI_ENDPOINTS', {})
+    OPENAI_MAX_RETRIES = config_namespace.get('OPENAI_MAX_RETRIES', 3)
+    BREAKER_FAILURES = config_namespace.get('BREAKER_FAILURES', 5)
+    BREAKER_RESET_SECONDS = config_namespace.get('BREAKER_RESET_SECONDS', 30)
+    OPENAI_POOL = config_namespace.get('OPENAI_POOL', {})
+    TELEGRAM_POOL = config_namespace.get('TELEGRAM_POOL', {})
+    TELEGRAM_SEND = config_namespace.get('TELEGRAM_SEND', {})
+    WARMUP_CONNECTIONS = config_namespace.get('WARMUP_CONNECTIONS', 4)
+    WARMUP_TIMEOUT = config_namespace.get('WARMUP_TIMEOUT', 5.0)
+    METRICS_LISTEN = config_namespace.get('METRICS_LISTEN', '127.0.0.1')
+    METRICS_PORT = config_namespace.get('METRICS_PORT', 9090)
+    OPENAI_BASE_URL = config_namespace.get('OPENAI_BASE_URL') or None
+    TELEGRAM_BASE_URL = config_namespace.get('TELEGRAM_BASE_URL') or 'https://api.telegram.org/bot'
+    TELEGRAM_BASE_FILE_URL = config_namespace.get('TELEGRAM_BASE_FILE_URL') or 'https://api.telegram.org/file/bot'
+    WORKERS = config_namespace.get('WORKERS', 1)
+    WORKER_RESTART_DELAY = config_namespace.get('WORKER_RESTART_DELAY', 1.0)
+    LOG_LEVEL = config_namespace.get('LOG_LEVEL', 'INFO')
+    LOG_FILE = config_namespace.get('LOG_FILE', 'logs/bot.log')
+    LOG_FORMAT = config_namespace.get('LOG_FORMAT', 'json')
+    LOG_MAX_MB = config_namespace.get('LOG_MAX_MB', 50)
+    LOG_BACKUPS = config_namespace.get('LOG_BACKUPS', 5)
+    LOG_RATE_LIMIT = config_namespace.get('LOG_RATE_LIMIT', 20)
+    LOG_RATE_INTERVAL = config_namespace.get('LOG_RATE_INTERVAL', 60)
+    LOOP_LAG_THRESHOLD = config_namespace.get('LOOP_LAG_THRESHOLD', 0.25)
+    ADMIN_USER_IDS = config_namespace.get('ADMIN_USER_IDS', ())
+    PROFILE_SECONDS = config_namespace.get('PROFILE_SECONDS', 10)
+    PROFILE_MAX_SECONDS = config_namespace.get('PROFILE_MAX_SECONDS', 60)
+    PROFILE_HZ = config_namespace.get('PROFILE_HZ', 100)
+    PROFILE_DIR = config_namespace.get('PROFILE_DIR', 'logs/profiles')
+    PROFILE_ENDPOINT = config_namespace.get('PROFILE_ENDPOINT', True)
 except Exception as e:
-    logger.error(f"導入配置時出錯: {e}")
-    logger.error(f"配置文件是否存在: {os.path.exists(config_file)}")
+    logger.error("導入配置時出錯: %s", e)
+    logger.error("配置文件是否存在: %s", os.path.exists(config_file))
     sys.exit(1)
 
-# 設置 OpenAI API
-openai.api_key = OPENAI_API_KEY
-
 # 在文件開頭添加常量
 MAX_VOICE_SIZE = 20 * 1024 * 1024  # 20MB
 MAX_PHOTO_SIZE = 10 * 1024 * 1024  # 10MB
 MAX_RETRIES = 3
+CHAT_MODEL = "gpt-3.5-turbo"
+CHAT_MAX_TOKENS = 1000
+VISION_MAX_TOKENS = 300
+# 圖片輸入按高清模式的大致 token 數預估
+VISION_IMAGE_TOKENS = 765
+# 分片模式下分派進程長輪詢的超時秒數
+POLL_TIMEOUT = 30
 
 # 在文件開頭添加語音配置
+TTS_MODEL = "tts-1"
 VOICE_SETTINGS = {
     "male_lover": "echo",     # 男性聲音
     "female_lover": "nova",   # 女性聲音
@@ -74,33 +155,6 @@ VOICE_SPEED = {
 SUPPORTED_IMAGE_FORMATS = ['.jpg', '.jpeg', '.png', '.webp']
 MAX_IMAGE_DIMENSION = 2048  # 最大圖片尺寸
 
-# 添加速率限制常量
-class RateLimits:
-    GPT35_RPM = 3500  # 每分鐘請求數
-    GPT4_VISION_RPM = 50
-    WHISPER_RPM = 50
-    TTS_RPM = 50
-    
-    def __init__(self):
-        # 為每個服務創建請隊
-        self.gpt35_requests = deque(maxlen=self.GPT35_RPM)
-        self.vision_requests = deque(maxlen=self.GPT4_VISION_RPM)
-        self.whisper_requests = deque(maxlen=self.WHISPER_RPM)
-        self.tts_requests = deque(maxlen=self.TTS_RPM)
-    
-    async def check_rate_limit(self, queue: deque, rpm: int) -> bool:
-        """檢查是否超過速率限制"""
-        now = datetime.now()
-        # 清理超過1分鐘的請求
-        while queue and (now - queue[0]) > timedelta(minutes=1):
-            queue.popleft()
-        
-        if len(queue) >= rpm:
-            return False
-        
-        queue.append(now)
-        return True
-
 # 更新錯誤消息
 ERROR_MESSAGES = {
     "rate_limit": "抱歉，服務當前請求過多，請稍後再試。",
@@ -109,19 +163,264 @@ ERROR_MESSAGES = {
     "no_role": "請先使用 /start 命令選擇一個角色。",
     "process_error": "抱歉，處理您的請求時發生錯誤。請稍後重試。",
     "voice_error": "抱歉，處理您的語音時發生錯誤。",
-    "photo_error": "抱歉，處理您的圖片時發生錯誤。"
+    "photo_error": "抱歉，處理您的圖片時發生錯誤。",
+    "service_unavailable": "抱歉，AI 服務暫時不可用，請稍後再試。"
 }
 
 class RoleChatBot:
-    def __init__(self):
-        self.role_manager = RoleManager()
+    def __init__(self, worker_index: int = None):
+        # 分片模式下的工作進程編號，單進程運行時為 None
+        self.worker_index = worker_index
+        if worker_index is None:
+            self.metrics_port = METRICS_PORT
+        else:
+            # 每個工作進程在 METRICS_PORT + 1 + 編號 上導出自己的指標
+            self.metrics_port = METRICS_PORT + 1 + worker_index if METRICS_PORT else 0
+        self.storage = create_storage(
+            STORAGE_BACKEND,
+            STORAGE_PATH,
+            HISTORY_EXPIRY_HOURS * 3600,
+            MAX_HISTORY_LENGTH,
+            STORAGE_FLUSH_INTERVAL
+        )
+        self.role_manager = RoleManager(
+            ROLES,
+            HISTORY_EXPIRY_HOURS,
+            MAX_HISTORY_LENGTH,
+            CONTEXT_TOKEN_BUDGETS,
+            HISTORY_MAX_MB * 1024 * 1024,
+            self.storage
+        )
         self.user_roles = {}
         self.custom_names = {}
         self.voice_mode_users = set()  # 新增：追踪使用語音模式��用戶
-        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-        self.rate_limits = RateLimits()
+        self._loaded_users = set()  # 已從存儲加載狀態的用戶
+        self._evicted_users = set()  # 聊天記錄因內存預算被淘汰、需要重新加載的用戶
+        self.role_manager.chat_history.on_evict = self._evicted_users.add
+        # openai 導入較慢，只在真正處理消息的進程中導入；分片模式的分派進程不創建 RoleChatBot
+        from openai import AsyncOpenAI
+        # 重試由 OpenAICaller 統一處理，關閉 SDK 自帶的重試
+        openai_http_client, self.openai_pool = create_openai_http_client(OPENAI_POOL)
+        self.client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            max_retries=0,
+            http_client=openai_http_client
+        )
+        self.telegram_request = MonitoredHTTPXRequest(
+            connection_pool_size=TELEGRAM_POOL.get('max_connections', 64),
+            keepalive_expiry=TELEGRAM_POOL.get('keepalive_expiry', 60.0),
+            http_version=TELEGRAM_POOL.get('http_version', '1.1'),
+            proxy=TELEGRAM_POOL.get('proxy'),
+            pool_timeout=TELEGRAM_POOL.get('pool_timeout', 5.0),
+            connect_timeout=TELEGRAM_POOL.get('connect_timeout', 5.0),
+            read_timeout=TELEGRAM_POOL.get('read_timeout', 10.0),
+            write_timeout=TELEGRAM_POOL.get('write_timeout', 20.0)
+        )
+        self.api = OpenAICaller(
+            self.client,
+            OPENAI_ENDPOINTS,
+            max_retries=OPENAI_MAX_RETRIES,
+            breaker_failures=BREAKER_FAILURES,
+            breaker_reset=BREAKER_RESET_SECONDS
+        )
+        self.rate_limits = RateLimiter(RATE_LIMITS, RATE_LIMIT_WAIT)
+        self.summarizer = ConversationSummarizer(
+            self.role_manager,
+            self.api,
+            CHAT_MODEL,
+            self.rate_limits,
+            SUMMARY_THRESHOLD_TOKENS,
+            SUMMARY_KEEP_RECENT,
+            SUMMARY_MAX_TOKENS,
+            trigger_length=MAX_HISTORY_LENGTH * 3 // 4
+        )
+        self.tts_cache = TTSCache(
+            TTS_CACHE_DIR,
+            TTS_CACHE_MEMORY_MB * 1024 * 1024,
+            TTS_CACHE_DISK_MB * 1024 * 1024
+        )
+        self.image_processor = ImageProcessor(MAX_IMAGE_DIMENSION, SUPPORTED_IMAGE_FORMATS, IMAGE_WORKERS)
+        self.media_cache = MediaResultCache(MEDIA_CACHE_SIZE, MEDIA_CACHE_TTL_HOURS * 3600)
+        self.media_io = MediaIO(
+            MEDIA_MEMORY_BUDGET_MB * 1024 * 1024,
+            MEDIA_POOL_MB * 1024 * 1024,
+            proxy=TELEGRAM_POOL.get('proxy'),
+            max_connections=TELEGRAM_POOL.get('max_connections', 64)
+        )
+        self.coalescer = MessageCoalescer(self.reply_to_batch, COALESCE_WINDOW, COALESCE_MAX_WAIT)
+        # Telegram 的全局發送限制按機器人計算，分片模式下由各工作進程平分
+        send_share = WORKERS if worker_index is not None else 1
+        self.outbox = SendQueue(
+            TELEGRAM_SEND.get('global_per_second', 30) / send_share,
+            TELEGRAM_SEND.get('chat_per_minute', 60),
+            TELEGRAM_SEND.get('chat_burst', 3),
+            max_in_flight=TELEGRAM_SEND.get('max_in_flight', 32),
+            max_uploads=TELEGRAM_SEND.get('max_uploads', 4),
+            max_retries=TELEGRAM_SEND.get('max_retries', 5),
+            max_retry_after=TELEGRAM_SEND.get('max_retry_after', 60.0)
+        )
+        self.loop_monitor = LoopLagMonitor(LOOP_LAG_THRESHOLD) if LOOP_LAG_THRESHOLD > 0 else None
+        self.profiler = SamplingProfiler(PROFILE_DIR, PROFILE_HZ, PROFILE_MAX_SECONDS)
+        self._background_tasks = []
+        # 限制同時生成回覆的批次數，在事件循環中按需創建
+        self._reply_slots = None
+        self.metrics_server = None
+        self.register_metrics()
         logger.info("RoleChatBot 初始化完成")
     
+    def register_metrics(self):
+        """把各組件的 stats() 導出到 /metrics"""
+        REGISTRY.add_stats("bot_history", self.role_manager.chat_history.stats)
+        REGISTRY.add_stats("bot_rate_limiter", self.rate_limits.stats, "service")
+        REGISTRY.add_stats("bot_openai", self.api.stats, "endpoint")
+        REGISTRY.add_stats("bot_http_pool", self.pool_stats, "pool")
+        REGISTRY.add_stats("bot_tts_cache", self.tts_cache.stats)
+        REGISTRY.add_stats("bot_media_cache", self.media_cache.stats)
+        REGISTRY.add_stats("bot_media_io", self.media_io.stats)
+        REGISTRY.add_stats("bot_summarizer", self.summarizer.stats)
+        REGISTRY.add_stats("bot_coalescer", self.coalescer.stats)
+        REGISTRY.add_stats("bot_send_queue", self.outbox.stats)
+        REGISTRY.add_stats("bot_profiler", self.profiler.stats)
+        if self.loop_monitor is not None:
+            REGISTRY.add_stats("bot_event_loop", self.loop_monitor.stats)
+    
+    async def post_init(self, application: Application):
+        """應用啟動後開啟後台任務"""
+        if self.loop_monitor is not None:
+            self.loop_monitor.start()
+        await asyncio.gather(self.storage.start(), self.tts_cache.start())
+        self._background_tasks.append(asyncio.create_task(
+            self.role_manager.chat_history.run_sweeper(HISTORY_SWEEP_INTERVAL)
+        ))
+        # 預熱在後台進行，不推遲開始接收更新
+        self._background_tasks.append(asyncio.create_task(self.warm_up(application)))
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(METRICS_LISTEN, self.metrics_port)
+            if PROFILE_ENDPOINT:
+                self.metrics_server.add_get("/debug/profile", profile_handler(self.profiler, PROFILE_SECONDS))
+            await self.metrics_server.start()
+    
+    async def warm_up(self, application: Application):
+        """在線程池中加載分詞器，同時預熱連接，避免第一條消息承擔這些時間"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            loop.run_in_executor(None, self.role_manager.context_builder.preload, CHAT_MODEL),
+            self.warm_up_connections(application)
+        )
+
+    async def warm_up_connections(self, application: Application):
+        """並發發出輕量請求，提前完成 TCP 和 TLS 握手"""
+        if WARMUP_CONNECTIONS <= 0:
+            return
+        started = time.monotonic()
+        requests = []
+        for _ in range(WARMUP_CONNECTIONS):
+            requests.append(application.bot.get_me())
+            requests.append(self.client.models.list())
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*requests, return_exceptions=True), WARMUP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning("連接預熱超過 %s 秒，跳過", WARMUP_TIMEOUT)
+            return
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        logger.info(
+            "連接預熱完成，用時 %.2f 秒，失敗 %s/%s", time.monotonic() - started, failed, len(results)
+        )
+    
+    async def post_stop(self, application: Application):
+        """停止接收更新後，處理完合併窗口中還在等待的消息，並發出隊列中的回覆"""
+        await self.coalescer.close()
+        logger.info("消息合併狀態: %s", self.coalescer.stats())
+        await self.outbox.close()
+        logger.info("發送隊列狀態: %s", self.outbox.stats())
+    
+    def reply(self, message, text: str, **kwargs) -> asyncio.Future:
+        """把文字回覆排入發送隊列，不等待發送完成，返回發出的消息的 Future"""
+        return self.outbox.submit(message.chat_id, partial(message.reply_text, text, **kwargs))
+    
+    def edit(self, chat_id: int, message, text: str) -> asyncio.Future:
+        """把消息編輯排入發送隊列，同一條消息尚未發出的編輯只保留最新內容
+
+        message 可以是已發出的消息，也可以是 reply() 返回的 Future。
+        """
+        async def send():
+            target = await message if isinstance(message, asyncio.Future) else message
+            return await target.edit_text(text)
+        
+        return self.outbox.submit(chat_id, send, key=("edit", id(message)))
+    
+    async def post_shutdown(self, application: Application):
+        """應用關閉時停止後台任務"""
+        for task in self._background_tasks:
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        self._background_tasks.clear()
+        if self.loop_monitor is not None:
+            await self.loop_monitor.stop()
+        await self.summarizer.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await self.storage.close()
+        await self.tts_cache.close()
+        self.image_processor.close()
+        await self.media_io.close()
+        logger.info("媒體下載狀態: %s", self.media_io.stats())
+        logger.info("聊天記錄狀態: %s", self.role_manager.chat_history.stats())
+        logger.info("對話摘要狀態: %s", self.summarizer.stats())
+        logger.info("OpenAI 調用狀態: %s", self.api.stats())
+        logger.info("連接池狀態: %s", self.pool_stats())
+        await self.client.close()
+    
+    def pool_stats(self) -> dict:
+        """OpenAI 和 Telegram 連接池的佔用和排隊情況"""
+        return {
+            "openai": self.openai_pool.stats(),
+            "telegram": self.telegram_request.monitor.stats(),
+            "telegram_files": self.media_io.monitor.stats(),
+        }
+    
+    async def load_user_state(self, user_id: int):
+        """首次收到用戶消息時從存儲中恢復狀態，聊天記錄因內存預算被淘汰後再重新加載
+
+        記錄在內存中自然過期時，存儲中的記錄同樣已經過期，無需再讀取存儲。
+        """
+        if user_id in self._loaded_users and user_id not in self._evicted_users:
+            return
+        
+        first_load = user_id not in self._loaded_users
+        try:
+            state = await self.storage.load_user(user_id)
+        except Exception as e:
+            # 不標記為已加載，下一條消息重新讀取，避免之後的保存覆蓋存儲中的設置
+            logger.error("加載用戶 %s 的狀態失敗: %s", user_id, e)
+            return
+        self._loaded_users.add(user_id)
+        self._evicted_users.discard(user_id)
+        if not state:
+            return
+        
+        # 內存中的狀態較新，只在首次加載時恢復用戶設置
+        if first_load:
+            if state["role_id"] and self.validate_role_id(state["role_id"]):
+                self.user_roles.setdefault(user_id, state["role_id"])
+            if state["custom_name"]:
+                self.custom_names.setdefault(user_id, state["custom_name"])
+            if state["voice_mode"]:
+                self.voice_mode_users.add(user_id)
+        self.role_manager.restore_chat_history(user_id, state["history"], state.get("summaries"))
+    
+    def save_user_state(self, user_id: int):
+        """將用戶的角色、稱呼和語音模式排入存儲隊列"""
+        self.storage.save_user(
+            user_id,
+            self.user_roles.get(user_id),
+            self.custom_names.get(user_id),
+            user_id in self.voice_mode_users
+        )
+    
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """處理 /start 命令，顯示角色選擇菜單"""
         help_text = """
@@ -147,33 +446,39 @@ class RoleChatBot:
             ])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(help_text, reply_markup=reply_markup)
+        self.reply(update.message, help_text, reply_markup=reply_markup)
     
     async def finish(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """處理 /finish 命令"""
         user_id = update.effective_user.id
+        await self.load_user_state(user_id)
         if user_id in self.user_roles:
             role_id = self.user_roles[user_id]
+            # 尚未回覆的消息屬於已結束的對話
+            self.coalescer.discard(user_id)
             self.role_manager.clear_chat_history(user_id, role_id)
             del self.user_roles[user_id]
+            self.save_user_state(user_id)
             await self.start(update, context)
         else:
-            await update.message.reply_text("您還沒有開始任何對話。")
+            self.reply(update.message, "您還沒有開始任何對話。")
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """處理文字消息"""
         user_id = update.effective_user.id
+        await self.load_user_state(user_id)
         
         # 檢查是否在等待設置名稱
         if context.user_data.get('waiting_for_name', False):
             custom_name = update.message.text
             self.custom_names[user_id] = custom_name
+            self.save_user_state(user_id)
             context.user_data['waiting_for_name'] = False
-            await update.message.reply_text(f"好的，我明白了。從現在開始，您可以叫我 {custom_name}。\n請直接發送消息開始聊天，使用 /finish 結束對話。")
+            self.reply(update.message, f"好的，我明白了。從現在開始，您可以叫我 {custom_name}。\n請直接發送消息開始聊天，使用 /finish 結束對話。")
             return
         
         if user_id not in self.user_roles:
-            await update.message.reply_text("請先使用 /start 命令選擇一個角色進行對話。")
+            self.reply(update.message, "請先使用 /start 命令選擇一個角色進行對話。")
             return
         
         await self.process_message(update, context)
@@ -187,59 +492,85 @@ class RoleChatBot:
         role_id = query.data.replace("select_role_", "")
         
         # 更新用戶選擇的角色
+        await self.load_user_state(user_id)
         self.user_roles[user_id] = role_id
+        self.save_user_state(user_id)
         
         # 如果是虛擬戀人，詢問稱呼
         if role_id in ["male_lover", "female_lover"]:
-            await query.message.edit_text("請告訴我，您想怎麼稱呼我呢？")
+            self.edit(query.message.chat_id, query.message, "請告訴我，您想怎麼稱呼我呢？")
             context.user_data['waiting_for_name'] = True
             return
         
         # 如果是管家，直接使用默認名稱
         role = self.role_manager.get_role(role_id)
-        await query.message.edit_text(f"您已選擇與 {role['name']} 對話。\n請直接發送消息開始聊天，使用 /finish 結束對話。")
+        self.edit(query.message.chat_id, query.message, f"您已選擇與 {role['name']} 對話。\n請直接發送消息開始聊天，使用 /finish 結束對話。")
 
     async def handle_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """處理語音消息"""
-        # 檢查速率限制
-        if not await self.rate_limits.check_rate_limit(self.rate_limits.whisper_requests, RateLimits.WHISPER_RPM):
-            await update.message.reply_text("抱歉，語音識別服務當前請求過多，請稍後再試。")
-            return
-        
         if update.message.voice.file_size > MAX_VOICE_SIZE:
-            await update.message.reply_text("語音文件太大，請發送小於 20MB 的語音。")
+            self.reply(update.message, "語音文件太大，請發送小於 20MB 的語音。")
             return
         user_id = update.effective_user.id
+        await self.load_user_state(user_id)
         if user_id not in self.user_roles:
-            await update.message.reply_text("請先使用 /start 命令選擇一個角色進行對話。")
+            self.reply(update.message, "請先使用 /start 命令選擇一個角色進行對話。")
             return
 
+        role_id = self.user_roles[user_id]
         try:
-            # 獲取語音文件
             voice = update.message.voice
-            voice_file = await context.bot.get_file(voice.file_id)
-            
-            # 下載語音文件
-            voice_bytes = await voice_file.download_as_bytearray()
-            
-            # 使用 Whisper API 進行語音轉文字
-            audio_file = io.BytesIO(voice_bytes)
-            audio_file.name = "voice_message.ogg"
             
-            transcript = await self.client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
+            # 同一個文件（如轉發的語音）直接使用緩存的轉寫結果，無需下載
+            id_key = self.media_cache.transcription_key("file_id", voice.file_unique_id)
+            text_message = self.media_cache.get(id_key)
+            if text_message is None:
+                text_message = await self.transcribe_voice(update, context, voice)
+                if text_message is None:
+                    return
+                self.media_cache.put(id_key, text_message)
             
-            # 處理轉換後的文字消，並指定需要語音回覆
-            text_message = transcript.text
+            # 處理轉換後的文字消，並指定需要語音回覆；耗時在 reply_to_batch 中記錄
             await self.process_message(update, context, text_message, voice_reply=True)
 
         except Exception as e:
-            logger.error(f"處理語音消息時發生錯誤: {str(e)}")
-            await update.message.reply_text("抱歉，處理您的語音消息時發生錯誤。")
+            HANDLER_ERRORS.inc("voice", role_id)
+            logger.error("處理語音消息時發生錯誤: %s", e)
+            self.reply(update.message, "抱歉，處理您的語音消息時發生錯誤。")
+
+    async def transcribe_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE, voice) -> str:
+        """下載語音並轉寫，內容相同時使用緩存，限流超時返回 None"""
+        role_id = self.user_roles.get(update.effective_user.id)
+        started = time.perf_counter()
+        # 獲取並下載語音文件
+        voice_file = await context.bot.get_file(voice.file_id)
+        async with self.media_io.download(voice_file, voice.file_size) as buffer:
+            STAGE_SECONDS.observe(time.perf_counter() - started, "voice", "download", role_id)
+            voice_view = buffer.view()
+            content_key = self.media_cache.transcription_key(
+                "content", hashlib.sha256(voice_view).hexdigest()
+            )
+            text_message = self.media_cache.get(content_key)
+            if text_message is not None:
+                return text_message
+            
+            # 檢查速率限制，額度不足時短暫排隊等待
+            if not await self.rate_limits.acquire("whisper", update.effective_user.id):
+                self.reply(update.message, "抱歉，語音識別服務當前請求過多，請稍後再試。")
+                return None
+            
+            # 使用 Whisper API 進行語音轉文字，直接從下載緩衝區上傳
+            with STAGE_SECONDS.time("voice", "whisper", role_id):
+                transcript = await self.api.call(
+                    "whisper",
+                    self.client.audio.transcriptions.create,
+                    model="whisper-1",
+                    file=("voice_message.ogg", MemoryReader(voice_view))
+                )
+        self.media_cache.put(content_key, transcript.text)
+        return transcript.text
 
-    async def process_image(self, photo_bytes: bytes, role_id: str, caption: str = None) -> str:
+    async def process_image(self, image_url: str, role_id: str, caption: str = None) -> str:
         """根據角色處理圖片分析"""
         role_prompts = {
             "male_lover": "作為一個關心的男朋友，請描述這張圖片並給出溫柔的回應。",
@@ -252,8 +583,9 @@ class RoleChatBot:
         prompt = f"{base_prompt}\n用戶的圖片描述：{caption}" if caption else base_prompt
         
         try:
-            base64_image = base64.b64encode(photo_bytes).decode('utf-8')
-            response = await self.client.chat.completions.create(
+            response = await self.api.call(
+                "vision",
+                self.client.chat.completions.create,
                 model="gpt-4o",
                 messages=[
                     {
@@ -266,52 +598,78 @@ class RoleChatBot:
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
+                                    "url": image_url
                                 }
                             }
                         ]
                     }
                 ],
-                max_tokens=300
+                max_tokens=VISION_MAX_TOKENS
             )
             return response.choices[0].message.content
         except Exception as e:
-            logger.error(f"圖片分析失敗: {str(e)}")
+            logger.error("圖片分析失敗: %s", e)
             raise
 
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """處理圖片消息"""
+        role_id = None
         try:
-            # 檢查速率限制
-            if not await self.rate_limits.check_rate_limit(self.rate_limits.vision_requests, RateLimits.GPT4_VISION_RPM):
-                await update.message.reply_text("抱歉，圖片分析服務當前請求過多，請稍後再試。")
-                return
-            
-            photo = update.message.photo[-1]
-            if photo.file_size > MAX_PHOTO_SIZE:
-                await update.message.reply_text("圖片太大，請發送小於 10MB 的圖片。")
+            # 選擇滿足目標解析度的最小尺寸，減少下載量和視覺 token
+            photo = pick_photo_size(update.message.photo, VISION_TARGET_DIMENSION)
+            if (photo.file_size or 0) > MAX_PHOTO_SIZE:
+                self.reply(update.message, "圖片太大，請發送小於 10MB 的圖片。")
                 return
             
             user_id = update.effective_user.id
+            await self.load_user_state(user_id)
             if user_id not in self.user_roles:
-                await update.message.reply_text("請先使用 /start 命令選擇一個角色進行對話。")
+                self.reply(update.message, "請先使用 /start 命令選擇一個角色進行對話。")
                 return
 
-            photo_file = await context.bot.get_file(photo.file_id)
-            photo_bytes = await photo_file.download_as_bytearray()
-            
-            # 分析圖片，傳入 caption
             role_id = self.user_roles[user_id]
-            response_text = await self.process_image(
-                photo_bytes, 
-                role_id,
-                caption=update.message.caption
-            )
+            caption = update.message.caption
+            # 先處理完之前合併中的文字消息，歷史記錄和回覆保持到達順序
+            await self.coalescer.flush(user_id)
+            with HANDLER_SECONDS.time("photo", role_id):
+                # 同一個文件在同一角色下分析過時，無需下載和調用 API
+                id_key = self.media_cache.vision_key("file_id", photo.file_unique_id, role_id, caption)
+                response_text = self.media_cache.get(id_key)
+                if response_text is None:
+                    started = time.perf_counter()
+                    photo_file = await context.bot.get_file(photo.file_id)
+                    # 解碼和重新編碼期間的內存約為文件大小的數倍，按此預留內存預算
+                    async with self.media_io.download(photo_file, photo.file_size, reserve_factor=4) as buffer:
+                        STAGE_SECONDS.observe(time.perf_counter() - started, "photo", "download", role_id)
+                        # 在線程池中縮放、重新編碼並生成 data URL
+                        with STAGE_SECONDS.time("photo", "prepare", role_id):
+                            image_url, image_hash = await self.image_processor.prepare(buffer.view())
+                
+                    # 內容逐字節相同（SHA-256 一致）的圖片複用分析結果
+                    content_key = self.media_cache.vision_key("content", image_hash, role_id, caption)
+                    response_text = self.media_cache.get(content_key)
+                    if response_text is None:
+                        # 檢查速率限制，額度不足時短暫排隊等待
+                        if not await self.rate_limits.acquire(
+                            "vision", user_id, VISION_IMAGE_TOKENS + VISION_MAX_TOKENS
+                        ):
+                            self.reply(update.message, "抱歉，圖片分析服務當前請求過多，請稍後再試。")
+                            return
+                    
+                        # 分析圖片，傳入 caption
+                        with STAGE_SECONDS.time("photo", "vision", role_id):
+                            response_text = await self.process_image(
+                                image_url,
+                                role_id,
+                                caption=caption
+                            )
+                        self.media_cache.put(content_key, response_text)
+                    self.media_cache.put(id_key, response_text)
             
-            # 發送回覆（只發送一次）
-            custom_name = self.custom_names.get(user_id, self.role_manager.get_role(role_id)['name'])
-            formatted_message = f"{custom_name}：{response_text}"
-            await update.message.reply_text(formatted_message)
+                # 發送回覆（只發送一次）
+                custom_name = self.custom_names.get(user_id, self.role_manager.get_role(role_id)['name'])
+                formatted_message = f"{custom_name}：{response_text}"
+                self.reply(update.message, formatted_message)
             
             # 將圖片回應添加到聊天歷史
             self.role_manager.add_chat_history(user_id, role_id, {
@@ -324,50 +682,171 @@ class RoleChatBot:
             })
 
         except Exception as e:
-            logger.error(f"處理圖片消息時發生錯誤: {str(e)}")
-            await update.message.reply_text("抱歉，處理您的圖片時發生錯誤。")
+            HANDLER_ERRORS.inc("photo", role_id)
+            logger.error("處理圖片消息時發生錯誤: %s", e)
+            self.reply(update.message, "抱歉，處理您的圖片時發生錯誤。")
+
+    async def synthesize_voice(self, user_id: int, voice: str, speed: float, text: str):
+        """合成一段語音，返回 (緩存鍵, file_id 或音頻數據)，限流超時返回 None"""
+        cache_key = self.tts_cache.make_key(TTS_MODEL, voice, speed, text)
+        
+        # 已上傳過的相同語音直接按 file_id 重發
+        file_id = self.tts_cache.get_file_id(cache_key)
+        if file_id:
+            return cache_key, file_id
+        
+        audio = await self.tts_cache.get(cache_key)
+        if audio is not None:
+            return cache_key, audio
+        
+        # 檢查速率限制，TTS 按輸入字符數計算額度
+        if not await self.rate_limits.acquire("tts", user_id, len(text)):
+            return None
+        
+        # 生成語音
+        with STAGE_SECONDS.time("voice_reply", "tts", self.user_roles.get(user_id)):
+            response = await self.api.call(
+                "tts",
+                self.client.audio.speech.create,
+                model=TTS_MODEL,
+                voice=voice,
+                input=text,
+                speed=speed,
+                response_format="mp3"  # 指定回應格式
+            )
+        audio = response.content
+        self.tts_cache.put(cache_key, audio)
+        return cache_key, audio
+
+    def deliver_voice(self, update: Update, cache_key: str, payload) -> asyncio.Future:
+        """把語音排入發送隊列，首次上傳後記住 file_id
+
+        上傳音頻的優先級低於文字，按 file_id 重發的語音不需要上傳，與文字同等優先。
+        """
+        role_id = self.user_roles.get(update.effective_user.id)
+        
+        async def upload():
+            # 直接從內存發送，不經過臨時文件
+            with STAGE_SECONDS.time("voice_reply", "upload", role_id):
+                sent = await update.message.reply_voice(payload)
+            sent_file = sent.voice or sent.audio
+            if isinstance(payload, bytes) and sent_file:
+                self.tts_cache.set_file_id(cache_key, sent_file.file_id)
+            return sent
+        
+        priority = PRIORITY_VOICE if isinstance(payload, bytes) else PRIORITY_TEXT
+        return self.outbox.submit(update.message.chat_id, upload, priority)
 
     async def send_voice_reply(self, update: Update, text: str):
-        """發送語音回覆"""
+        """發送語音回覆，長回覆按句子分段並行合成、按順序發送"""
         try:
             user_id = update.effective_user.id
             role_id = self.user_roles[user_id]
             voice = VOICE_SETTINGS.get(role_id, "alloy")
             speed = VOICE_SPEED.get(role_id, 1.0)
             
-            # 確保 temp 目錄存在
-            temp_dir = Path("temp")
-            temp_dir.mkdir(exist_ok=True)
-            
-            # 生成臨時文件路徑
-            speech_file = temp_dir / f"speech_{user_id}_{datetime.now().timestamp()}.mp3"
-            
-            # 生成語音
-            response = await self.client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text,
-                speed=speed,
-                response_format="mp3"  # 指定回應格式
-            )
+            chunks = [text]
+            if len(text) > TTS_PIPELINE_THRESHOLD:
+                chunks = split_sentences(text)
             
-            # 直接將響應內容寫入文件
-            with open(speech_file, "wb") as file:
-                file.write(response.content)
+            semaphore = asyncio.Semaphore(TTS_PIPELINE_CONCURRENCY)
             
-            # 發送語音文件
-            with open(speech_file, "rb") as audio:
-                await update.message.reply_voice(audio)
+            async def synthesize(chunk: str):
+                async with semaphore:
+                    return await self.synthesize_voice(user_id, voice, speed, chunk)
             
-            # 刪除臨時文件
-            speech_file.unlink(missing_ok=True)
+            # 所有片段同時開始合成，哪段先好不影響發送順序
+            tasks = [asyncio.create_task(synthesize(chunk)) for chunk in chunks]
+            try:
+                with HANDLER_SECONDS.time("voice_reply", role_id):
+                    for task in tasks:
+                        result = await task
+                        if result is None:
+                            self.reply(update.message, "抱歉，語音合成服務當前請求過多，請稍後再試。")
+                            return
+                        self.deliver_voice(update, *result)
+            finally:
+                for task in tasks:
+                    task.cancel()
 
         except Exception as e:
-            logger.error(f"生成語音回覆時發生錯誤: {str(e)}")
-            await update.message.reply_text("抱歉，生成語音回覆時發生錯誤。")
+            HANDLER_ERRORS.inc("voice_reply", self.user_roles.get(update.effective_user.id))
+            logger.error("生成語音回覆時發生錯誤: %s", e)
+            self.reply(update.message, "抱歉，生成語音回覆時發生錯誤。")
+
+    async def stream_reply(self, update: Update, messages: list, prefix: str, role_id: str = None,
+                           on_first_chunk=None) -> str:
+        """以串流方式生成回覆，並按節流間隔編輯同一條消息
+
+        on_first_chunk 在發送第一條消息前調用。
+        """
+        started = time.perf_counter()
+        stream = await self.api.call(
+            "chat_stream",
+            self.client.chat.completions.create,
+            model=CHAT_MODEL,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=CHAT_MAX_TOKENS,
+            stream=True
+        )
+        
+        loop = asyncio.get_running_loop()
+        ai_message = ""
+        sent_message = None
+        sent_text = ""
+        last_edit = 0.0
+        
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                ai_message += delta
+                
+                now = loop.time()
+                if sent_message is None:
+                    STAGE_SECONDS.observe(time.perf_counter() - started, "message", "first_token", role_id)
+                    if on_first_chunk is not None:
+                        on_first_chunk()
+                    # 收到首批內容立即發送，縮短首字延遲
+                    sent_text = prefix + ai_message
+                    sent_message = self.reply(update.message, sent_text)
+                    last_edit = now
+                elif now - last_edit >= STREAM_EDIT_INTERVAL:
+                    # 節流編輯，避免超出 Telegram 的編輯頻率限制
+                    sent_text = prefix + ai_message
+                    self.edit(update.message.chat_id, sent_message, sent_text)
+                    last_edit = now
+        except asyncio.CancelledError:
+            # 被新消息取代時斷開連接，不再接收剩餘內容
+            await stream.response.aclose()
+            raise
+        
+        # 發送最終完整內容
+        final_text = prefix + ai_message
+        if sent_message is None:
+            self.reply(update.message, final_text)
+        elif final_text != sent_text:
+            self.edit(update.message.chat_id, sent_message, final_text)
+        
+        STAGE_SECONDS.observe(time.perf_counter() - started, "message", "stream", role_id)
+        return ai_message
+
+    def settle_chat_tokens(self, estimated_tokens: int, prompt_tokens: int, ai_message: str):
+        """按實際回覆長度修正聊天服務的 TPM 額度"""
+        completion_tokens = self.role_manager.context_builder.count_tokens(ai_message, CHAT_MODEL)
+        self.rate_limits.settle("chat", estimated_tokens, prompt_tokens + completion_tokens)
+
+    def compact_history(self, user_id: int, role_id: str):
+        """對話過長時在後台生成摘要，不阻塞當前請求"""
+        if SUMMARY_THRESHOLD_TOKENS > 0:
+            self.summarizer.maybe_compact(user_id, role_id)
 
     async def process_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str = None, voice_reply: bool = False):
-        """處理消息的核心邏輯"""
+        """處理消息的核心邏輯：同一用戶連續發送的消息先合併，再一次生成回覆"""
         user_id = update.effective_user.id
         text = message_text or update.message.text
         
@@ -375,51 +854,113 @@ class RoleChatBot:
         voice_keywords = ["用語音回答", "跟我說話", "用語音", "之後都用語音"]
         if any(keyword in text for keyword in voice_keywords):
             self.voice_mode_users.add(user_id)  # 將用戶加入語音模式
-            await update.message.reply_text("好的，我之後會用語音和您交流。")
+            self.save_user_state(user_id)
+            self.reply(update.message, "好的，我之後會用語音和您交流。")
         
         # 決定是否使用語音回覆
         voice_reply = voice_reply or user_id in self.voice_mode_users
+        handler = "voice" if voice_reply and message_text is not None else "message"
+        item = (update, text, voice_reply, handler)
         
-        # 檢查速率限制
-        if not await self.rate_limits.check_rate_limit(self.rate_limits.gpt35_requests, RateLimits.GPT35_RPM):
-            await update.message.reply_text("抱歉，聊天服務當前請求過多，請稍後再試。")
+        if COALESCE_WINDOW > 0:
+            # 處理在合併器的後台任務中進行，同一聊天的下一條更新無需等待本次回覆
+            self.coalescer.submit(user_id, item)
             return
-        
-        role_id = self.user_roles[user_id]
+        await self.reply_to_batch(MessageBatch(user_id, [item], time.monotonic()))
+
+    async def reply_to_batch(self, batch: MessageBatch):
+        """為合併後的一批消息調用一次模型，回覆最後一條消息
+
+        開始發送回覆前調用 batch.start_delivery()，之前的任何等待都可能被新消息取消，
+        此時不寫入歷史記錄，消息會併入下一批。同時生成回覆的批次不超過
+        MAX_CONCURRENT_UPDATES 個；從第一條消息到達到回覆完成的耗時記入 bot_handler_seconds，
+        被取消的批次不計入。
+        """
+        handler = "voice" if any(item[3] == "voice" for item in batch.items) else "message"
+        # 等待期間用戶可能已結束對話
+        role_id = self.user_roles.get(batch.key)
+        if role_id is None:
+            return
+        if self._reply_slots is None:
+            self._reply_slots = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+        async with self._reply_slots:
+            try:
+                await self.generate_batch_reply(batch, handler, role_id)
+            except Exception as e:
+                # 在合併器的後台任務中運行，異常到不了 error_handler，在這裡回覆用戶
+                HANDLER_ERRORS.inc(handler, role_id)
+                batch.start_delivery()
+                logger.error("處理用戶 %s 的消息時發生錯誤: %s", batch.key, e)
+                self.reply(batch.items[-1][0].message, ERROR_MESSAGES["process_error"])
+        HANDLER_SECONDS.observe(time.monotonic() - batch.first_at, handler, role_id)
+
+    async def generate_batch_reply(self, batch: MessageBatch, handler: str, role_id: str):
+        user_id = batch.key
+        update = batch.items[-1][0]
+        text = "\n".join(item[1] for item in batch.items)
+        voice_reply = any(item[2] for item in batch.items)
         role = self.role_manager.get_role(role_id)
+        STAGE_SECONDS.observe(time.monotonic() - batch.first_at, handler, "coalesce", role_id)
         
-        # 添加用戶消息到歷史記錄
-        self.role_manager.add_chat_history(user_id, role_id, {
-            "role": "user",
-            "content": text
-        })
-        
-        # 獲取聊天歷史
-        chat_history = self.role_manager.get_chat_history(user_id, role_id)
+        # 按 token 預算組裝提示詞和聊天歷史，本批消息放在最後，回覆完成後才寫入歷史
+        with STAGE_SECONDS.time(handler, "context", role_id):
+            messages, prompt_tokens = self.role_manager.build_context(
+                user_id, role_id, CHAT_MODEL, self.custom_names.get(user_id), pending_text=text
+            )
+        user_message = {"role": "user", "content": text}
+        history_written = False
         
-        # 獲取格式化的提示詞
-        prompt = self.role_manager.format_prompt(role_id, chat_history)
+        # 檢查速率限制（RPM 和預估 TPM），額度不足時短暫排隊等待
+        estimated_tokens = prompt_tokens + CHAT_MAX_TOKENS
+        if not await self.rate_limits.acquire("chat", user_id, estimated_tokens):
+            batch.start_delivery()
+            self.role_manager.add_chat_history(user_id, role_id, user_message)
+            self.reply(update.message, "抱歉，聊天服務當前請求過多，請稍後再試。")
+            return
         
         try:
+            # 文字回覆使用串流，收到首批內容即發送消息
+            if STREAM_RESPONSES and not voice_reply:
+                custom_name = self.custom_names.get(user_id, role['name'])
+                ai_message = await self.stream_reply(
+                    update, messages, f"{custom_name}：", role_id, on_first_chunk=batch.start_delivery
+                )
+                
+                # 串流結束後才寫入歷史記錄
+                self.role_manager.add_chat_history(user_id, role_id, user_message)
+                history_written = True
+                self.role_manager.add_chat_history(user_id, role_id, {
+                    "role": "assistant",
+                    "content": ai_message
+                })
+                self.settle_chat_tokens(estimated_tokens, prompt_tokens, ai_message)
+                self.compact_history(user_id, role_id)
+                return
+            
             # 調用 API
-            response = await self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": prompt},
-                    *chat_history
-                ],
-                temperature=0.7,
-                max_tokens=1000
-            )
+            with STAGE_SECONDS.time(handler, "chat", role_id):
+                response = await self.api.call(
+                    "chat",
+                    self.client.chat.completions.create,
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=CHAT_MAX_TOKENS
+                )
+            batch.start_delivery()
             
             # 獲取回應內容
             ai_message = response.choices[0].message.content
             
-            # 添加 AI 回應到歷史記錄
+            # 添加用戶消息和 AI 回應到歷史記錄
+            self.role_manager.add_chat_history(user_id, role_id, user_message)
+            history_written = True
             self.role_manager.add_chat_history(user_id, role_id, {
                 "role": "assistant",
                 "content": ai_message
             })
+            self.settle_chat_tokens(estimated_tokens, prompt_tokens, ai_message)
+            self.compact_history(user_id, role_id)
             
             # 根據回覆類型選擇回覆方式
             if voice_reply:
@@ -429,79 +970,201 @@ class RoleChatBot:
                 # 只發送文字回覆
                 custom_name = self.custom_names.get(user_id, role['name'])
                 formatted_message = f"{custom_name}：{ai_message}"
-                await update.message.reply_text(formatted_message)
+                self.reply(update.message, formatted_message)
             
+        except asyncio.CancelledError:
+            # 被新消息取代，請求可能已發出，按提示詞計入 TPM 額度
+            self.rate_limits.settle("chat", estimated_tokens, prompt_tokens)
+            raise
         except Exception as e:
-            logger.error(f"處理消息時發生錯誤: {str(e)}")
-            await update.message.reply_text("抱歉，處理您的消息時發生錯誤。")
+            HANDLER_ERRORS.inc(handler, role_id)
+            batch.start_delivery()
+            # 生成失敗時仍保留用戶消息
+            if not history_written:
+                self.role_manager.add_chat_history(user_id, role_id, user_message)
+            if isinstance(e, CircuitOpenError):
+                logger.warning("處理消息時服務熔斷: %s", e)
+                self.reply(update.message, ERROR_MESSAGES["service_unavailable"])
+            else:
+                logger.error("處理消息時發生錯誤: %s", e)
+                self.reply(update.message, "抱歉，處理您的消息時發生錯誤。")
 
     async def rename(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """處理 /rename 命令"""
         user_id = update.effective_user.id
+        await self.load_user_state(user_id)
         if user_id not in self.user_roles:
-            await update.message.reply_text("請先使用 /start 命令選擇一個角色。")
+            self.reply(update.message, "請先使用 /start 命令選擇一個角色。")
             return
         
         role_id = self.user_roles[user_id]
         if role_id not in ["male_lover", "female_lover"]:
-            await update.message.reply_text("只有虛擬戀人角色可以修改稱呼。")
+            self.reply(update.message, "只有虛擬戀人角色可以修改稱呼。")
             return
         
         context.user_data['waiting_for_name'] = True
-        await update.message.reply_text("請告訴我，您想怎麼稱呼我呢？")
+        self.reply(update.message, "請告訴我，您想怎麼稱呼我呢？")
 
-    async def retry_with_exponential_backoff(self, func, *args, **kwargs):
-        """帶有指數退避的重試機制"""
-        max_retries = 3
-        base_delay = 1
-        
-        for attempt in range(max_retries):
+    async def profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """處理 /profile [秒數] 命令（僅管理員）：對運行中的進程採樣，回傳火焰圖用的調用棧文件"""
+        seconds = PROFILE_SECONDS
+        if context.args:
             try:
-                return await func(*args, **kwargs)
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    raise
-                
-                delay = base_delay * (2 ** attempt)
-                logger.warning(f"嘗試失敗 {attempt + 1}/{max_retries}，等待 {delay} 秒後重試")
-                await asyncio.sleep(delay)
+                seconds = float(context.args[0])
+            except ValueError:
+                self.reply(update.message, "用法：/profile [秒數]")
+                return
+        if self.profiler.running:
+            self.reply(update.message, "已有採樣在進行中，請稍後再試。")
+            return
+        seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+        self.reply(update.message, f"開始採樣 {seconds:g} 秒...")
+        try:
+            path, samples = await self.profiler.profile(seconds)
+        except ProfilerBusyError:
+            self.reply(update.message, "已有採樣在進行中，請稍後再試。")
+            return
+        caption = f"採樣 {samples} 次，可用 flamegraph.pl 或 speedscope 查看"
+        if self.loop_monitor is not None:
+            lag = self.loop_monitor.stats()
+            caption += f"\n事件循環阻塞 {lag['stalls']} 次，最長延遲 {lag['max_lag'] * 1000:.0f} ms"
+        self.outbox.submit(
+            update.message.chat_id,
+            partial(update.message.reply_document, document=Path(path), caption=caption)
+        )
+
+    def build_application(self, update_processor: ChatOrderedUpdateProcessor = None,
+                          with_updater: bool = True) -> Application:
+        """創建 Application 並註冊所有處理器
+
+        update_processor 默認為 ChatOrderedUpdateProcessor，基準測試可傳入帶計時的子類。
+        分片模式的工作進程從管道接收更新，不需要 Updater。
+        """
+        if update_processor is None:
+            update_processor = ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES)
+        REGISTRY.add_stats("bot_updates", update_processor.stats)
+        builder = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .base_url(TELEGRAM_BASE_URL)
+            .base_file_url(TELEGRAM_BASE_FILE_URL)
+            .request(self.telegram_request)
+            .concurrent_updates(update_processor)
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .post_shutdown(self.post_shutdown)
+        )
+        if not with_updater:
+            builder = builder.updater(None)
+        application = builder.build()
+        logger.info("機器人實例創建成功")
+        
+        # 添加命令處理器
+        application.add_handler(CommandHandler("start", self.start))
+        application.add_handler(CommandHandler("finish", self.finish))
+        application.add_handler(CommandHandler("rename", self.rename))  # 添加 rename 命令處理器
+        if ADMIN_USER_IDS:
+            # 其他用戶發送的 /profile 不匹配任何處理器，直接忽略
+            application.add_handler(CommandHandler("profile", self.profile, filters=filters.User(user_id=ADMIN_USER_IDS)))
+        application.add_handler(CallbackQueryHandler(self.handle_role_selection, pattern="^select_role_"))
+        
+        # 添加消息處理器
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        application.add_handler(MessageHandler(filters.VOICE, self.handle_voice))
+        application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
+        
+        # 添加錯誤處理器
+        async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if isinstance(context.error, RetryAfter):
+                # 被 Telegram 限流時再發一條消息只會延長限流
+                logger.warning("請求被 Telegram 限流: %s", context.error)
+                return
+            logger.error("更新信息: %s", update)
+            logger.error("錯誤信息: %s", context.error)
+            if update and update.effective_message:
+                self.reply(update.effective_message, "抱歉，處理您的請求時發生錯誤。請稍後重試。")
+        
+        application.add_error_handler(error_handler)
+        logger.info("所有處理器添加完成")
+        return application
+
+    async def run_webhook(self, application: Application):
+        """以 Webhook 模式運行，收到停止信號後處理完已排隊的更新再退出"""
+        # 指標和採樣接口只在 post_init 啟動的 MetricsServer 上提供，不暴露在公網的 Webhook 端口
+        server = WebhookServer(application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        
+        await application.initialize()
+        await self.post_init(application)
+        await application.start()
+        await server.start()
+        # 不丟棄重啟期間積壓的更新
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False
+        )
+        logger.info("機器人正在以 Webhook 模式運行...")
+        
+        try:
+            await stop_event.wait()
+        finally:
+            logger.info("收到停止信號，正在處理剩餘更新...")
+            # 新請求返回 503，Telegram 會保留並在重啟後重新投遞
+            server.stop_accepting()
+            # stop() 會處理完隊列中的更新並等待進行中的處理器結束
+            await application.stop()
+            await self.post_stop(application)
+            await self.post_shutdown(application)
+            await application.shutdown()
+            await server.stop()
+
+    async def run_worker(self, conn):
+        """作為分片模式的工作進程運行，處理分派進程通過管道轉發的更新"""
+        application = self.build_application(with_updater=False)
+        await application.initialize()
+        await self.post_init(application)
+        await application.start()
+        logger.info("工作進程 %s 已啟動", self.worker_index)
+        loop = asyncio.get_running_loop()
+        
+        try:
+            while True:
+                try:
+                    payload = await loop.run_in_executor(None, conn.recv_bytes)
+                except EOFError:
+                    logger.warning("工作進程 %s 與分派進程的連接已斷開", self.worker_index)
+                    break
+                if payload == STOP_MESSAGE:
+                    break
+                update = Update.de_json(json.loads(payload), application.bot)
+                await application.update_queue.put(update)
+        finally:
+            logger.info("工作進程 %s 正在處理剩餘更新...", self.worker_index)
+            await application.stop()
+            await self.post_stop(application)
+            await self.post_shutdown(application)
+            await application.shutdown()
 
     def run(self):
         """運行機器人"""
         logger.info("開始初始化機器人...")
         try:
-            application = Application.builder().token(BOT_TOKEN).build()
-            logger.info("機器人實例創建成功")
-            
-            # 添加命令處理器
-            application.add_handler(CommandHandler("start", self.start))
-            application.add_handler(CommandHandler("finish", self.finish))
-            application.add_handler(CommandHandler("rename", self.rename))  # 添加 rename 命令處理器
-            application.add_handler(CallbackQueryHandler(self.handle_role_selection, pattern="^select_role_"))
-            
-            # 添加消息處理器
-            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
-            application.add_handler(MessageHandler(filters.VOICE, self.handle_voice))
-            application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
-            
-            # 添加錯誤處理器
-            async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-                logger.error(f"更新信息: {update}")
-                logger.error(f"錯誤信息: {context.error}")
-                if update and update.effective_message:
-                    await update.effective_message.reply_text(
-                        "抱歉，處理您的請求時發生錯誤。請稍後重試。"
-                    )
-            
-            application.add_error_handler(error_handler)
-            logger.info("所有處理器添加完成")
+            application = self.build_application()
             
             # 啟動機器人
             logger.info("機器人正在啟動...")
-            application.run_polling(drop_pending_updates=True)
+            if UPDATE_MODE == "webhook":
+                asyncio.run(self.run_webhook(application))
+            else:
+                application.run_polling(drop_pending_updates=False)
             
         except Exception as e:
-            logger.error(f"啟動時發生錯誤: {e}")
+            logger.error("啟動時發生錯誤: %s", e)
             import traceback
             logger.error(traceback.format_exc())
 
@@ -509,8 +1172,99 @@ class RoleChatBot:
         """驗證角色ID是否有效"""
         return role_id in ["male_lover", "female_lover", "butler"]
 
+def configure_logging(worker_index: int = None):
+    """安裝隊列日誌管道，文件寫入和格式化都在後台線程中進行
+
+    分片模式下每個工作進程寫自己的日誌文件，避免多個進程同時輪轉同一個文件。
+    """
+    path = LOG_FILE
+    if path and worker_index is not None:
+        root, ext = os.path.splitext(path)
+        path = f"{root}.worker{worker_index}{ext}"
+    pipeline = setup_logging(
+        path,
+        LOG_LEVEL,
+        json_format=LOG_FORMAT == 'json',
+        max_bytes=int(LOG_MAX_MB * 1024 * 1024),
+        backup_count=LOG_BACKUPS,
+        rate_limit=LOG_RATE_LIMIT,
+        rate_interval=LOG_RATE_INTERVAL
+    )
+    REGISTRY.add_stats("bot_logging", pipeline.stats)
+    logger.info("成功導入配置: %s", config_file)
+    return pipeline
+
+def worker_main(index: int, conn):
+    """分片模式下工作進程的入口"""
+    # Ctrl+C 會發給整個進程組，由分派進程統一通知工作進程退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_logging(index)
+    bot = RoleChatBot(worker_index=index)
+    asyncio.run(bot.run_worker(conn))
+
+async def run_sharded():
+    """分片模式：本進程只接收更新，按用戶 ID 一致性哈希轉發給 WORKERS 個工作進程"""
+    dispatcher = ShardDispatcher(worker_main, WORKERS, WORKER_RESTART_DELAY)
+    REGISTRY.add_stats("bot_shards", dispatcher.stats, "worker")
+    bot = Bot(
+        BOT_TOKEN,
+        base_url=TELEGRAM_BASE_URL,
+        base_file_url=TELEGRAM_BASE_FILE_URL,
+        get_updates_request=HTTPXRequest(read_timeout=POLL_TIMEOUT + 10)
+    )
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    dispatcher.start()
+    supervisor = asyncio.create_task(dispatcher.supervise())
+    server = None
+    metrics_server = None
+    poller = None
+    try:
+        async with bot:
+            if METRICS_PORT:
+                metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT)
+                await metrics_server.start()
+            if UPDATE_MODE == "webhook":
+                server = DispatchWebhookServer(dispatcher, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+                await server.start()
+                await bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=False
+                )
+            else:
+                poller = UpdatePoller(bot, dispatcher, POLL_TIMEOUT)
+                poll_task = asyncio.create_task(poller.run())
+            logger.info("機器人正在以分片模式運行，工作進程 %s 個", WORKERS)
+            
+            await stop_event.wait()
+            logger.info("收到停止信號，正在等待工作進程處理剩餘更新...")
+            if poller is not None:
+                poll_task.cancel()
+                await asyncio.gather(poll_task, return_exceptions=True)
+                await poller.confirm()
+            elif server is not None:
+                server.stop_accepting()
+    finally:
+        supervisor.cancel()
+        await asyncio.gather(supervisor, return_exceptions=True)
+        await dispatcher.stop()
+        if server is not None:
+            await server.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        logger.info("分片狀態: %s", dispatcher.stats())
+
 def main():
     """主函數"""
+    configure_logging()
+    if WORKERS > 1:
+        asyncio.run(run_sharded())
+        return
     bot = RoleChatBot()
     bot.run()
 
@@ -1,30 +1,56 @@
-from datetime import datetime, timedelta
-from config.config import ROLES, HISTORY_EXPIRY_HOURS, MAX_HISTORY_LENGTH
+from .context_builder import ContextBuilder
+from .prompt_templates import PromptLibrary
+from .history_store import HistoryStore, HistoryView
+from .storage import SessionStorage, MemoryStorage
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
 class RoleManager:
-    def __init__(self):
-        self.roles = ROLES
-        self.chat_history = {}
-        self.history_expiry = timedelta(hours=HISTORY_EXPIRY_HOURS)
-        self.max_history_length = MAX_HISTORY_LENGTH
+    # 單調時鐘換算為 Unix 時間時允許的誤差（秒）
+    CLOCK_TOLERANCE = 0.001
     
-    def format_prompt(self, role_id: str, chat_history: list) -> str:
-        """格式化角色提示詞"""
+    def __init__(self, roles: dict, history_expiry_hours: float, max_history_length: int,
+                 context_budgets: dict = None, max_history_bytes: int = 0, storage: SessionStorage = None):
+        self.roles = roles
+        # 啟動時一次性編譯所有角色的提示詞模板
+        self.prompts = PromptLibrary(roles)
+        self.history_expiry = history_expiry_hours * 3600
+        self.max_history_length = max_history_length
+        self.chat_history = HistoryStore(self.max_history_length, self.history_expiry, max_history_bytes)
+        self.context_builder = ContextBuilder(context_budgets)
+        self.storage = storage or MemoryStorage()
+    
+    def format_prompt(self, role_id: str, custom_name: str = None) -> str:
+        """獲取角色的系統提示詞（預先編譯，相同輸入總是返回相同內容）"""
+        # 歷史記錄只以消息形式發送，不寫入提示詞
+        return self.prompts.render(role_id, custom_name)
+    
+    def build_context(self, user_id: int, role_id: str, model: str, custom_name: str = None,
+                      pending_text: str = None) -> tuple:
+        """按角色和模型的 token 預算組裝上下文消息，返回 (消息列表, token 數)
+
+        pending_text 為尚未寫入歷史記錄的用戶消息，放在上下文最後，回覆完成後才寫入歷史。
+        """
         role = self.get_role(role_id)
         if not role:
-            return ""
+            return [], 0
         
-        # 組合完整提示詞
-        base_prompt = role['prompt']
-        formatted_history = "\n".join([
-            f"{'用戶' if msg['role'] == 'user' else '你'}: {msg['content']}"
-            for msg in chat_history[-5:]  # 只使用最近5條對話
-        ])
-        
-        return f"{base_prompt}\n\n最近的對話記錄：\n{formatted_history}"
+        history = self.chat_history.get(user_id, role_id)
+        budget = self.context_builder.budget_for(role, model)
+        start = self.chat_history.get_context_start(user_id, role_id)
+        summary = self.chat_history.get_summary(user_id, role_id)
+        pending_tokens = 0
+        if pending_text:
+            pending_tokens = self.context_builder.count_tokens(pending_text, model) + self.context_builder.MESSAGE_OVERHEAD
+        messages, tokens, start = self.context_builder.build(
+            self.format_prompt(role_id, custom_name), history, model, budget - pending_tokens, start, summary
+        )
+        self.chat_history.set_context_start(user_id, role_id, start)
+        if pending_text:
+            messages.append({"role": "user", "content": pending_text})
+        return messages, tokens + pending_tokens
     
     def get_role(self, role_id: str):
         """獲取角色信息"""
@@ -32,75 +58,36 @@ class RoleManager:
     
     def add_chat_history(self, user_id: int, role_id: str, message: dict):
         """添加聊天記錄"""
-        if user_id not in self.chat_history:
-            self.chat_history[user_id] = {}
-        
-        if role_id not in self.chat_history[user_id]:
-            self.chat_history[user_id][role_id] = []
-        
-        message['timestamp'] = datetime.now()
-        history = self.chat_history[user_id][role_id]
-        history.append(message)
-        
-        # 限制歷史記錄長度
-        if len(history) > self.max_history_length:
-            history.pop(0)
-        
-        self._clean_old_history(user_id, role_id)
+        self.chat_history.append(user_id, role_id, message["role"], message["content"])
+        self.storage.append_message(user_id, role_id, message["role"], message["content"], time.time())
+    
+    def restore_chat_history(self, user_id: int, history: dict, summaries: dict = None):
+        """從持久化存儲恢復聊天記錄和摘要，已在內存中的對話保持不變"""
+        summaries = summaries or {}
+        for role_id, messages in history.items():
+            self.chat_history.restore(user_id, role_id, messages, summaries.get(role_id))
     
-    def get_chat_history(self, user_id: int, role_id: str):
-        """獲取聊天歷史"""
-        if user_id in self.chat_history and role_id in self.chat_history[user_id]:
-            self._clean_old_history(user_id, role_id)
-            return [
-                {"role": msg["role"], "content": msg["content"]}
-                for msg in self.chat_history[user_id][role_id]
-            ]
-        return []
+    def compact_chat_history(self, user_id: int, role_id: str, summary: str, last_message) -> int:
+        """用摘要取代 last_message 及更早的消息，並同步到存儲，返回移除的消息數"""
+        removed = self.chat_history.compact(user_id, role_id, summary, last_message)
+        if removed:
+            # 將單調時鐘換算回 Unix 時間，與存儲中的 created_at 對應
+            covered_until = last_message.timestamp + (time.time() - time.monotonic())
+            self.storage.save_summary(user_id, role_id, summary, covered_until + self.CLOCK_TOLERANCE)
+        return removed
+    
+    def get_chat_history(self, user_id: int, role_id: str) -> HistoryView:
+        """獲取聊天歷史（只讀視圖，不複製消息）"""
+        return self.chat_history.get(user_id, role_id)
     
     def clear_chat_history(self, user_id: int, role_id: str = None):
         """清除聊天歷史"""
+        self.chat_history.clear(user_id, role_id)
+        self.storage.clear_history(user_id, role_id)
         if role_id:
-            if user_id in self.chat_history:
-                self.chat_history[user_id].pop(role_id, None)
-                logger.info(f"已清除用戶 {user_id} 的 {role_id} 角色歷史記錄")
-                # 如果用戶沒有其他角色的歷史記錄，清理用戶記錄
-                if not self.chat_history[user_id]:
-                    self.chat_history.pop(user_id, None)
+            logger.info("已清除用戶 %s 的 %s 角色歷史記錄", user_id, role_id)
         else:
-            # 清除用戶的所有歷史記錄
-            self.chat_history.pop(user_id, None)
-            logger.info(f"已清除用戶 {user_id} 的所有歷史記錄")
-    
-    def _clean_old_history(self, user_id: int, role_id: str):
-        """清理過期的聊天記錄"""
-        if user_id not in self.chat_history or role_id not in self.chat_history[user_id]:
-            return
-        
-        current_time = datetime.now()
-        history = self.chat_history[user_id][role_id]
-        
-        # 過濾掉過期的消息
-        valid_messages = [
-            msg for msg in history
-            if current_time - msg['timestamp'] < self.history_expiry
-        ]
-        
-        # 如果有消息被清理，記錄日誌
-        if len(valid_messages) < len(history):
-            logger.info(f"用戶 {user_id} 的 {role_id} 角清理了 {len(history) - len(valid_messages)} 條過期消息")
-        
-        self.chat_history[user_id][role_id] = valid_messages
-        
-        # 如果該角色的歷史記錄為空，清理整個角色記錄
-        if not valid_messages:
-            self.chat_history[user_id].pop(role_id, None)
-            logger.info(f"用戶 {user_id} 的 {role_id} 角色歷史記錄已清空")
-        
-        # 如果用戶沒有任何角色的歷史記錄，清理用戶記錄
-        if not self.chat_history[user_id]:
-            self.chat_history.pop(user_id, None)
-            logger.info(f"用戶 {user_id} 的所有歷史記錄已清空")
+            logger.info("已清除用戶 %s 的所有歷史記錄", user_id)
     
     def get_available_roles(self):
         """獲取所有可用角色列表"""
@@ -0,0 +1,307 @@
+import time
+import heapq
+import asyncio
+import logging
+from collections import deque
+from itertools import count
+from telegram.error import RetryAfter
+from .rate_limiter import TokenBucket
+from .metrics import SEND_QUEUE_WAIT_SECONDS, TELEGRAM_SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 發送優先級，數值小的先發：文字和編輯在前，語音上傳在後
+PRIORITY_TEXT = 0
+PRIORITY_VOICE = 1
+PRIORITY_NAMES = {PRIORITY_TEXT: "text", PRIORITY_VOICE: "voice"}
+
+
+class OutboundMessage:
+    """排隊中的一次發送，send() 是返回協程的函數"""
+    __slots__ = ('chat_id', 'send', 'priority', 'seq', 'key', 'future', 'queued_at', 'attempts', 'started')
+
+    def __init__(self, chat_id, send, priority: int, seq: int, key, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.send = send
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+        self.started = False
+
+    @property
+    def kind(self) -> str:
+        return PRIORITY_NAMES.get(self.priority, "text")
+
+
+class _ChatQueue:
+    __slots__ = ('chat_id', 'jobs', 'bucket', 'blocked_until', 'busy', 'scheduled')
+
+    def __init__(self, chat_id, bucket: TokenBucket):
+        self.chat_id = chat_id
+        self.jobs = deque()
+        self.bucket = bucket
+        self.blocked_until = 0.0
+        # busy：正在發送隊首消息；scheduled：已在就緒堆中或在等待定時器
+        self.busy = False
+        self.scheduled = False
+
+
+class SendQueue:
+    """發往 Telegram 的消息發送隊列
+
+    處理器把發送排入隊列後立即返回，由調度任務按 Telegram 的限制發出：
+    - 全局每秒最多 global_per_second 條，每個聊天按令牌桶每分鐘 chat_per_minute 條，
+      允許 chat_burst 條的短時突發
+    - 同一聊天按入隊順序逐條發送，編輯不會早於被編輯的消息
+    - 不同聊天之間文字優先於語音，同時進行的語音上傳不超過 max_uploads 個
+    - 收到 RetryAfter 時該聊天暫停指定的秒數後重發，不佔用處理器；全局發送同時暫停同樣的秒數
+      （不超過 max_retry_after），避免其他聊天在 Telegram 限流期間繼續觸發 429
+
+    submit() 返回發送結果的 Future；帶 key 提交時，同一聊天中尚未開始發送的
+    同 key 消息會被新內容取代（用於合併串流回覆的多次編輯）。
+    """
+
+    def __init__(self, global_per_second: float = 30, chat_per_minute: float = 60, chat_burst: int = 3,
+                 max_in_flight: int = 32, max_uploads: int = 4, max_retries: int = 5,
+                 max_retry_after: float = 60.0):
+        self.global_bucket = TokenBucket(global_per_second * 60, global_per_second)
+        self.chat_per_minute = chat_per_minute
+        self.chat_burst = chat_burst
+        self.max_in_flight = max_in_flight
+        self.max_uploads = max_uploads
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.replaced = 0
+        self._chats = {}
+        # 隊首可以發送的聊天：(優先級, 序號, chat_id)
+        self._ready = []
+        # 等待上傳名額的語音
+        self._deferred = []
+        self._seq = count()
+        self._pending = 0
+        self._in_flight = 0
+        self._uploads = 0
+        self._scheduler = None
+        self._tasks = set()
+        # 限流和清理聊天狀態的定時器，關閉時取消
+        self._timers = set()
+        # 收到 RetryAfter 後全局暫停發送到此時刻
+        self._paused_until = 0.0
+        # 在事件循環中按需創建
+        self._wakeup = None
+        self._drained = None
+
+    def submit(self, chat_id, send, priority: int = PRIORITY_TEXT, key=None) -> asyncio.Future:
+        """排入一次發送，必須在事件循環中調用"""
+        loop = asyncio.get_running_loop()
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            self._drained = asyncio.Event()
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatQueue(
+                chat_id, TokenBucket(self.chat_per_minute, self.chat_burst)
+            )
+
+        if key is not None:
+            for job in state.jobs:
+                if job.key == key and not job.started:
+                    job.send = send
+                    self.replaced += 1
+                    return job.future
+
+        job = OutboundMessage(chat_id, send, priority, next(self._seq), key, loop.create_future())
+        job.future.add_done_callback(_log_failure)
+        state.jobs.append(job)
+        self._pending += 1
+        self._drained.clear()
+        self._schedule_chat(state)
+        if self._scheduler is None:
+            self._scheduler = asyncio.create_task(self._run())
+        return job.future
+
+    def _schedule_chat(self, state: _ChatQueue):
+        """聊天的隊首可發送時放入就緒堆，否則等到限流或 RetryAfter 結束"""
+        if state.busy or state.scheduled:
+            return
+        if not state.jobs:
+            self._forget_later(state)
+            return
+        now = time.monotonic()
+        wait = max(state.bucket.wait_time(1, now), state.blocked_until - now)
+        state.scheduled = True
+        if wait > 0:
+            self._call_later(wait, self._timer_fired, state)
+            return
+        head = state.jobs[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, state.chat_id))
+        self._wakeup.set()
+
+    def _timer_fired(self, state: _ChatQueue):
+        state.scheduled = False
+        self._schedule_chat(state)
+
+    def _forget_later(self, state: _ChatQueue):
+        """空閒的聊天在令牌補滿後移除，避免為每個聊天常駐狀態"""
+        now = time.monotonic()
+        # wait_time 會先按經過的時間補充令牌
+        state.bucket.wait_time(0, now)
+        delay = max((state.bucket.capacity - state.bucket.tokens) / state.bucket.rate, state.blocked_until - now)
+        if delay <= 0:
+            self._forget(state)
+        else:
+            self._call_later(delay, self._forget, state)
+
+    def _call_later(self, delay: float, callback, state: _ChatQueue):
+        handle = None
+
+        def fire():
+            self._timers.discard(handle)
+            callback(state)
+
+        handle = asyncio.get_running_loop().call_later(delay, fire)
+        self._timers.add(handle)
+
+    def _forget(self, state: _ChatQueue):
+        if not state.jobs and not state.busy and self._chats.get(state.chat_id) is state:
+            del self._chats[state.chat_id]
+
+    async def _run(self):
+        while True:
+            # 等待有可發送的消息和空閒的發送名額
+            while not self._ready or self._in_flight >= self.max_in_flight:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            now = time.monotonic()
+            wait = max(self.global_bucket.wait_time(1, now), self._paused_until - now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            entry = heapq.heappop(self._ready)
+            state = self._chats[entry[2]]
+            job = state.jobs[0]
+            if job.priority == PRIORITY_VOICE and self._uploads >= self.max_uploads:
+                self._deferred.append(entry)
+                continue
+
+            state.scheduled = False
+            state.busy = True
+            self.global_bucket.consume(1)
+            state.bucket.consume(1)
+            self._in_flight += 1
+            if job.priority == PRIORITY_VOICE:
+                self._uploads += 1
+            task = asyncio.create_task(self._send(state, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, state: _ChatQueue, job: OutboundMessage):
+        started = time.monotonic()
+        if not job.attempts:
+            SEND_QUEUE_WAIT_SECONDS.observe(started - job.queued_at, job.kind)
+        job.started = True
+        outcome = "ok"
+        try:
+            result = await job.send()
+        except RetryAfter as e:
+            outcome = "retry_after"
+            job.attempts += 1
+            retry_after = float(e.retry_after)
+            now = time.monotonic()
+            state.blocked_until = now + retry_after
+            self._paused_until = max(self._paused_until, now + min(retry_after, self.max_retry_after))
+            if job.attempts > self.max_retries or retry_after > self.max_retry_after:
+                self._finish(state, job, error=e)
+            else:
+                # 留在隊首，限流結束後按原順序重發
+                self.retried += 1
+                job.started = False
+                logger.warning("聊天 %s 被 Telegram 限流，%.0f 秒後重發", state.chat_id, retry_after)
+        except Exception as e:
+            outcome = type(e).__name__
+            self._finish(state, job, error=e)
+        else:
+            self._finish(state, job, result=result)
+        finally:
+            TELEGRAM_SEND_SECONDS.observe(time.monotonic() - started, job.kind, outcome)
+            self._in_flight -= 1
+            if job.priority == PRIORITY_VOICE:
+                self._uploads -= 1
+                # 空出上傳名額，讓等待中的語音重新參與調度
+                for entry in self._deferred:
+                    heapq.heappush(self._ready, entry)
+                self._deferred.clear()
+            state.busy = False
+            self._schedule_chat(state)
+            self._wakeup.set()
+
+    def _finish(self, state: _ChatQueue, job: OutboundMessage, result=None, error: Exception = None):
+        state.jobs.popleft()
+        self._pending -= 1
+        if error is None:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        else:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+        if not self._pending:
+            self._drained.set()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def close(self, timeout: float = 30.0):
+        """等待隊列中的消息發送完畢，超時則放棄剩餘的消息"""
+        if self._scheduler is None:
+            return
+        if self._pending:
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("發送隊列未在 %s 秒內清空，放棄 %s 條消息", timeout, self._pending)
+        self._scheduler.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(self._scheduler, *self._tasks, return_exceptions=True)
+        self._scheduler = None
+        for handle in self._timers:
+            handle.cancel()
+        self._timers.clear()
+        for state in self._chats.values():
+            for job in state.jobs:
+                job.future.cancel()
+        self._chats.clear()
+        self._ready.clear()
+        self._deferred.clear()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._pending,
+            "in_flight": self._in_flight,
+            "uploads": self._uploads,
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "replaced": self.replaced,
+            "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 3),
+        }
+
+
+def _log_failure(future: asyncio.Future):
+    """沒有調用方等待結果時也記錄發送失敗"""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logger.warning("發送消息失敗: %s", error)
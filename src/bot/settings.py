@@ -0,0 +1,71 @@
+import os
+import importlib.util
+from types import MappingProxyType
+
+# 配置文件必須提供的設置
+REQUIRED_SETTINGS = ("BOT_TOKEN", "OPENAI_API_KEY", "ROLES")
+# 每個角色必須提供的文字字段
+ROLE_TEXT_FIELDS = ("name", "description", "prompt")
+# 選擇角色的按鈕回調數據為 "select_role_<角色 ID>"，Telegram 限制為 64 字節
+MAX_ROLE_ID_BYTES = 64 - len("select_role_")
+
+
+class ConfigError(Exception):
+    """配置文件不存在或內容無效"""
+
+
+def freeze(value):
+    """把字典和列表遞歸轉為只讀的 MappingProxyType 和 tuple"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def _valid_budget(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def validate_roles(roles) -> MappingProxyType:
+    """校驗角色配置，返回只讀的 {角色 ID: 角色} 映射"""
+    if not isinstance(roles, dict) or not roles:
+        raise ConfigError("ROLES 必須是非空的字典")
+    for role_id, role in roles.items():
+        if not isinstance(role_id, str) or not role_id or len(role_id.encode("utf-8")) > MAX_ROLE_ID_BYTES:
+            raise ConfigError(f"角色 ID {role_id!r} 必須是不超過 {MAX_ROLE_ID_BYTES} 字節的非空字符串")
+        if not isinstance(role, dict):
+            raise ConfigError(f"角色 {role_id} 的配置必須是字典")
+        for field in ROLE_TEXT_FIELDS:
+            value = role.get(field)
+            if not isinstance(value, str) or not value.strip():
+                raise ConfigError(f"角色 {role_id} 缺少 {field} 或不是文字")
+        budget = role.get("context_tokens")
+        if budget is not None:
+            budgets = budget.values() if isinstance(budget, dict) else (budget,)
+            if not all(_valid_budget(item) for item in budgets):
+                raise ConfigError(f"角色 {role_id} 的 context_tokens 必須是正整數或 {{模型: 正整數}}")
+    return freeze(roles)
+
+
+def load_config(path: str) -> MappingProxyType:
+    """讀取配置文件，返回只讀的 {設置名: 值} 映射，只包含大寫的名稱
+
+    配置文件是從環境變量讀取設置的普通 Python 模塊，通過 importlib 加載，
+    字節碼緩存在 __pycache__ 中，不重複編譯源碼。ROLES 在這裡一次性校驗，
+    字典和列表都轉為只讀結構，運行中不會被意外修改。
+    """
+    if not os.path.isfile(path):
+        raise ConfigError(f"配置文件不存在: {path}")
+    spec = importlib.util.spec_from_file_location("bot_config", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    settings = {name: value for name, value in vars(module).items() if name.isupper()}
+    missing = [name for name in REQUIRED_SETTINGS if name not in settings]
+    if missing:
+        raise ConfigError(f"配置文件缺少 {', '.join(missing)}")
+    roles = validate_roles(settings.pop("ROLES"))
+    settings = {name: freeze(value) for name, value in settings.items()}
+    settings["ROLES"] = roles
+    return MappingProxyType(settings)
@@ -0,0 +1,310 @@
+import json
+import time
+import queue
+import asyncio
+import hashlib
+import logging
+import threading
+import multiprocessing
+from bisect import bisect
+from telegram import Update
+from telegram.error import TelegramError
+from .webhook import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+# 工作進程收到空消息時處理完已接收的更新後退出
+STOP_MESSAGE = b""
+_CLOSE = object()
+
+
+def routing_key(data: dict) -> int:
+    """從原始更新中取出用戶 ID，沒有用戶時使用聊天 ID
+
+    直接讀取 JSON，不在分派進程中構造 Update 對象。
+    """
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if sender:
+            return sender["id"]
+        chat = value.get("chat")
+        if chat:
+            return chat["id"]
+    return data.get("update_id", 0)
+
+
+class HashRing:
+    """一致性哈希環，每個工作進程佔 virtual_nodes 個虛擬節點
+
+    路由只取決於工作進程編號，進程重啟後用戶仍落在同一個工作進程；
+    調整工作進程數時只有約 1/N 的用戶需要換到新的進程。
+    """
+
+    def __init__(self, workers: int, virtual_nodes: int = 128):
+        points = []
+        for worker in range(workers):
+            for replica in range(virtual_nodes):
+                points.append((self._hash(f"worker-{worker}#{replica}"), worker))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._workers = [worker for _, worker in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def lookup(self, key) -> int:
+        index = bisect(self._points, self._hash(str(key)))
+        return self._workers[index % len(self._workers)]
+
+
+class WorkerChannel:
+    """分派進程到一個工作進程的更新通道
+
+    更新先進入進程內隊列，由發送線程按順序寫入管道，分派進程的事件循環不會被
+    管道緩衝區阻塞。工作進程重啟期間更新留在隊列中，新進程接上管道後繼續發送，
+    同一用戶的更新不丟失也不亂序。
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.sent = 0
+        self.dropped = 0
+        self._queue = queue.Queue()
+        self._conn = None
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"shard-{index}-sender", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def attach(self, conn):
+        """接上新工作進程的管道"""
+        with self._condition:
+            self._conn = conn
+            self._condition.notify_all()
+
+    def detach(self):
+        """工作進程退出後斷開管道，未發送的更新留在隊列中"""
+        with self._condition:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()
+
+    def put(self, data: dict):
+        self._queue.put(data)
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self, timeout: float = None):
+        """發送完隊列中的更新後通知工作進程退出"""
+        self._queue.put(_CLOSE)
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def _wait_conn(self):
+        with self._condition:
+            while self._conn is None and not self._closing:
+                self._condition.wait()
+            return self._conn
+
+    def _run(self):
+        item = None
+        while True:
+            if item is None:
+                item = self._queue.get()
+            conn = self._wait_conn()
+            if conn is None:
+                # 正在關閉且工作進程已退出，剩餘的更新無法送達
+                if item is not _CLOSE:
+                    self.dropped += self._queue.qsize()
+                    logger.warning("工作進程 %s 已退出，丟棄 %s 條未發送的更新", self.index, self.dropped)
+                return
+            try:
+                if item is _CLOSE:
+                    conn.send_bytes(STOP_MESSAGE)
+                    return
+                conn.send_bytes(json.dumps(item, ensure_ascii=False).encode("utf-8"))
+            except (OSError, EOFError):
+                # 工作進程已退出，等待監督者接上新的管道後重發
+                with self._condition:
+                    if self._conn is conn:
+                        self._conn = None
+                if item is _CLOSE:
+                    return
+                continue
+            self.sent += 1
+            item = None
+
+
+class ShardDispatcher:
+    """把更新按用戶一致性哈希分派到多個工作進程，並監督工作進程
+
+    每個用戶的全部更新都由同一個工作進程處理，該進程獨佔這些用戶的內存狀態。
+    工作進程意外退出時按指數退避重啟，期間發往它的更新在通道中排隊。
+    worker_target(index, conn) 在子進程中運行，從 conn 接收 JSON 編碼的更新。
+    """
+
+    def __init__(self, worker_target, workers: int, restart_delay: float = 1.0,
+                 max_restart_delay: float = 30.0, virtual_nodes: int = 128):
+        self.worker_target = worker_target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.ring = HashRing(workers, virtual_nodes)
+        self.channels = [WorkerChannel(index) for index in range(workers)]
+        self.routed = [0] * workers
+        self.restarts = [0] * workers
+        self._processes = [None] * workers
+        self._started_at = [0.0] * workers
+        self._delays = [0.0] * workers
+        self._restart_at = [None] * workers
+        # 子進程重新導入模塊，不繼承分派進程的事件循環和線程
+        self._context = multiprocessing.get_context("spawn")
+
+    def start(self):
+        for index, channel in enumerate(self.channels):
+            channel.start()
+            self._spawn(index)
+        logger.info("已啟動 %s 個工作進程", self.workers)
+
+    def _spawn(self, index: int):
+        reader, writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=self.worker_target, args=(index, reader), name=f"bot-worker-{index}"
+        )
+        process.start()
+        reader.close()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        self.channels[index].attach(writer)
+
+    def dispatch(self, data: dict):
+        index = self.ring.lookup(routing_key(data))
+        self.routed[index] += 1
+        self.channels[index].put(data)
+
+    def pending(self) -> int:
+        return sum(channel.pending for channel in self.channels)
+
+    def alive_workers(self) -> int:
+        return sum(1 for process in self._processes if process is not None and process.is_alive())
+
+    def check_workers(self):
+        """重啟已退出的工作進程，啟動後很快又退出的按指數退避"""
+        now = time.monotonic()
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            if self._restart_at[index] is None:
+                process.join(0)
+                self.channels[index].detach()
+                if now - self._started_at[index] >= self.max_restart_delay:
+                    self._delays[index] = self.restart_delay
+                else:
+                    self._delays[index] = min(
+                        max(self._delays[index] * 2, self.restart_delay), self.max_restart_delay
+                    )
+                self._restart_at[index] = now + self._delays[index]
+                logger.warning(
+                    "工作進程 %s 已退出（退出碼 %s），%.0f 秒後重啟，排隊更新 %s 條",
+                    index, process.exitcode, self._delays[index], self.channels[index].pending
+                )
+            elif now >= self._restart_at[index]:
+                self._restart_at[index] = None
+                self.restarts[index] += 1
+                self._spawn(index)
+                logger.info("工作進程 %s 已重啟", index)
+
+    async def supervise(self, interval: float = 1.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.check_workers()
+
+    async def stop(self, timeout: float = 30.0):
+        """通知所有工作進程處理完已接收的更新後退出，超時則強制終止"""
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        await asyncio.gather(*(
+            loop.run_in_executor(None, channel.close, timeout) for channel in self.channels
+        ))
+        for index, process in enumerate(self._processes):
+            remaining = max(0.0, deadline - time.monotonic())
+            await loop.run_in_executor(None, process.join, remaining)
+            if process.is_alive():
+                logger.warning("工作進程 %s 未在 %s 秒內退出，強制終止", index, timeout)
+                process.terminate()
+                await loop.run_in_executor(None, process.join, 5)
+
+    def stats(self) -> dict:
+        return {
+            str(index): {
+                "alive": self._processes[index] is not None and self._processes[index].is_alive(),
+                "routed": self.routed[index],
+                "sent": channel.sent,
+                "queued": channel.pending,
+                "dropped": channel.dropped,
+                "restarts": self.restarts[index],
+            }
+            for index, channel in enumerate(self.channels)
+        }
+
+
+class DispatchWebhookServer(WebhookServer):
+    """分片模式的 Webhook 服務：不解析更新，直接轉發給對應的工作進程"""
+
+    def __init__(self, dispatcher: ShardDispatcher, listen: str, port: int, path: str,
+                 secret_token: str):
+        super().__init__(None, listen, port, path, secret_token)
+        self.dispatcher = dispatcher
+
+    async def deliver(self, data: dict):
+        self.dispatcher.dispatch(data)
+
+    def pending(self) -> int:
+        return self.dispatcher.pending()
+
+    def running(self) -> bool:
+        return self.dispatcher.alive_workers() > 0
+
+
+class UpdatePoller:
+    """分片模式下用 getUpdates 長輪詢接收更新並交給分派器"""
+
+    def __init__(self, bot, dispatcher: ShardDispatcher, timeout: int = 30):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.timeout = timeout
+        self.offset = None
+
+    async def run(self):
+        # 不丟棄重啟期間積壓的更新
+        await self.bot.delete_webhook(drop_pending_updates=False)
+        while True:
+            try:
+                updates = await self.bot.get_updates(
+                    offset=self.offset, timeout=self.timeout, allowed_updates=Update.ALL_TYPES
+                )
+            except TelegramError as e:
+                logger.warning("獲取更新失敗: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.dispatcher.dispatch(update.to_dict())
+                self.offset = update.update_id + 1
+
+    async def confirm(self):
+        """確認已分派的更新，重啟後不會重複收到"""
+        if self.offset is None:
+            return
+        try:
+            await self.bot.get_updates(offset=self.offset, timeout=0, limit=1)
+        except TelegramError as e:
+            logger.warning("確認更新失敗: %s", e)
@@ -0,0 +1,292 @@
+import time
+import sqlite3
+import asyncio
+import logging
+from pathlib import Path
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStorage:
+    """會話存儲接口
+
+    寫入方法都是同步的且不阻塞，只負責把操作排入隊列；
+    讀取方法是協程，在首次收到用戶消息時按需加載。
+    """
+
+    async def start(self):
+        """打開存儲"""
+
+    async def close(self):
+        """寫出剩餘數據並關閉存儲"""
+
+    async def flush(self):
+        """等待已排隊的寫入完成"""
+
+    async def load_user(self, user_id: int):
+        """加載用戶狀態，不存在時返回 None
+
+        返回 {"role_id", "custom_name", "voice_mode", "history", "summaries"}，
+        其中 history 為 {role_id: [(role, content, created_at), ...]}，
+        created_at 為 Unix 時間戳；summaries 為 {role_id: 摘要}。
+        """
+        return None
+
+    def save_user(self, user_id: int, role_id: str, custom_name: str, voice_mode: bool):
+        """保存用戶的角色、稱呼和語音模式"""
+
+    def append_message(self, user_id: int, role_id: str, role: str, content: str, created_at: float):
+        """追加一條聊天記錄"""
+
+    def clear_history(self, user_id: int, role_id: str = None):
+        """清除用戶某個角色或全部角色的聊天記錄"""
+
+    def save_summary(self, user_id: int, role_id: str, summary: str, covered_until: float):
+        """保存對話摘要，並刪除摘要已涵蓋的（created_at 不晚於 covered_until）記錄"""
+
+
+class MemoryStorage(SessionStorage):
+    """不做持久化，狀態只保存在進程內存中"""
+
+
+class SQLiteStorage(SessionStorage):
+    """基於 SQLite WAL 的會話存儲，寫入在後台批量提交
+
+    所有數據庫操作都在專用的單線程執行器中完成，事件循環不會等待磁盤。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        role_id TEXT,
+        custom_name TEXT,
+        voice_mode INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        role_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, role_id, id);
+    CREATE INDEX IF NOT EXISTS idx_messages_created ON messages (created_at);
+    CREATE TABLE IF NOT EXISTS summaries (
+        user_id INTEGER NOT NULL,
+        role_id TEXT NOT NULL,
+        content TEXT NOT NULL,
+        covered_until REAL NOT NULL,
+        PRIMARY KEY (user_id, role_id)
+    );
+    """
+
+    # 清理過期記錄的間隔（秒）
+    PURGE_INTERVAL = 3600
+    APPEND_SQL = "INSERT INTO messages (user_id, role_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)"
+    # 刪除對話中最新 max_history_length 條之前的記錄，與內存中的環形緩衝區保持一致
+    TRIM_SQL = (
+        "DELETE FROM messages WHERE user_id = ? AND role_id = ? AND id <= ("
+        "SELECT id FROM messages WHERE user_id = ? AND role_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)"
+    )
+    # 寫入失敗後重試的最長間隔（秒），從 flush_interval 開始逐次加倍
+    MAX_RETRY_DELAY = 30.0
+
+    def __init__(self, path: str, expiry_seconds: float, max_history_length: int,
+                 flush_interval: float = 0.05):
+        self.path = path
+        self.expiry_seconds = expiry_seconds
+        self.max_history_length = max_history_length
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        self._pending = []
+        self._wakeup = None
+        self._flusher = None
+        self._last_purge = 0.0
+        self.written_ops = 0
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        await self._run(self._open)
+        self._flusher = asyncio.create_task(self._flush_loop())
+        logger.info("會話存儲已打開: %s", self.path)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("關閉時寫入會話存儲失敗，丟棄 %s 條操作: %s", len(self._pending), e)
+            self._pending = []
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+        logger.info("會話存儲已關閉，共寫入 %s 條操作", self.written_ops)
+
+    async def flush(self):
+        """寫入失敗時操作放回隊列最前面，保持順序，由下一次 flush 重試
+
+        被取消時執行器中的寫入仍會完成，不放回隊列，避免重複寫入。
+        """
+        if not self._pending:
+            return
+        ops, self._pending = self._pending, []
+        try:
+            await self._run(self._write_batch, ops)
+        except Exception:
+            self._pending[:0] = ops
+            raise
+
+    async def load_user(self, user_id: int):
+        # 先寫出該用戶尚未提交的操作，保證讀到最新狀態
+        await self.flush()
+        return await self._run(self._load_user, user_id)
+
+    def save_user(self, user_id: int, role_id: str, custom_name: str, voice_mode: bool):
+        self._enqueue((
+            "INSERT INTO users (user_id, role_id, custom_name, voice_mode) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET role_id = excluded.role_id, "
+            "custom_name = excluded.custom_name, voice_mode = excluded.voice_mode",
+            (user_id, role_id, custom_name, int(voice_mode))
+        ))
+
+    def append_message(self, user_id: int, role_id: str, role: str, content: str, created_at: float):
+        self._enqueue((self.APPEND_SQL, (user_id, role_id, role, content, created_at)))
+
+    def clear_history(self, user_id: int, role_id: str = None):
+        if role_id is None:
+            self._enqueue(("DELETE FROM messages WHERE user_id = ?", (user_id,)))
+            self._enqueue(("DELETE FROM summaries WHERE user_id = ?", (user_id,)))
+        else:
+            self._enqueue(("DELETE FROM messages WHERE user_id = ? AND role_id = ?", (user_id, role_id)))
+            self._enqueue(("DELETE FROM summaries WHERE user_id = ? AND role_id = ?", (user_id, role_id)))
+
+    def save_summary(self, user_id: int, role_id: str, summary: str, covered_until: float):
+        self._enqueue((
+            "INSERT INTO summaries (user_id, role_id, content, covered_until) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id, role_id) DO UPDATE SET content = excluded.content, "
+            "covered_until = excluded.covered_until",
+            (user_id, role_id, summary, covered_until)
+        ))
+        self._enqueue((
+            "DELETE FROM messages WHERE user_id = ? AND role_id = ? AND created_at <= ?",
+            (user_id, role_id, covered_until)
+        ))
+
+    def _enqueue(self, op: tuple):
+        self._pending.append(op)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _flush_loop(self):
+        """攢批寫入：有新操作時等待一個批次窗口，然後一次事務提交；失敗時退避重試"""
+        delay = self.flush_interval
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(delay)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                delay = min(max(delay, 0.05) * 2, self.MAX_RETRY_DELAY)
+                logger.error("寫入會話存儲失敗，%s 條操作將在 %.2f 秒後重試: %s", len(self._pending), delay, e)
+                self._wakeup.set()
+            else:
+                delay = self.flush_interval
+
+    def _open(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(self.SCHEMA)
+
+    def _write_batch(self, ops: list):
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            # 連續的同類操作合併為一次 executemany
+            for sql, group in groupby(ops, key=itemgetter(0)):
+                conn.executemany(sql, [params for _, params in group])
+            # 本批有新消息的對話只保留最新的 max_history_length 條
+            appended = {params[:2] for sql, params in ops if sql == self.APPEND_SQL}
+            conn.executemany(self.TRIM_SQL, [
+                (user_id, role_id, user_id, role_id, self.max_history_length) for user_id, role_id in appended
+            ])
+            now = time.time()
+            if now - self._last_purge > self.PURGE_INTERVAL:
+                conn.execute("DELETE FROM messages WHERE created_at < ?", (now - self.expiry_seconds,))
+                # 對話記錄全部過期後，摘要也一併清除
+                conn.execute(
+                    "DELETE FROM summaries WHERE NOT EXISTS (SELECT 1 FROM messages m "
+                    "WHERE m.user_id = summaries.user_id AND m.role_id = summaries.role_id)"
+                )
+                self._last_purge = now
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.written_ops += len(ops)
+
+    def _load_user(self, user_id: int):
+        conn = self._conn
+        row = conn.execute(
+            "SELECT role_id, custom_name, voice_mode FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        # 每個角色只讀取最新的 max_history_length 條
+        rows = conn.execute(
+            "SELECT role_id, role, content, created_at FROM ("
+            "SELECT id, role_id, role, content, created_at, "
+            "ROW_NUMBER() OVER (PARTITION BY role_id ORDER BY id DESC) AS recency FROM messages "
+            "WHERE user_id = ? AND created_at > ?"
+            ") WHERE recency <= ? ORDER BY id",
+            (user_id, time.time() - self.expiry_seconds, self.max_history_length)
+        ).fetchall()
+        if row is None and not rows:
+            return None
+
+        summaries = {}
+        for role_id, content, covered_until in conn.execute(
+            "SELECT role_id, content, covered_until FROM summaries WHERE user_id = ?", (user_id,)
+        ):
+            summaries[role_id] = (content, covered_until)
+
+        history = {}
+        for role_id, role, content, created_at in rows:
+            # 跳過已被摘要涵蓋、但尚未從表中刪除的記錄
+            if role_id in summaries and created_at <= summaries[role_id][1]:
+                continue
+            history.setdefault(role_id, []).append((role, content, created_at))
+        for role_id, messages in history.items():
+            history[role_id] = messages[-self.max_history_length:]
+
+        return {
+            "role_id": row[0] if row else None,
+            "custom_name": row[1] if row else None,
+            "voice_mode": bool(row[2]) if row else False,
+            "history": history,
+            "summaries": {role_id: content for role_id, (content, _) in summaries.items()},
+        }
+
+
+def create_storage(backend: str, path: str, expiry_seconds: float, max_history_length: int,
+                   flush_interval: float = 0.05) -> SessionStorage:
+    """根據配置創建會話存儲"""
+    if backend == "sqlite":
+        return SQLiteStorage(path, expiry_seconds, max_history_length, flush_interval)
+    if backend != "memory":
+        logger.warning("未知的存儲後端 %s，改用內存存儲", backend)
+    return MemoryStorage()
@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INSTRUCTIONS = """你負責整理角色扮演聊天的記憶。請把已有摘要和新的對話內容合併成一份新的摘要：
+- 保留用戶的個人信息、偏好、重要事件、雙方的約定和尚未結束的話題
+- 省略寒暄和重複的內容
+- 以第三人稱書寫，只輸出摘要本身，不超過 {max_chars} 字"""
+
+SPEAKERS = {"user": "用戶", "assistant": "角色"}
+
+
+class ConversationSummarizer:
+    """在後台把較早的對話壓縮成滾動摘要
+
+    每次回覆寫入歷史後檢查對話長度，超過閾值時在後台任務中調用模型，
+    把除最近 keep_recent 條以外的消息與已有摘要合併。請求路徑從不等待摘要，
+    摘要完成前照常按 token 預算發送完整的歷史記錄。
+    摘要失敗或被截斷後，同一段對話在冷卻期內不再觸發壓縮，連續失敗時冷卻期逐次加倍。
+    """
+
+    # 失敗後的冷卻秒數，連續失敗時加倍，不超過 MAX_COOLDOWN
+    COOLDOWN = 60.0
+    MAX_COOLDOWN = 3600.0
+
+    def __init__(self, role_manager, api, model: str, rate_limits,
+                 threshold_tokens: int, keep_recent: int, max_tokens: int, trigger_length: int = 0):
+        self.role_manager = role_manager
+        self.api = api
+        self.model = model
+        self.rate_limits = rate_limits
+        self.threshold_tokens = threshold_tokens
+        self.keep_recent = max(1, keep_recent)
+        self.max_tokens = max_tokens
+        # 消息條數達到此值時也觸發壓縮，避免環形緩衝區直接丟棄最舊的消息
+        self.trigger_length = trigger_length
+        self._tasks = {}
+        # (user_id, role_id) -> (可以再次壓縮的單調時鐘時間, 連續失敗次數)
+        self._cooldowns = {}
+        self.compactions = 0
+        self.compacted_messages = 0
+        self.failures = 0
+        self.truncated = 0
+
+    def maybe_compact(self, user_id: int, role_id: str):
+        """對話超過閾值時安排後台壓縮，同一段對話同時只有一個任務"""
+        key = (user_id, role_id)
+        if key in self._tasks:
+            return
+        cooldown = self._cooldowns.get(key)
+        if cooldown is not None and time.monotonic() < cooldown[0]:
+            return
+        history = self.role_manager.get_chat_history(user_id, role_id)
+        if len(history) <= self.keep_recent:
+            return
+        if not (self.trigger_length and len(history) >= self.trigger_length):
+            builder = self.role_manager.context_builder
+            tokens = sum(builder.message_tokens(message, self.model) for message in history)
+            if tokens < self.threshold_tokens:
+                return
+
+        task = asyncio.create_task(self._compact(user_id, role_id))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def close(self):
+        """取消進行中的壓縮任務，未完成的對話下次觸發時重新壓縮"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._tasks),
+            "compactions": self.compactions,
+            "compacted_messages": self.compacted_messages,
+            "failures": self.failures,
+            "truncated": self.truncated,
+            "cooling_down": len(self._cooldowns),
+        }
+
+    def _back_off(self, key: tuple):
+        """記錄一次失敗，冷卻期內不再壓縮這段對話"""
+        now = time.monotonic()
+        if len(self._cooldowns) >= 10000:
+            # 清理已過冷卻期的條目，避免為不再活躍的對話常駐狀態
+            self._cooldowns = {k: v for k, v in self._cooldowns.items() if v[0] > now}
+        _, streak = self._cooldowns.get(key, (0.0, 0))
+        delay = min(self.COOLDOWN * (2 ** streak), self.MAX_COOLDOWN)
+        self._cooldowns[key] = (now + delay, streak + 1)
+
+    def build_request(self, summary: str, messages: list) -> list:
+        """組裝摘要請求的消息列表"""
+        transcript = "\n".join(
+            f"{SPEAKERS.get(message.role, message.role)}：{message.content}" for message in messages
+        )
+        parts = []
+        if summary:
+            parts.append(f"已有摘要：\n{summary}")
+        parts.append(f"新的對話：\n{transcript}")
+        return [
+            # 中文每個字約佔 1～2 個 token，按 token 上限的一半限制字數
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(max_chars=self.max_tokens // 2)},
+            {"role": "user", "content": "\n\n".join(parts)},
+        ]
+
+    async def _compact(self, user_id: int, role_id: str):
+        history = self.role_manager.get_chat_history(user_id, role_id)
+        older = history[:len(history) - self.keep_recent]
+        if not older:
+            return
+
+        summary = self.role_manager.chat_history.get_summary(user_id, role_id)
+        request = self.build_request(summary, older)
+        builder = self.role_manager.context_builder
+        estimated = sum(builder.count_tokens(message["content"], self.model) for message in request) + self.max_tokens
+        if not await self.rate_limits.acquire("summary", user_id, estimated):
+            logger.debug("摘要服務額度不足，稍後再壓縮用戶 %s 的 %s 對話", user_id, role_id)
+            return
+
+        try:
+            response = await self.api.call(
+                "summary",
+                self.api.client.chat.completions.create,
+                model=self.model,
+                messages=request,
+                temperature=0.3,
+                max_tokens=self.max_tokens
+            )
+        except Exception as e:
+            self.failures += 1
+            # 請求失敗時退還預留的額度
+            self.rate_limits.settle("summary", estimated, 0)
+            self._back_off((user_id, role_id))
+            logger.warning("生成對話摘要失敗: %s", e)
+            return
+
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.rate_limits.settle("summary", estimated, usage.total_tokens)
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            # 被截斷的摘要會丟失信息，保留原來的記錄，下次觸發時重新壓縮
+            self.truncated += 1
+            self._back_off((user_id, role_id))
+            logger.warning("用戶 %s 的 %s 對話摘要超出 %s token 被截斷，已丟棄", user_id, role_id, self.max_tokens)
+            return
+        new_summary = (choice.message.content or "").strip()
+        if not new_summary:
+            self._back_off((user_id, role_id))
+            return
+
+        self._cooldowns.pop((user_id, role_id), None)
+        removed = self.role_manager.compact_chat_history(user_id, role_id, new_summary, older[-1])
+        if removed:
+            self.compactions += 1
+            self.compacted_messages += removed
+            logger.debug("用戶 %s 的 %s 對話壓縮了 %s 條消息", user_id, role_id, removed)
@@ -0,0 +1,72 @@
+import re
+
+# 句末標點（含中文標點），英文句號需後接空白或位於結尾
+SENTENCE_END = re.compile(r'([。！？!?；;…\n]+|\.(?=\s|$))')
+# 句子過長時的次級切分點
+CLAUSE_END = re.compile(r'([，,、：:]+)')
+
+
+def _split_keep(pattern, text: str) -> list:
+    """按標點切分，標點保留在前一段末尾"""
+    parts = pattern.split(text)
+    pieces = []
+    for i in range(0, len(parts), 2):
+        piece = parts[i] + (parts[i + 1] if i + 1 < len(parts) else "")
+        if piece.strip():
+            pieces.append(piece.strip())
+    return pieces
+
+
+def _limit_length(sentence: str, max_chars: int) -> list:
+    """把超長句子按分句標點或固定長度拆開"""
+    if len(sentence) <= max_chars:
+        return [sentence]
+    pieces = []
+    current = ""
+    for clause in _split_keep(CLAUSE_END, sentence):
+        while len(clause) > max_chars:
+            pieces.append(clause[:max_chars])
+            clause = clause[max_chars:]
+        if current and len(current) + len(clause) > max_chars:
+            pieces.append(current)
+            current = ""
+        current = _join(current, clause)
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _join(left: str, right: str) -> str:
+    """拼接片段，英文句子之間補回空格"""
+    if left and left[-1].isascii() and right[0].isascii():
+        return f"{left} {right}"
+    return left + right
+
+
+def split_sentences(text: str, first_chars: int = 20, min_chars: int = 80, max_chars: int = 300) -> list:
+    """在句子邊界把文本切成適合逐段合成語音的片段
+
+    第一段只需湊滿 first_chars 個字符，以便盡快開始播放；
+    之後的片段合併到至少 min_chars 個字符，減少調用次數。
+    """
+    sentences = []
+    for sentence in _split_keep(SENTENCE_END, text):
+        sentences.extend(_limit_length(sentence, max_chars))
+
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        target = first_chars if not chunks else min_chars
+        if current and len(current) + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = _join(current, sentence)
+        if len(current) >= target:
+            chunks.append(current)
+            current = ""
+    if current:
+        if chunks and len(chunks[-1]) + len(current) <= max_chars:
+            chunks[-1] = _join(chunks[-1], current)
+        else:
+            chunks.append(current)
+    return chunks
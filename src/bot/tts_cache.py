@@ -0,0 +1,178 @@
+import os
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTSCache:
+    """語音合成結果的內容尋址緩存
+
+    鍵由 (模型, 聲音, 語速, 規範化文本) 計算得出。查找順序為：
+    已上傳到 Telegram 的 file_id、內存層、磁盤 LRU 層。
+    磁盤讀寫都在線程中執行，不阻塞事件循環。
+    """
+
+    # 最多記住的 Telegram file_id 數量
+    MAX_FILE_IDS = 10000
+
+    def __init__(self, directory: str, memory_bytes: int, disk_bytes: int):
+        self.directory = Path(directory)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self._file_ids = OrderedDict()
+        self._writes = set()
+        self._writing = set()
+        self.hits = {"file_id": 0, "memory": 0, "disk": 0}
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, voice: str, speed: float, text: str) -> str:
+        """計算緩存鍵，文本的首尾空白和連續空白不影響結果"""
+        normalized = " ".join(text.split())
+        raw = f"{model}\0{voice}\0{speed}\0{normalized}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def start(self):
+        """掃描磁盤緩存目錄，按修改時間重建 LRU 順序"""
+        if self.disk_bytes <= 0:
+            return
+        entries = await asyncio.to_thread(self._scan)
+        for key, size in entries:
+            self._disk[key] = size
+            self._disk_size += size
+        logger.info("TTS 磁盤緩存: %s 個文件，共 %s KB", len(self._disk), self._disk_size // 1024)
+        await self._evict_disk()
+
+    async def close(self):
+        """等待進行中的磁盤寫入完成"""
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def get_file_id(self, key: str):
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            self.hits["file_id"] += 1
+        return file_id
+
+    def set_file_id(self, key: str, file_id: str):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        if len(self._file_ids) > self.MAX_FILE_IDS:
+            self._file_ids.popitem(last=False)
+
+    async def get(self, key: str):
+        """從內存或磁盤獲取音頻，未命中返回 None"""
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.hits["memory"] += 1
+            return data
+
+        if key in self._disk:
+            try:
+                data = await asyncio.to_thread(self._path(key).read_bytes)
+            except OSError:
+                self._forget_disk(key)
+            else:
+                self._disk.move_to_end(key)
+                self._remember(key, data)
+                self.hits["disk"] += 1
+                return data
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        """寫入內存層，並在後台寫入磁盤層"""
+        self._remember(key, data)
+        if self.disk_bytes <= 0 or key in self._disk or key in self._writing or len(data) > self.disk_bytes:
+            return
+        self._writing.add(key)
+        task = asyncio.create_task(self._write_disk(key, data))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    def stats(self) -> dict:
+        return {
+            **{f"hits_{tier}": count for tier, count in self.hits.items()},
+            "misses": self.misses,
+            "memory_bytes": self._memory_size,
+            "disk_bytes": self._disk_size,
+        }
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    async def _write_disk(self, key: str, data: bytes):
+        try:
+            await asyncio.to_thread(self._write_file, key, data)
+        except OSError as e:
+            logger.warning("寫入 TTS 磁盤緩存失敗: %s", e)
+            return
+        finally:
+            self._writing.discard(key)
+        self._disk[key] = len(data)
+        self._disk_size += len(data)
+        await self._evict_disk()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.mp3"
+
+    def _forget_disk(self, key: str):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+
+    def _scan(self) -> list:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        files.sort()
+        return [(key, size) for _, key, size in files]
+
+    def _write_file(self, key: str, data: bytes):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        # 多個工作進程共用緩存目錄，臨時文件名帶上進程號
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    async def _evict_disk(self):
+        """淘汰最久未使用的文件，直到不超過磁盤上限"""
+        victims = []
+        while self._disk_size > self.disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            victims.append(self._path(key))
+        if victims:
+            await asyncio.to_thread(self._delete_files, victims)
+
+    @staticmethod
+    def _delete_files(paths: list):
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
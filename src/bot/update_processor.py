@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """並行處理不同聊天的更新，同一聊天內的更新按到達順序串行處理
+
+    先取得聊天鎖再佔用全局並發名額，排隊中的同聊天更新不會佔住名額。
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [鎖, 引用數]，沒有更新在處理或排隊時移除
+        self._chat_locks = {}
+
+    @staticmethod
+    def _chat_key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update: object, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock 按先來先得喚醒，保證同一聊天的處理順序
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
+
+    async def do_process_update(self, update: object, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def active_chats(self) -> int:
+        """正在處理或排隊的聊天數"""
+        return len(self._chat_locks)
+
+    def stats(self) -> dict:
+        return {
+            "active_chats": len(self._chat_locks),
+            "pending_updates": sum(entry[1] for entry in self._chat_locks.values()),
+        }
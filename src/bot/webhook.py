@@ -0,0 +1,139 @@
+import hmac
+import json
+import logging
+from aiohttp import web
+from telegram import Update
+from .metrics import REGISTRY
+from .diagnostics import ProfilerBusyError
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """內嵌 aiohttp 的 Webhook 服務，把收到的更新放入 Application 的隊列
+
+    端口對公網開放，只接受請求頭中帶有 secret_token 的更新，不提供空密鑰的選項。
+    """
+
+    def __init__(self, application, listen: str, port: int, path: str, secret_token: str):
+        if not secret_token:
+            raise ValueError("Webhook 模式必須設置 secret_token")
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.accepting = True
+        self.received = 0
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get("/healthz", self.handle_health)
+        self._runner = None
+
+    def add_get(self, path: str, handler):
+        """註冊額外的 GET 路由"""
+        self.app.router.add_get(path, handler)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """接收 Telegram 推送的更新"""
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            return web.Response(status=403)
+        if not self.accepting:
+            # 關閉中返回 503，Telegram 會稍後重新投遞
+            return web.Response(status=503)
+
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400)
+
+        await self.deliver(data)
+        self.received += 1
+        return web.Response()
+
+    async def deliver(self, data: dict):
+        """把更新放入 Application 的隊列"""
+        update = Update.de_json(data, self.application.bot)
+        await self.application.update_queue.put(update)
+
+    def pending(self) -> int:
+        return self.application.update_queue.qsize()
+
+    def running(self) -> bool:
+        return self.application.running
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """健康檢查"""
+        status = 200 if self.accepting and self.running() else 503
+        return web.json_response({
+            "status": "ok" if status == 200 else "draining",
+            "pending": self.pending(),
+            "received": self.received,
+        }, status=status)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.listen, self.port)
+        await site.start()
+        logger.info("Webhook 服務已啟動: http://%s:%s%s", self.listen, self.port, self.path)
+
+    def stop_accepting(self):
+        """停止接收新的更新，已排隊的更新繼續處理"""
+        self.accepting = False
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        logger.info("Webhook 服務已停止")
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """以 Prometheus 文本格式輸出所有指標"""
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+def profile_handler(profiler, default_seconds: float):
+    """返回 GET /debug/profile?seconds=N 的處理函數：採樣後返回 collapsed 格式的調用棧文件"""
+    async def handle_profile(request: web.Request) -> web.StreamResponse:
+        try:
+            seconds = float(request.query.get("seconds", default_seconds))
+        except ValueError:
+            return web.Response(status=400, text="seconds 必須是數字")
+        try:
+            path, samples = await profiler.profile(seconds)
+        except ProfilerBusyError:
+            return web.Response(status=409, text="已有採樣在進行中")
+        return web.FileResponse(path, headers={"X-Profile-Samples": str(samples)})
+    return handle_profile
+
+
+class MetricsServer:
+    """只監聽內網地址、單獨提供 /metrics 的 aiohttp 服務，所有運行模式都使用"""
+
+    def __init__(self, listen: str, port: int):
+        self.listen = listen
+        self.port = port
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", handle_metrics)
+        self._runner = None
+
+    def add_get(self, path: str, handler):
+        self.app.router.add_get(path, handler)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.listen, self.port)
+        await site.start()
+        logger.info("指標服務已啟動: http://%s:%s/metrics", self.listen, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -1,8 +1,4 @@
-from bot.role_chat_bot import RoleChatBot
-
-def main():
-    bot = RoleChatBot()
-    bot.run()
+from bot.role_chat_bot import main
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,110 @@
+"""上下文佈局的前綴穩定性：系統消息在各輪之間逐字節相同，歷史記錄只出現在末尾"""
+from bot.role_manager import RoleManager
+
+MODEL = "gpt-3.5-turbo"
+USER_ID = 42
+ROLE_ID = "butler"
+ROLES = {
+    "butler": {
+        "name": "管家",
+        "description": "專業盡責的管家",
+        "prompt": "你現在是一位專業的管家。\r\n\r\n背景：\n- 做事認真負責，注重細節   \n",
+    },
+    "female_lover": {
+        "name": "虛擬戀人(女)",
+        "description": "可愛活潑的女性戀人",
+        "prompt": "你現在是一位虛擬戀人，名字是{name}。",
+    },
+}
+
+
+def make_manager(budget: int) -> RoleManager:
+    return RoleManager(ROLES, 24, 200, {MODEL: budget})
+
+
+def system_prefix(messages: list) -> list:
+    prefix = []
+    for message in messages:
+        if message["role"] != "system":
+            break
+        prefix.append(message["content"].encode("utf-8"))
+    return prefix
+
+
+def assert_history_trails(messages: list, history, pending: str):
+    """系統消息全部在前，之後是歷史記錄的一段連續後綴，最後是待回覆的用戶消息"""
+    prefix_length = len(system_prefix(messages))
+    tail = messages[prefix_length:]
+    assert all(message["role"] != "system" for message in tail)
+    assert tail[-1] == {"role": "user", "content": pending}
+    included = [(message["role"], message["content"]) for message in tail[:-1]]
+    stored = [(message.role, message.content) for message in history]
+    assert included == stored[len(stored) - len(included):]
+
+
+def run_turns(manager: RoleManager, turns: int, custom_name: str = None, summarize_every: int = 0) -> list:
+    """模擬多輪對話，返回每輪的 (消息列表, 當時的摘要)"""
+    results = []
+    for turn in range(turns):
+        if summarize_every and turn and turn % summarize_every == 0:
+            history = manager.get_chat_history(USER_ID, ROLE_ID)
+            manager.compact_chat_history(USER_ID, ROLE_ID, f"第 {turn} 輪之前的摘要", history[len(history) // 2])
+        pending = f"第 {turn} 輪：今天幫我安排一下行程，順便提醒我買牛奶。"
+        messages, _ = manager.build_context(USER_ID, ROLE_ID, MODEL, custom_name, pending_text=pending)
+        assert_history_trails(messages, manager.get_chat_history(USER_ID, ROLE_ID), pending)
+        results.append((messages, manager.chat_history.get_summary(USER_ID, ROLE_ID)))
+        manager.add_chat_history(USER_ID, ROLE_ID, {"role": "user", "content": pending})
+        manager.add_chat_history(USER_ID, ROLE_ID, {"role": "assistant", "content": f"好的，第 {turn} 輪的行程已經安排好了。"})
+    return results
+
+
+def test_system_prompt_is_byte_identical_across_turns():
+    results = run_turns(make_manager(100000), 10)
+    first = system_prefix(results[0][0])
+    assert len(first) == 1
+    for messages, _ in results:
+        assert system_prefix(messages) == first
+
+
+def test_custom_name_prompt_is_byte_identical_across_turns():
+    manager = make_manager(100000)
+    prompts = set()
+    for _ in range(3):
+        messages, _ = manager.build_context(USER_ID, "female_lover", MODEL, "小  明", pending_text="你好")
+        prompts.add(system_prefix(messages)[0])
+    assert len(prompts) == 1
+
+
+def test_each_turn_extends_previous_turn_within_budget():
+    results = run_turns(make_manager(100000), 10)
+    for (previous, _), (current, _) in zip(results, results[1:]):
+        assert current[:len(previous)] == previous
+
+
+def test_history_window_keeps_prefix_between_repacks():
+    results = run_turns(make_manager(600), 30)
+    kept = sum(
+        1 for (previous, _), (current, _) in zip(results, results[1:])
+        if current[:len(previous)] == previous
+    )
+    # 超出預算時一次裁剪到預算的 PACK_RATIO，大多數輪次沿用上一輪的歷史起點
+    assert len(results) // 2 < kept < len(results) - 1
+    assert len({tuple(system_prefix(messages)[:1]) for messages, _ in results}) == 1
+
+
+def test_summary_sits_between_system_prompt_and_history():
+    results = run_turns(make_manager(100000), 12, summarize_every=4)
+    base_prompt = system_prefix(results[0][0])[0]
+    for messages, summary in results:
+        prefix = system_prefix(messages)
+        assert prefix[0] == base_prompt
+        if summary is None:
+            assert len(prefix) == 1
+        else:
+            assert len(prefix) == 2
+            assert prefix[1].decode("utf-8").endswith(summary)
+
+    # 摘要不變的相鄰輪次之間，包括摘要在內的整個前綴保持不變
+    for (previous, previous_summary), (current, summary) in zip(results, results[1:]):
+        if summary == previous_summary:
+            assert current[:len(previous)] == previous